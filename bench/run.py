@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import hmac
+import socket
+import hashlib
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+
+# Benchmarks of the sync and dashboard hot paths against a synthetic shop (see synthetic_shop.py).
+#   Each scenario runs in its own process so its peak RSS is its own. Usage:
+#     python bench/run.py --line-items 100000 [--scenario parse] [--output bench_output.txt]
+#   Scenarios needing the app's dependencies (flask, ShopifyAPI, prefect) are reported as skipped without them.
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+SCENARIOS = ["parse", "normalize", "load", "routes", "app_installed"]
+
+SHOP = "bench-shop.myshopify.com"
+SECRET = "bench-secret"
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def data_dir(root, line_items) -> str:
+    # generated once per scale, reused by later runs
+    from synthetic_shop import SyntheticShop
+    path = os.path.join(root, f"shop-{line_items}")
+    if not os.path.exists(os.path.join(path, "inventory_levels.jsonl")):
+        SyntheticShop(line_items).write(path)
+    return path
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def load_shop(shop_data, data):
+    from bulk_reader import read_bulk_records
+    for name in ("products", "variants"):
+        with open(os.path.join(data, f"{name}.jsonl"), 'rb') as f:
+            shop_data.load(name, read_bulk_records(f))
+    with open(os.path.join(data, "orders.jsonl"), 'rb') as f:
+        shop_data.load_orders(read_bulk_records(f))
+
+
+def scenario_parse(data) -> dict:
+    from bulk_reader import read_bulk_records
+
+    def parse():
+        with open(os.path.join(data, "orders.jsonl"), 'rb') as f:
+            return sum(1 for _ in read_bulk_records(f))
+
+    seconds, orders = timed(parse)
+    return {'seconds': seconds, 'orders': orders, 'orders_per_second': orders / seconds}
+
+
+def scenario_normalize(data) -> dict:
+    from normalize import normalize_orders, concat
+
+    def normalize():
+        with open(os.path.join(data, "orders.jsonl"), 'rb') as f:
+            batches = list(normalize_orders(f))
+        return concat(line_items for _, line_items in batches)
+
+    seconds, line_items = timed(normalize)
+    count = len(line_items['id']) if line_items else 0
+    return {'seconds': seconds, 'line_items': count, 'line_items_per_second': count / seconds}
+
+
+def scenario_load(data) -> dict:
+    from data_store import ShopData
+    shop_data = ShopData(SHOP)
+    seconds, _ = timed(lambda: load_shop(shop_data, data))
+    return {'seconds': seconds, **{name: len(table) for name, table in shop_data.tables.items()}}
+
+
+def _latencies(client, url, repeat) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        samples.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, f"{url}: {response.status_code}"
+    samples.sort()
+    return {'median_ms': statistics.median(samples), 'p95_ms': samples[int(len(samples) * 0.95) - 1], 'bytes': len(response.data)}
+
+
+def scenario_routes(data, repeat: int = 50) -> dict:
+    from server import app, STORE
+    shop_data = STORE.shop(SHOP)
+    seconds, _ = timed(lambda: load_shop(shop_data, data))
+
+    shop = urllib.parse.quote(SHOP)
+    datatables = "draw=1&start=0&length=50&search[value]=&order[0][column]=1&order[0][dir]=desc"
+    routes = {
+        'products2': f"/products2?shop={shop}",
+        'data_orders': f"/data/orders?shop={shop}&{datatables}&columns[1][data]=created_at",
+        'data_variants': f"/data/variants?shop={shop}&{datatables}&columns[1][data]=sku",
+        'data_line_items_search': f"/data/line_items?shop={shop}&draw=1&start=0&length=50&search[value]=SKU-0000001",
+        'product_variants': f"/product_variants?shop={shop}&product_id=1",
+        'inventory_metrics': f"/inventory_metrics?shop={shop}",
+    }
+    client = app.test_client()
+    results = {'load_seconds': seconds}
+    for name, url in routes.items():
+        results[name] = _latencies(client, url, repeat)
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _signed_query(params: dict) -> str:
+    # as checked by helpers.verify_web_call
+    data = '&'.join(f"{key}={value}" for key, value in params.items())
+    signature = hmac.new(SECRET.encode('utf-8'), data.encode('utf-8'), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(dict(params, hmac=signature))
+
+
+def scenario_app_installed(data, bulk_latency: float = 0.5, timeout: float = 600) -> dict:
+    # OAuth callback to all datasets loaded, against the stand-in. Prefect is not part of the measurement:
+    #   flow runs are recorded instead of submitted.
+    from shopify_standin import ShopifyStandIn
+    from werkzeug.serving import make_server
+
+    port = _free_port()
+    app_origin = f"http://127.0.0.1:{port}"
+    standin = ShopifyStandIn({name: os.path.join(data, f"{name}.jsonl") for name in ("products", "variants", "orders", "inventory_levels")},
+                             tempfile.mkdtemp(prefix="standin-"), secret=SECRET, bulk_latency=bulk_latency).start()
+    os.environ['SHOPIFY_ADMIN_ORIGIN'] = standin.origin
+    os.environ['WEBHOOK_APP_UNINSTALL_URL'] = f"{app_origin}/app_uninstalled"
+    os.environ['WEBHOOK_QUERY_FINISHED_URL'] = f"{app_origin}/query_finished"
+    os.environ['WEBHOOK_DATA_UPDATED_URL'] = f"{app_origin}/data_updated"
+
+    import flow_dispatch
+    submitted = []
+
+    class FlowRun:
+        def __init__(self, name):
+            self.id = f"bench-{len(submitted)}"
+            self.state = None
+            submitted.append(name)
+
+    flow_dispatch.submit_deployment = lambda name, flow_run_name, parameters: FlowRun(name)
+
+    from server import app, STORE, JOBS
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = app.test_client()
+
+    try:
+        started = time.perf_counter()
+        launched = client.get(f"/app_launched?{_signed_query({'shop': SHOP})}")
+        state = urllib.parse.parse_qs(urllib.parse.urlparse(launched.headers['Location']).query)['state'][0]
+        installed = client.get(f"/app_installed?{_signed_query({'code': 'bench', 'shop': SHOP, 'state': state})}")
+        acknowledged = time.perf_counter() - started
+        assert installed.status_code == 302, installed.status_code
+
+        deadline = time.monotonic() + timeout
+        while not JOBS.status(SHOP)['done']:
+            if time.monotonic() > deadline:
+                raise TimeoutError("sync did not finish")
+            time.sleep(0.05)
+        seconds = time.perf_counter() - started
+
+        status = JOBS.status(SHOP)
+        shop_data = STORE.shop(SHOP)
+        return {
+            'seconds': seconds,
+            'redirect_seconds': acknowledged,
+            'jobs': status['counts'],
+            'flow_runs': len(submitted),
+            **{name: len(table) for name, table in shop_data.tables.items()},
+        }
+    finally:
+        server.shutdown()
+        standin.stop()
+
+
+def run_scenario(name, data) -> dict:
+    sys.path[:0] = [SRC_DIR, BENCH_DIR]
+    try:
+        result = globals()[f"scenario_{name}"](data)
+    except ImportError as ex:
+        return {'skipped': f"missing module {ex.name}"}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def isolated_env(work_dir) -> dict:
+    # the app reads its settings at import time, these keep it off the real store and the real cache
+    env = dict(os.environ)
+    env.update({
+        'SHOPIFY_SECRET': SECRET,
+        'SHOPIFY_API_KEY': "bench-api-key",
+        'SHOPIFY_API_VERSION': env.get('SHOPIFY_API_VERSION', "2024-04"),
+        'APP_NAME': "bench",
+        'INSTALL_REDIRECT_URL': "http://127.0.0.1/app_installed",
+        'BULK_CACHE_DIR': os.path.join(work_dir, "bulk"),
+        'WEBHOOK_QUEUE_PATH': os.path.join(work_dir, "webhooks.sqlite3"),
+        'SHARED_STATE_PATH': os.path.join(work_dir, "shared_state.sqlite3"),
+        'SNAPSHOT_DIR': os.path.join(work_dir, "snapshots"),
+        'BULK_POLL_INITIAL_INTERVAL': env.get('BULK_POLL_INITIAL_INTERVAL', "1"),
+        'FLOW_MAX_IN_FLIGHT_PER_SHOP': "1000000",
+        # no scheduled refresh in the middle of a measurement
+        'REFRESH_WINDOW': "",
+    })
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync and dashboard hot paths")
+    parser.add_argument('--line-items', type=int, default=100_000)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="default: all")
+    parser.add_argument('--data-root', default=os.path.join(tempfile.gettempdir(), "inventory_guru_bench"))
+    parser.add_argument('--output', default=None, help="also append the results to this file, e.g. bench_output.txt")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, data_dir(args.data_root, args.line_items))))
+        return 0
+
+    sys.path.insert(0, BENCH_DIR)
+    seconds, data = timed(lambda: data_dir(args.data_root, args.line_items))
+    results = {'line_items': args.line_items, 'data': data, 'generate_seconds': seconds, 'scenarios': {}}
+    for name in args.scenario or SCENARIOS:
+        work_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+        process = subprocess.run([sys.executable, __file__, '--child', name, '--line-items', str(args.line_items),
+                                  '--data-root', args.data_root], capture_output=True, text=True, env=isolated_env(work_dir))
+        if process.returncode != 0:
+            results['scenarios'][name] = {'failed': process.stderr.strip().splitlines()[-1:]}
+        else:
+            results['scenarios'][name] = json.loads(process.stdout.strip().splitlines()[-1])
+        print(f"{name}: {json.dumps(results['scenarios'][name])}", flush=True)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+import urllib.request
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the parts of a shop's Admin API the sync path uses:
+#   POST /admin/oauth/access_token
+#   POST /admin/api/<version>/graphql.json    bulkOperationRunQuery, currentBulkOperation, node(id:), orders(first: 1)
+#   GET  /bulk/<operation>.jsonl              result files, served from the synthetic shop (see synthetic_shop.py)
+#   GET, POST, DELETE /admin/api/<version>/webhooks[/<id>].json
+# Bulk operations complete after `bulk_latency` seconds, then bulk_operations/finish is sent to the subscribed address
+#   (or `webhook_url`) signed with `secret`, like Shopify would. Point the app at it with SHOPIFY_ADMIN_ORIGIN.
+#   With `fail_after`, the first operation of each dataset exporting more lines than that FAILs with a partial file
+#   cut mid-line, to exercise resumed exports.
+
+ROOTS = {'orders': 'orders', 'products': 'products', 'productVariants': 'variants', 'inventoryItems': 'inventory_levels'}
+COST = {
+    'requestedQueryCost': 10,
+    'actualQueryCost': 10,
+    'throttleStatus': {'maximumAvailable': 1000.0, 'currentlyAvailable': 990, 'restoreRate': 50.0},
+}
+
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def search_filters(search: str) -> list:
+    # "created_at:>='...' AND updated_at:>'...' AND id:>123" -> [(record field, operator, value)]
+    filters = []
+    for field, operator, value, number in re.findall(r"(created_at|updated_at|id):(>=|<=|>|<)(?:'([^']+)'|(\d+))", search or ""):
+        filters.append(({'created_at': 'createdAt', 'updated_at': 'updatedAt', 'id': 'id'}[field], operator, int(number) if number else value))
+    return filters
+
+
+def matches(record: dict, filters: list) -> bool:
+    for field, operator, value in filters:
+        actual = record.get(field)
+        if actual is None:
+            continue
+        if field == 'id':
+            actual = int(actual.rsplit('/', 1)[1])
+        if not {'>=': actual >= value, '<=': actual <= value, '>': actual > value, '<': actual < value}[operator]:
+            return False
+    return True
+
+
+class StandInState:
+    def __init__(self, data_paths: dict, out_dir: str, webhook_url: str, secret: str, bulk_latency: float, fail_after: int = None):
+        self.data_paths = data_paths
+        self.fail_after = fail_after
+        self.failed = set()
+        self.out_dir = out_dir
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.bulk_latency = bulk_latency
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.current = None
+        self.webhooks = {}
+        self.next_id = 1
+        self.origin = None
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def run_bulk_query(self, shop, query: str) -> dict:
+        root = re.search(r'\b(orders|products|productVariants|inventoryItems)\b', query).group(1)
+        search = re.search(r'\(query:\s*"([^"]*)"\)', query)
+        operation = {
+            'id': f"gid://shopify/BulkOperation/{self.new_id()}",
+            'status': "CREATED",
+            'errorCode': None,
+            'createdAt': timestamp(),
+            'completedAt': None,
+            'objectCount': "0",
+            'fileSize': None,
+            'url': None,
+            'partialDataUrl': None,
+        }
+        with self.lock:
+            self.operations[operation['id']] = operation
+            self.current = operation['id']
+        # the mutation answers with the operation as created, whatever the export thread did since
+        created = dict(operation)
+        threading.Thread(target=self._complete, args=(shop, operation, ROOTS[root], search.group(1) if search else None), daemon=True).start()
+        return created
+
+    def _complete(self, shop, operation, dataset, search):
+        started = time.monotonic()
+        operation['status'] = "RUNNING"
+        filters = search_filters(search)
+        key = operation['id'].rsplit('/', 1)[1]
+        path = os.path.join(self.out_dir, f"{key}.jsonl")
+
+        count = 0
+        keep = True
+        fail = self.fail_after is not None and dataset not in self.failed
+        with open(self.data_paths[dataset], 'rb') as src, open(path, 'wb') as dst:
+            for line in src:
+                if filters:
+                    record = json.loads(line)
+                    if '__parentId' not in record:
+                        keep = matches(record, filters)
+                if keep and fail and count >= self.fail_after:
+                    dst.write(line[:len(line) // 2])
+                    break
+                if keep:
+                    dst.write(line)
+                    count += 1
+            else:
+                fail = False
+
+        time.sleep(max(self.bulk_latency - (time.monotonic() - started), 0))
+        size = os.path.getsize(path)
+        if fail:
+            self.failed.add(dataset)
+        operation.update({
+            'status': "FAILED" if fail else "COMPLETED",
+            'errorCode': "INTERNAL_SERVER_ERROR" if fail else None,
+            'completedAt': timestamp(),
+            'objectCount': str(count),
+            'fileSize': str(size),
+            'url': f"{self.origin}/bulk/{key}.jsonl" if count and not fail else None,
+            'partialDataUrl': f"{self.origin}/bulk/{key}.jsonl" if fail else None,
+        })
+        self.send_webhook(shop, "bulk_operations/finish", {
+            'admin_graphql_api_id': operation['id'],
+            'completed_at': operation['completedAt'],
+            'created_at': operation['createdAt'],
+            'error_code': operation['errorCode'] and operation['errorCode'].lower(),
+            'status': operation['status'].lower(),
+        })
+
+    def send_webhook(self, shop, topic, payload):
+        # to the address the app subscribed for the topic, `webhook_url` when it did not subscribe
+        address = next((webhook['address'] for webhook in list(self.webhooks.values()) if webhook.get('topic') == topic), self.webhook_url)
+        if not address:
+            return
+        body = json.dumps(payload).encode('utf-8')
+        signature = base64.b64encode(hmac.new(self.secret.encode('utf-8'), body, hashlib.sha256).digest()).decode()
+        request = urllib.request.Request(address, data=body, method="POST", headers={
+            'Content-Type': "application/json",
+            'X-Shopify-Topic': topic,
+            'X-Shopify-Hmac-Sha256': signature,
+            'X-Shopify-Shop-Domain': shop,
+            'X-Shopify-Webhook-Id': f"standin-{self.new_id()}",
+        })
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+        except Exception as ex:
+            print(f"webhook {topic} to {address} failed: {ex}", file=sys.stderr)
+
+    def first_order_created_at(self):
+        with open(self.data_paths['orders'], 'rb') as f:
+            for line in f:
+                record = json.loads(line)
+                if '__parentId' not in record:
+                    return record['createdAt']
+        return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StandInState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Shopify-Shop-Api-Call-Limit', "1/40")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _shop(self) -> str:
+        return self.headers.get('X-Shopify-Shop-Domain') or "bench-shop.myshopify.com"
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/bulk/'):
+            file_path = os.path.join(self.state.out_dir, os.path.basename(path))
+            if not os.path.exists(file_path):
+                return self._send_json({'errors': "Not Found"}, 404)
+            self.send_response(200)
+            self.send_header('Content-Type', "application/jsonl")
+            self.send_header('Content-Length', str(os.path.getsize(file_path)))
+            self.end_headers()
+            with open(file_path, 'rb') as f:
+                while chunk := f.read(1024 * 1024):
+                    self.wfile.write(chunk)
+        elif path.endswith('/webhooks.json'):
+            self._send_json({'webhooks': list(self.state.webhooks.values())})
+        elif path.endswith('/webhooks/count.json'):
+            self._send_json({'count': len(self.state.webhooks)})
+        else:
+            self._send_json({'errors': "Not Found"}, 404)
+
+    def do_DELETE(self):
+        match = re.search(r'/webhooks/(\d+)\.json$', self.path)
+        if match:
+            self.state.webhooks.pop(int(match.group(1)), None)
+        self._send_json({})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        payload = self._read_json()
+        if path == '/admin/oauth/access_token':
+            return self._send_json({'access_token': "bench-access-token", 'scope': "read_products,read_orders"})
+        if path.endswith('/webhooks.json'):
+            webhook = dict(payload.get('webhook', {}), id=self.state.new_id())
+            self.state.webhooks[webhook['id']] = webhook
+            return self._send_json({'webhook': webhook}, 201)
+        if path.endswith('/graphql.json'):
+            return self._send_json(self._graphql(payload.get('query', ''), payload.get('variables') or {}))
+        self._send_json({'errors': "Not Found"}, 404)
+
+    def _graphql(self, query: str, variables: dict) -> dict:
+        state = self.state
+        if 'bulkOperationRunQuery' in query:
+            operation = state.run_bulk_query(self._shop(), query)
+            data = {'bulkOperationRunQuery': {'bulkOperation': {'id': operation['id'], 'status': operation['status']}, 'userErrors': []}}
+        elif 'currentBulkOperation' in query:
+            data = {'currentBulkOperation': state.operations.get(state.current)}
+        elif 'node(' in query:
+            data = {'node': state.operations.get(variables.get('id'))}
+        elif 'orders(first: 1' in query:
+            created_at = state.first_order_created_at()
+            data = {'orders': {'edges': [{'node': {'createdAt': created_at}}] if created_at else []}}
+        else:
+            return {'errors': [{'message': "Query not supported by the stand-in"}]}
+        return {'data': data, 'extensions': {'cost': COST}}
+
+
+class ShopifyStandIn:
+    def __init__(self, data_paths: dict, out_dir: str, webhook_url: str = None, secret: str = "bench-secret",
+                 bulk_latency: float = 0.5, host: str = "127.0.0.1", port: int = 0, fail_after: int = None):
+        os.makedirs(out_dir, exist_ok=True)
+        self.state = StandInState(data_paths, out_dir, webhook_url, secret, bulk_latency, fail_after=fail_after)
+        handler = type('Handler', (StandInHandler,), {'state': self.state})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.origin = f"http://{host}:{self.server.server_address[1]}"
+        self.state.origin = self.origin
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic shop through a local Admin API stand-in")
+    parser.add_argument('--data', default="bench_data", help="directory written by synthetic_shop.py")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--webhook-url', default=None, help="where bulk_operations/finish is sent, e.g. http://127.0.0.1:5000/query_finished")
+    parser.add_argument('--secret', default=os.environ.get('SHOPIFY_SECRET', "bench-secret"))
+    parser.add_argument('--bulk-latency', type=float, default=0.5)
+    parser.add_argument('--fail-after', type=int, default=None, help="fail the first export of each dataset after this many lines")
+    args = parser.parse_args(argv)
+
+    data_paths = {name: os.path.join(args.data, f"{name}.jsonl") for name in ("products", "variants", "orders", "inventory_levels")}
+    standin = ShopifyStandIn(data_paths, os.path.join(args.data, "operations"), webhook_url=args.webhook_url,
+                             secret=args.secret, bulk_latency=args.bulk_latency, port=args.port, fail_after=args.fail_after)
+    print(f"Admin API stand-in on {standin.origin}, set SHOPIFY_ADMIN_ORIGIN={standin.origin}")
+    standin.server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+# Synthetic shop data in the bulk operation JSONL layout of src/queries (products, productVariants, inventoryItems)
+#   and order_query.build_orders_query('full'): one object per line, children after their parent with `__parentId`.
+
+CURRENCY = "EUR"
+PRODUCT_TYPES = ["Shirts", "Pants", "Shoes", "Hats", "Bags", "Socks", "Jackets", "Accessories"]
+VENDORS = ["Acme", "Globex", "Initech", "Umbrella", "Hooli", "Stark", "Wayne", "Tyrell"]
+SIZES = ["XS", "S", "M", "L", "XL"]
+COLLECTIONS = 12
+LOCATIONS = ["Warehouse", "Store"]
+
+
+def gid(kind, i) -> str:
+    return f"gid://shopify/{kind}/{i}"
+
+
+def timestamp(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def money(amount: float) -> dict:
+    return {'amount': f"{amount:.2f}", 'currencyCode': CURRENCY}
+
+
+def money_set(amount: float) -> dict:
+    return {'shopMoney': money(amount), 'presentmentMoney': money(amount)}
+
+
+class SyntheticShop:
+    # Catalog sizes follow the number of line items: ~2.5 line items per order, ~100 line items per variant
+    #   over the history, 4 variants per product. Demand per variant is skewed (a few best sellers).
+
+    def __init__(self, line_items: int, variants: int = None, days: int = 365, seed: int = 0, end: datetime = None):
+        self.rng = random.Random(seed)
+        self.line_items = line_items
+        self.variants = variants or max(8, line_items // 100)
+        self.products = max(1, self.variants // 4)
+        self.days = days
+        self.end = (end or datetime.now(timezone.utc)).replace(microsecond=0)
+        self.start = self.end - timedelta(days=days)
+        self.prices = [round(self.rng.uniform(5, 150), 2) for _ in range(self.variants)]
+        # Zipf-like popularity, cumulative weights for rng.choices
+        weights = [1.0 / (rank + 1) ** 0.8 for rank in range(self.variants)]
+        self.rng.shuffle(weights)
+        self.cum_weights = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+
+    def product_of(self, variant: int) -> int:
+        return variant // 4 + 1
+
+    def iter_products(self):
+        for p in range(1, self.products + 1):
+            created_at = timestamp(self.start - timedelta(days=self.rng.randint(1, 400)))
+            variants = [v for v in range((p - 1) * 4, min(p * 4, self.variants))]
+            prices = [self.prices[v] for v in variants] or [0.0]
+            yield {
+                'id': gid('Product', p),
+                'title': f"Product {p}",
+                'description': f"Description of product {p}",
+                'descriptionHtml': f"<p>Description of product {p}</p>",
+                'createdAt': created_at,
+                'updatedAt': created_at,
+                'productType': PRODUCT_TYPES[p % len(PRODUCT_TYPES)],
+                'vendor': VENDORS[p % len(VENDORS)],
+                'tags': [PRODUCT_TYPES[p % len(PRODUCT_TYPES)].lower()],
+                'priceRange': {'minVariantPrice': money(min(prices)), 'maxVariantPrice': money(max(prices))},
+                'totalInventory': 0,
+                'onlineStoreUrl': None,
+                'status': "ACTIVE",
+            }
+            for v in variants:
+                yield {
+                    'id': gid('ProductVariant', v + 1),
+                    'title': SIZES[v % len(SIZES)],
+                    'sku': f"SKU-{v + 1:08d}",
+                    'price': f"{self.prices[v]:.2f}",
+                    'compareAtPrice': None,
+                    'availableForSale': True,
+                    'weight': 0.5,
+                    'weightUnit': "KILOGRAMS",
+                    '__parentId': gid('Product', p),
+                }
+            yield {
+                'id': gid('Collection', p % COLLECTIONS + 1),
+                'title': f"Collection {p % COLLECTIONS + 1}",
+                'descriptionHtml': "",
+                '__parentId': gid('Product', p),
+            }
+
+    def iter_variants(self):
+        for v in range(self.variants):
+            created_at = timestamp(self.start - timedelta(days=self.rng.randint(1, 400)))
+            yield {
+                'id': gid('ProductVariant', v + 1),
+                'title': SIZES[v % len(SIZES)],
+                'sku': f"SKU-{v + 1:08d}",
+                'price': f"{self.prices[v]:.2f}",
+                'compareAtPrice': None,
+                'availableForSale': True,
+                'weight': 0.5,
+                'weightUnit': "KILOGRAMS",
+                'selectedOptions': [{'name': "Size", 'value': SIZES[v % len(SIZES)]}],
+                'product': {'id': gid('Product', self.product_of(v))},
+                'inventoryQuantity': self.rng.randint(0, 500),
+                'inventoryPolicy': "DENY",
+                'requiresShipping': True,
+                'taxCode': None,
+                'inventoryItem': {
+                    'id': gid('InventoryItem', v + 1),
+                    'createdAt': created_at,
+                    'updatedAt': created_at,
+                    'unitCost': money(self.prices[v] * 0.4),
+                },
+            }
+
+    def iter_inventory_levels(self):
+        # Each variant's inventory item, its stock split over LOCATIONS (drawn again, not tied to inventoryQuantity)
+        for v in range(self.variants):
+            yield {
+                'id': gid('InventoryItem', v + 1),
+                'tracked': True,
+                'variant': {'id': gid('ProductVariant', v + 1)},
+            }
+            for l, location in enumerate(LOCATIONS, start=1):
+                available = self.rng.randint(0, 250)
+                yield {
+                    'id': f"{gid('InventoryLevel', l)}?inventory_item_id={v + 1}",
+                    'location': {'id': gid('Location', l), 'name': location},
+                    'quantities': [{'name': "available", 'quantity': available}, {'name': "on_hand", 'quantity': available},
+                                   {'name': "committed", 'quantity': 0}, {'name': "incoming", 'quantity': 0}],
+                    'updatedAt': timestamp(self.end),
+                    '__parentId': gid('InventoryItem', v + 1),
+                }
+
+    def iter_orders(self):
+        # Orders in createdAt order, spread evenly over the history
+        n_orders = max(1, round(self.line_items / 2.5))
+        written = 0
+        step = self.days * 86400 / n_orders
+        for o in range(1, n_orders + 1):
+            remaining = self.line_items - written
+            if remaining <= 0:
+                break
+            count = remaining if o == n_orders else min(remaining, self.rng.randint(1, 4))
+            created_at = self.start + timedelta(seconds=int(o * step))
+            variants = self.rng.choices(range(self.variants), cum_weights=self.cum_weights, k=count)
+            line_items = []
+            subtotal = 0.0
+            for variant in variants:
+                quantity = self.rng.randint(1, 3)
+                price = self.prices[variant]
+                discounted = round(price * (0.9 if self.rng.random() < 0.2 else 1.0), 2)
+                subtotal += discounted * quantity
+                written += 1
+                line_items.append({
+                    'id': gid('LineItem', written),
+                    'quantity': quantity,
+                    'sku': f"SKU-{variant + 1:08d}",
+                    'vendor': VENDORS[self.product_of(variant) % len(VENDORS)],
+                    'fulfillableQuantity': 0,
+                    'fulfillmentStatus': "fulfilled",
+                    'product': {'id': gid('Product', self.product_of(variant))},
+                    'variant': {'id': gid('ProductVariant', variant + 1)},
+                    'originalUnitPriceSet': money_set(price),
+                    'discountedUnitPriceSet': money_set(discounted),
+                    '__parentId': gid('Order', o),
+                })
+
+            tax = round(subtotal * 0.2, 2)
+            total = round(subtotal + tax, 2)
+            yield {
+                'id': gid('Order', o),
+                'createdAt': timestamp(created_at),
+                'cancelledAt': timestamp(created_at + timedelta(hours=2)) if self.rng.random() < 0.02 else None,
+                'closedAt': None,
+                'currencyCode': CURRENCY,
+                'customerLocale': "en",
+                'totalPrice': f"{total:.2f}",
+                'updatedAt': timestamp(created_at + timedelta(days=1)),
+                'processedAt': timestamp(created_at),
+                'subtotalPrice': f"{subtotal:.2f}",
+                'totalTax': f"{tax:.2f}",
+                'totalShippingPrice': "0.00",
+                'totalDiscounts': "0.00",
+                'totalWeight': 0,
+                'currentTotalPriceSet': money_set(total),
+                'currentTotalDiscountsSet': money_set(0.0),
+                'currentTotalTaxSet': money_set(tax),
+                'currentSubtotalPriceSet': money_set(subtotal),
+                'shippingAddress': {'provinceCode': None, 'countryCode': "DE", 'city': "Berlin"},
+            }
+            yield from line_items
+
+    def write(self, out_dir) -> dict:
+        # -> {'products': path, 'variants': path, 'orders': path, 'inventory_levels': path}
+        os.makedirs(out_dir, exist_ok=True)
+        paths = {}
+        for name, records in (("products", self.iter_products()), ("variants", self.iter_variants()), ("orders", self.iter_orders()),
+                              ("inventory_levels", self.iter_inventory_levels())):
+            path = os.path.join(out_dir, f"{name}.jsonl")
+            with open(path, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(',', ':')))
+                    f.write('\n')
+            paths[name] = path
+        return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic bulk operation JSONL files for a shop")
+    parser.add_argument('--line-items', type=int, default=10_000)
+    parser.add_argument('--variants', type=int, default=None)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default="bench_data")
+    args = parser.parse_args(argv)
+
+    shop = SyntheticShop(args.line_items, variants=args.variants, days=args.days, seed=args.seed)
+    for name, path in shop.write(args.out).items():
+        print(f"{name}: {path} ({os.path.getsize(path)} bytes)")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
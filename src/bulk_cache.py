@@ -0,0 +1,265 @@
+import os
+import gzip
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from bulk_reader import read_bulk_records
+from shared_state import SHARED_STATE
+
+load_dotenv()
+
+BULK_CACHE_DIR = os.environ.get('BULK_CACHE_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'bulk'))
+BULK_CACHE_MAX_BYTES = int(os.environ.get('BULK_CACHE_MAX_BYTES', 20 * 1024 ** 3))
+BULK_CACHE_MAX_AGE = float(os.environ.get('BULK_CACHE_MAX_AGE', 7 * 24 * 60 * 60))
+# A file handed over to an ingestion flow is not evicted for this long, the flow reads it on its own schedule
+BULK_CACHE_PIN_SECONDS = float(os.environ.get('BULK_CACHE_PIN_SECONDS', 24 * 60 * 60))
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]
+
+
+def operation_key(operation_id: str) -> str:
+    # gid://shopify/BulkOperation/123 -> 123
+    return operation_id.rsplit('/', 1)[-1]
+
+
+class BulkCache:
+    # Bulk operation results on local disk, gzip compressed, addressed by shop / query hash / bulk operation ID.
+    #   <dir>/<shop>/<query hash>-<operation>.jsonl.gz  the file as downloaded from Shopify
+    #   <dir>/<shop>/<query hash>-<operation>.json      manifest (shop, query hash, operation, size, ...)
+    # Access refreshes an entry's mtime, eviction drops entries past the age budget then least recently used ones.
+    #   Files still referenced are kept: pinned for an ingestion flow (see #pin), or listed by a source registered
+    #   with #add_references (checkpoints of exports in progress, dataset handles).
+
+    def __init__(self, root: str = BULK_CACHE_DIR, max_bytes: int = BULK_CACHE_MAX_BYTES, max_age: float = BULK_CACHE_MAX_AGE,
+                 state=SHARED_STATE):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.state = state
+        self._lock = threading.Lock()
+        self._references = []
+
+    def path(self, shop, query: str, operation_id: str) -> Path:
+        return self.root / shop / f"{query_hash(query)}-{operation_key(operation_id)}.jsonl.gz"
+
+    def get(self, shop, query: str, operation_id: str) -> Path:
+        path = self.path(shop, query, operation_id)
+        if not path.exists():
+            return None
+        self._touch(path)
+        return path
+
+    def latest(self, shop, query: str) -> Path:
+        # most recent complete cached export of a query, e.g. to re-run ingestion without going back to Shopify
+        entries = sorted((self.root / shop).glob(f"{query_hash(query)}-*.jsonl.gz"), key=lambda p: p.stat().st_mtime)
+        for path in reversed(entries):
+            if not (self.manifest(path) or {}).get('partial'):
+                return path
+        return None
+
+    def store(self, shop, query: str, operation_id: str, url: str, http) -> Path:
+        # http: the shop's transport (see transport.py)
+        path = self.get(shop, query, operation_id)
+        if path:
+            return path
+
+        path = self.path(shop, query, operation_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+
+        response = http.request("GET", url, stream=True, throttle=False)
+        try:
+            response.raise_for_status()
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            response.close()
+
+        os.replace(tmp_path, path)
+        manifest = {
+            'shop': shop,
+            'query_hash': query_hash(query),
+            'operation_id': operation_id,
+            'size': path.stat().st_size,
+            'created_at': time.time(),
+        }
+        path.with_name(path.name[:-len('.jsonl.gz')] + '.json').write_text(json.dumps(manifest))
+        logging.info(f"Cached bulk operation {operation_id} of shop {shop} at {path} ({manifest['size']} bytes)")
+
+        self.evict()
+        return path
+
+    def manifest(self, path) -> dict:
+        path = Path(path)
+        try:
+            return json.loads(path.with_name(path.name[:-len('.jsonl.gz')] + '.json').read_text())
+        except FileNotFoundError:
+            return None
+
+    def merge(self, shop, query: str, key: str, paths: list) -> Path:
+        # Concatenates shard exports of `query` (e.g. created_at windows) into one cached entry under `key`.
+        #   Shards must not overlap; parents keep their children since every shard is complete on its own.
+        path = self.path(shop, query, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                for shard_path in paths:
+                    with self.open_lines(shard_path) as src:
+                        for line in src:
+                            dst.write(line if line.endswith(b'\n') else line + b'\n')
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        os.replace(tmp_path, path)
+        manifest = {
+            'shop': shop,
+            'query_hash': query_hash(query),
+            'operation_id': key,
+            'shards': [str(shard_path) for shard_path in paths],
+            'size': path.stat().st_size,
+            'created_at': time.time(),
+        }
+        path.with_name(path.name[:-len('.jsonl.gz')] + '.json').write_text(json.dumps(manifest))
+        logging.info(f"Merged {len(paths)} shards of shop {shop} into {path} ({manifest['size']} bytes)")
+
+        self.evict()
+        return path
+
+    def trim_partial(self, path) -> tuple:
+        # The partial file of a FAILED operation (partialDataUrl) stops anywhere, possibly mid-line. It is cut back to
+        #   before its last top-level object, whose children may be missing, so that every object left is complete.
+        #   Returns (GID of the last top-level object kept or None when none is left, whether the top-level objects
+        #   came in ascending ID order, which resuming `id:>` that GID relies on).
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        group, last_kept = [], None
+        previous_id, ascending = None, True
+        try:
+            with self.open_lines(path) as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                for line in src:
+                    if not line.endswith(b'\n'):
+                        break
+                    if b'"__parentId"' in line:
+                        group.append(line)
+                        continue
+                    # a new top-level object, the previous one is complete
+                    if group:
+                        dst.writelines(group)
+                        last_kept = group[0]
+                    group = [line]
+                    object_id = int(json.loads(line)['id'].rsplit('/', 1)[-1])
+                    ascending = ascending and (previous_id is None or object_id > previous_id)
+                    previous_id = object_id
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        os.replace(tmp_path, path)
+        cursor = json.loads(last_kept)['id'] if last_kept else None
+        manifest = dict(self.manifest(path) or {}, partial=True, cursor=cursor, ascending=ascending, size=path.stat().st_size)
+        path.with_name(path.name[:-len('.jsonl.gz')] + '.json').write_text(json.dumps(manifest))
+        return cursor, ascending
+
+    def open_lines(self, path):
+        self._touch(Path(path))
+        return gzip.open(path, 'rb')
+
+    def read_records(self, path, batch_size: int = None, limit: int = None):
+        with self.open_lines(path) as f:
+            yield from read_bulk_records(f, batch_size=batch_size, limit=limit)
+
+    def mmap(self, path) -> mmap.mmap:
+        # Read-only memory map over the uncompressed JSONL. The file is decompressed next to the cached one and
+        #   unlinked as soon as it is mapped, its pages are freed once the mapping is closed.
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name[:-len('.gz')]}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self._touch(path)
+        try:
+            with gzip.open(path, 'rb') as src, open(tmp_path, 'w+b') as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                dst.flush()
+                # an empty file cannot be mapped (e.g. an incremental export without changes)
+                if dst.tell() == 0:
+                    return None
+                return mmap.mmap(dst.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def read_records_mmap(self, path, batch_size: int = None, limit: int = None):
+        view = self.mmap(path)
+        if view is None:
+            return
+        try:
+            yield from read_bulk_records(iter(view.readline, b''), batch_size=batch_size, limit=limit)
+        finally:
+            view.close()
+
+    def _touch(self, path: Path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def pin(self, path, seconds: float = BULK_CACHE_PIN_SECONDS):
+        # keeps the file from eviction for `seconds`, e.g. while an ingestion flow has still to read it
+        self.state.set("bulk_pins", str(path), True, ttl=seconds)
+
+    def add_references(self, fn):
+        # fn() -> paths of cached files still needed, never evicted
+        self._references.append(fn)
+
+    def referenced(self) -> set:
+        paths = set(self.state.keys("bulk_pins"))
+        for fn in self._references:
+            paths.update(str(path) for path in fn() if path)
+        return paths
+
+    def _entries(self):
+        for path in self.root.glob("*/*.jsonl.gz"):
+            stem = path.name[:-len('.jsonl.gz')]
+            files = [path, path.with_name(stem + '.json')]
+            stats = [f.stat() for f in files if f.exists()]
+            yield path.stat().st_mtime, sum(stat.st_size for stat in stats), files
+
+    def evict(self):
+        referenced = self.referenced()
+        with self._lock:
+            now = time.time()
+            entries = sorted(self._entries(), key=lambda entry: entry[0])
+            total = sum(size for _, size, _ in entries)
+
+            for accessed_at, size, files in entries:
+                if now - accessed_at <= self.max_age and total <= self.max_bytes:
+                    continue
+                if str(files[0]) in referenced:
+                    continue
+                for f in files:
+                    f.unlink(missing_ok=True)
+                total -= size
+                logging.info(f"Evicted cached bulk file {files[0]}")
+
+    def drop(self, shop):
+        with self._lock:
+            shutil.rmtree(self.root / shop, ignore_errors=True)
+
+
+BULK_CACHE = BulkCache()
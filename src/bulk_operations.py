@@ -0,0 +1,256 @@
+import os
+import uuid
+import socket
+import logging
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from shared_state import SHARED_STATE
+from bulk_cache import BULK_CACHE, query_hash
+
+load_dotenv()
+
+# Deadline for a single bulk operation, from creation to a terminal status
+BULK_OPERATION_TIMEOUT = float(os.environ.get('BULK_OPERATION_TIMEOUT', 4 * 60 * 60))
+# Polling fallback used when the bulk_operations/finish webhook does not show up
+BULK_POLL_INITIAL_INTERVAL = float(os.environ.get('BULK_POLL_INITIAL_INTERVAL', 10))
+BULK_POLL_MAX_INTERVAL = float(os.environ.get('BULK_POLL_MAX_INTERVAL', 300))
+# How long a webhook that arrived before its waiter registered is kept around
+BULK_EARLY_NOTIFICATION_TTL = float(os.environ.get('BULK_EARLY_NOTIFICATION_TTL', 15 * 60))
+# How often a waiter checks the shared state for a webhook handled by another worker process
+BULK_SIGNAL_POLL_INTERVAL = float(os.environ.get('BULK_SIGNAL_POLL_INTERVAL', 1))
+# Follow-up exports of the remainder of a FAILED bulk operation, per sync
+BULK_RESUME_MAX_ATTEMPTS = int(os.environ.get('BULK_RESUME_MAX_ATTEMPTS', 3))
+# How long the progress of an unfinished export is kept for the next sync to resume from
+BULK_CHECKPOINT_TTL = float(os.environ.get('BULK_CHECKPOINT_TTL', 6 * 60 * 60))
+# A finished export not handed over to ingestion yet is returned again for this long and this many times at most,
+#   after that (e.g. ingestion keeps failing) the next sync runs a new export
+BULK_CHECKPOINT_REUSE_AGE = float(os.environ.get('BULK_CHECKPOINT_REUSE_AGE', 60 * 60))
+BULK_CHECKPOINT_MAX_REUSES = int(os.environ.get('BULK_CHECKPOINT_MAX_REUSES', 3))
+# Bulk operations running and result files downloading at once, over every shop and worker process (see BulkSlots)
+BULK_MAX_OPERATIONS = int(os.environ.get('BULK_MAX_OPERATIONS', 16))
+BULK_MAX_DOWNLOADS = int(os.environ.get('BULK_MAX_DOWNLOADS', 4))
+# Bulk operations of one shop at once. Keep at 1 unless the shop's API version allows concurrent bulk queries (2026-01 and later)
+BULK_SHOP_OPERATIONS = int(os.environ.get('BULK_SHOP_OPERATIONS', 1))
+# How often a sync waiting for a slot checks again
+BULK_SLOT_POLL_INTERVAL = float(os.environ.get('BULK_SLOT_POLL_INTERVAL', 2))
+
+BULK_TERMINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELED", "EXPIRED")
+
+
+class BulkOperationTimeout(Exception):
+    pass
+
+
+class BulkOperationFailed(Exception):
+    pass
+
+
+class BulkOperationWaiter:
+    def __init__(self, shop, operation_id, dispatcher=None):
+        self.shop = shop
+        self.operation_id = operation_id
+        self.payload = None
+        self.dispatcher = dispatcher
+        self._event = threading.Event()
+
+    def set(self, payload=None):
+        self.payload = payload
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    def wait(self, timeout=None) -> bool:
+        # Woken right away by a webhook handled in this process, notifications left in the shared state by other
+        #   processes are picked up every BULK_SIGNAL_POLL_INTERVAL
+        if self.dispatcher is None:
+            return self._event.wait(timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else BULK_SIGNAL_POLL_INTERVAL
+            if self._event.wait(max(min(remaining, BULK_SIGNAL_POLL_INTERVAL), 0)):
+                return True
+            if self.dispatcher.claim(self):
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+
+class BulkOperationDispatcher:
+    # Matches bulk_operations/finish webhooks to the fetch waiting on that operation.
+    # Waiters are keyed by (shop, admin_graphql_api_id) so any number of shops and operations can be followed at once.
+    #   Notifications without a waiter in this process go to the shared state, where the waiter of another worker
+    #   process (or one registering later) claims them.
+
+    def __init__(self, early_notification_ttl: float = BULK_EARLY_NOTIFICATION_TTL, state=SHARED_STATE):
+        self.early_notification_ttl = early_notification_ttl
+        self.state = state
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    @staticmethod
+    def _signal_key(shop, operation_id) -> str:
+        return f"{shop}|{operation_id}"
+
+    def register(self, shop, operation_id) -> BulkOperationWaiter:
+        waiter = BulkOperationWaiter(shop, operation_id, dispatcher=self)
+        with self._lock:
+            self._waiters[(shop, operation_id)] = waiter
+        self.claim(waiter)
+        return waiter
+
+    def claim(self, waiter: BulkOperationWaiter) -> bool:
+        signal = self.state.pop("bulk_notifications", self._signal_key(waiter.shop, waiter.operation_id))
+        if signal is None:
+            return False
+        waiter.set(signal.get('payload'))
+        return True
+
+    def unregister(self, shop, operation_id):
+        with self._lock:
+            self._waiters.pop((shop, operation_id), None)
+
+    def notify(self, shop, operation_id, payload=None) -> bool:
+        key = (shop, operation_id)
+        with self._lock:
+            waiter = self._waiters.get(key)
+        if waiter:
+            waiter.set(payload)
+            return True
+
+        # The webhook can beat the mutation response back to the waiting thread, or land on another worker process
+        self.state.set("bulk_notifications", self._signal_key(shop, operation_id), {'payload': payload},
+                       ttl=self.early_notification_ttl)
+        logging.info(f"No waiter for bulk operation {operation_id} of shop {shop} in this process, notification shared")
+        return False
+
+    def pending(self, shop=None) -> list:
+        with self._lock:
+            return [operation_id for (waiter_shop, operation_id) in self._waiters if shop is None or waiter_shop == shop]
+
+
+DISPATCHER = BulkOperationDispatcher()
+
+
+class BulkCheckpoints:
+    # Progress of a bulk export, per shop and query, in the shared state so that a sync run by another (or a restarted)
+    #   process picks it up:
+    #     operation_id   bulk operation running for it, waited for again instead of starting a new one
+    #     parts          cached files exported so far, complete up to `cursor` (see BulkCache#trim_partial)
+    #     cursor         GID of the last top-level object of the parts, the rest is exported with `id:>`
+    #     path, url      the finished export, until it was handed over to ingestion
+    #     finished_at, reuses   when it finished, how many times it was returned again since
+
+    def __init__(self, state=SHARED_STATE, ttl: float = BULK_CHECKPOINT_TTL):
+        self.state = state
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(shop, query) -> str:
+        return f"{shop}|{query_hash(query)}"
+
+    def get(self, shop, query) -> dict:
+        return self.state.get("bulk_checkpoints", self._key(shop, query))
+
+    def update(self, shop, query, **fields) -> dict:
+        return self.state.update("bulk_checkpoints", self._key(shop, query), lambda current: dict(current or {}, **fields), ttl=self.ttl)
+
+    def clear(self, shop, query):
+        self.state.pop("bulk_checkpoints", self._key(shop, query))
+
+    def drop(self, shop):
+        self.state.delete_prefix("bulk_checkpoints", f"{shop}|")
+
+    def paths(self) -> list:
+        # cached files the checkpoints still need, kept from eviction
+        paths = []
+        for _, checkpoint in self.state.items("bulk_checkpoints"):
+            paths.extend(checkpoint.get('parts') or ())
+            paths.append(checkpoint.get('path'))
+        return paths
+
+
+BULK_CHECKPOINTS = BulkCheckpoints()
+BULK_CACHE.add_references(BULK_CHECKPOINTS.paths)
+
+
+class BulkSlots:
+    # Counting leases in the shared state: a bulk operation takes a slot of its shop and one of BULK_MAX_OPERATIONS
+    #   from its creation to its terminal status, a result file download one of BULK_MAX_DOWNLOADS. Holders are
+    #   <host>:<pid>:<id>; the leases of a process that died on this host are reclaimed right away, others expire
+    #   after BULK_OPERATION_TIMEOUT.
+
+    def __init__(self, state=SHARED_STATE, ttl: float = BULK_OPERATION_TIMEOUT):
+        self.state = state
+        self.ttl = ttl
+        self.limits = {'operations': BULK_MAX_OPERATIONS, 'downloads': BULK_MAX_DOWNLOADS}
+        self._host = socket.gethostname()
+
+    def _alive(self, holder) -> bool:
+        host, pid, _ = holder.split(':', 2)
+        if host != self._host:
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _take(self, key, limit, holder) -> bool:
+        now = time.time()
+
+        def take(holders):
+            holders = {other: expires_at for other, expires_at in (holders or {}).items() if expires_at > now and self._alive(other)}
+            if len(holders) < limit:
+                holders[holder] = now + self.ttl
+            return holders
+
+        return holder in self.state.update("bulk_slots", key, take)
+
+    def _give_back(self, key, holder):
+        self.state.update("bulk_slots", key, lambda holders: {other: expires_at for other, expires_at in (holders or {}).items() if other != holder})
+
+    def _keys(self, kind, shop) -> list:
+        keys = [(f"shop|{shop}", BULK_SHOP_OPERATIONS)] if kind == "operations" else []
+        return keys + [(kind, self.limits[kind])]
+
+    def acquire(self, kind, shop) -> tuple:
+        # Blocks until a slot is free, returns the lease to #release
+        holder = f"{self._host}:{os.getpid()}:{uuid.uuid4().hex}"
+        keys = self._keys(kind, shop)
+        waiting = False
+        while True:
+            taken = []
+            for key, limit in keys:
+                if not self._take(key, limit, holder):
+                    break
+                taken.append(key)
+            else:
+                return kind, shop, holder
+            for key in taken:
+                self._give_back(key, holder)
+            if not waiting:
+                logging.info(f"Waiting for a free bulk {kind} slot for shop {shop}")
+                waiting = True
+            time.sleep(BULK_SLOT_POLL_INTERVAL)
+
+    def release(self, lease):
+        kind, shop, holder = lease
+        for key, _ in self._keys(kind, shop):
+            self._give_back(key, holder)
+
+    def in_use(self) -> dict:
+        now = time.time()
+        return {kind: sum(1 for expires_at in (self.state.get("bulk_slots", kind) or {}).values() if expires_at > now)
+                for kind in self.limits}
+
+    def drop(self, shop):
+        self.state.pop("bulk_slots", f"shop|{shop}")
+
+
+BULK_SLOTS = BulkSlots()
@@ -0,0 +1,82 @@
+import json
+import logging
+from itertools import islice
+
+# Bulk operation results are JSONL: every node of a nested connection is written on its own line right after its parent,
+#   pointing back with `__parentId`. These helpers rebuild the tree one top-level record at a time,
+#   so only the record currently being assembled is held in memory.
+#   https://shopify.dev/docs/api/usage/bulk-operations/queries#the-jsonl-data-format
+
+# Where children of a given type are attached on their parent, keyed by the type in the child GID
+CHILD_KEYS = {
+    'LineItem': 'lineItems',
+    'ProductVariant': 'variants',
+    'Collection': 'collections',
+    'InventoryLevel': 'inventoryLevels',
+}
+
+
+def gid_type(gid: str) -> str:
+    # gid://shopify/LineItem/123 -> LineItem
+    return gid.split('/')[-2]
+
+
+def child_key(child: dict) -> str:
+    typename = gid_type(child['id']) if 'id' in child else '__children'
+    return CHILD_KEYS.get(typename, typename)
+
+
+def iter_jsonl(lines):
+    for line in lines:
+        if line and not line.isspace():
+            yield json.loads(line)
+
+
+def iter_bulk_records(objects):
+    # Yields each top-level object with its descendants grouped under CHILD_KEYS, as soon as the next top-level object starts
+    current = None
+    nodes = {}
+    orphans = 0
+
+    for obj in objects:
+        parent_id = obj.get('__parentId')
+        if parent_id is None:
+            if current is not None:
+                yield current
+            current = obj
+            nodes = {obj['id']: obj} if 'id' in obj else {}
+            continue
+
+        parent = nodes.get(parent_id)
+        if parent is None:
+            orphans += 1
+            continue
+
+        parent.setdefault(child_key(obj), []).append(obj)
+        if 'id' in obj:
+            nodes[obj['id']] = obj
+
+    if current is not None:
+        yield current
+
+    if orphans:
+        logging.warning(f"Skipped {orphans} bulk operation lines whose parent was not the current record")
+
+
+def iter_batches(records, batch_size: int):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_bulk_records(lines, batch_size: int = None, limit: int = None):
+    # lines: any iterable of JSONL lines (str or bytes), e.g. an open file or `response.iter_lines()`
+    records = iter_bulk_records(iter_jsonl(lines))
+    if limit is not None:
+        records = islice(records, limit)
+    if batch_size:
+        return iter_batches(records, batch_size)
+    return records
@@ -0,0 +1,80 @@
+import os
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from shopify_client import ShopifyStoreClient
+from transport import TRANSPORTS
+from shared_state import SHARED_STATE
+
+load_dotenv()
+
+CLIENT_POOL_SIZE = int(os.environ.get('CLIENT_POOL_SIZE', 256))
+# An install has to complete within this long after #app_launched
+OAUTH_NONCE_TTL = float(os.environ.get('OAUTH_NONCE_TTL', 10 * 60))
+
+
+class UnknownShop(Exception):
+    pass
+
+
+class CredentialStore:
+    # Per-shop secret values: offline access tokens, OAuth nonces. Kept in the shared state so that every worker process
+    #   sees them, e.g. the install callback landing on another worker than #app_launched.
+
+    def __init__(self, namespace, state=SHARED_STATE, ttl: float = None):
+        self.namespace = namespace
+        self.state = state
+        self.ttl = ttl
+
+    def get(self, shop):
+        return self.state.get(self.namespace, shop)
+
+    def set(self, shop, value):
+        self.state.set(self.namespace, shop, value, ttl=self.ttl)
+
+    def pop(self, shop):
+        return self.state.pop(self.namespace, shop)
+
+    def shops(self) -> list:
+        return self.state.keys(self.namespace)
+
+
+class ClientPool:
+    # LRU-bounded ShopifyStoreClient instances reused across requests, their keep-alive HTTP lives in the shop's transport.
+    #   Clients are safe to share between threads: the Shopify session is only activated for the duration of each call.
+
+    def __init__(self, tokens: CredentialStore, max_size: int = CLIENT_POOL_SIZE):
+        self.tokens = tokens
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+
+    def get(self, shop) -> ShopifyStoreClient:
+        access_token = self.tokens.get(shop)
+        if not access_token:
+            raise UnknownShop(f"No access token for shop {shop}")
+
+        with self._lock:
+            client = self._clients.get(shop)
+            if client and client.access_token == access_token:
+                self._clients.move_to_end(shop)
+                return client
+
+            client = ShopifyStoreClient(shop=shop, access_token=access_token)
+            self._clients[shop] = client
+            self._clients.move_to_end(shop)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+    def evict(self, shop):
+        with self._lock:
+            self._clients.pop(shop, None)
+        TRANSPORTS.close(shop)
+
+
+TOKENS = CredentialStore("tokens")
+NONCES = CredentialStore("nonces", ttl=OAUTH_NONCE_TTL)
+CLIENTS = ClientPool(TOKENS)
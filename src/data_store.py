@@ -0,0 +1,444 @@
+import sys
+import math
+import itertools
+import threading
+from array import array
+
+# Column kinds: ints and floats live in typed arrays, strings in a list of interned references
+#   so repeated values (vendors, currency codes, SKUs shared by line items, ...) are stored once.
+INT = 'int'
+FLOAT = 'float'
+STR = 'str'
+
+NULL_ID = 0
+
+
+def gid_to_int(gid) -> int:
+    # gid://shopify/ProductVariant/123 -> 123
+    if not gid:
+        return NULL_ID
+    return int(gid.rsplit('/', 1)[1])
+
+
+def get_path(record: dict, path: tuple):
+    value = record
+    for key in path:
+        if value is None:
+            return None
+        value = value.get(key)
+    return value
+
+
+def _new_column(kind):
+    if kind == INT:
+        return array('q')
+    if kind == FLOAT:
+        return array('d')
+    return []
+
+
+def _convert(kind, value):
+    if kind == INT:
+        return int(value) if value is not None else NULL_ID
+    if kind == FLOAT:
+        return float(value) if value is not None else math.nan
+    return sys.intern(str(value)) if value is not None else None
+
+
+def _sort_key(kind, column):
+    if kind == STR:
+        return lambda i: column[i] or ''
+    if kind == FLOAT:
+        return lambda i: -math.inf if math.isnan(column[i]) else column[i]
+    return column.__getitem__
+
+
+class Table:
+    def __init__(self, schema: dict, unique_indexes=(), indexes=()):
+        # schema: column name -> kind
+        self.schema = schema
+        self.columns = {name: _new_column(kind) for name, kind in schema.items()}
+        self.unique_indexes = {name: {} for name in unique_indexes}
+        self.indexes = {name: {} for name in indexes}
+        self._sorted_indices = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, row: dict):
+        i = self._size
+        for name, kind in self.schema.items():
+            self.columns[name].append(_convert(kind, row.get(name)))
+        for name, index in self.unique_indexes.items():
+            index[self.columns[name][i]] = i
+        for name, index in self.indexes.items():
+            value = self.columns[name][i]
+            if value not in index:
+                index[value] = array('I')
+            index[value].append(i)
+        self._size += 1
+        self._sorted_indices.clear()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def upsert(self, row: dict, key: str):
+        # Updates the row whose unique `key` matches in place (only the columns present in `row`), or appends it
+        i = self.unique_indexes[key].get(_convert(self.schema[key], row.get(key)))
+        if i is None:
+            self.append(row)
+            return
+
+        for name, index in self.unique_indexes.items():
+            if name != key and name in row:
+                index.pop(self.columns[name][i], None)
+                index[_convert(self.schema[name], row[name])] = i
+        for name, index in self.indexes.items():
+            if name in row:
+                old_value = self.columns[name][i]
+                new_value = _convert(self.schema[name], row[name])
+                if old_value != new_value:
+                    rows = index[old_value]
+                    del rows[rows.index(i)]
+                    if not rows:
+                        del index[old_value]
+                    index.setdefault(new_value, array('I')).append(i)
+        for name, kind in self.schema.items():
+            if name in row:
+                self.columns[name][i] = _convert(kind, row[name])
+        self._sorted_indices.clear()
+
+    def row(self, i: int) -> dict:
+        row = {}
+        for name, kind in self.schema.items():
+            value = self.columns[name][i]
+            if kind == FLOAT and math.isnan(value):
+                value = None
+            row[name] = value
+        return row
+
+    def rows(self, indices=None):
+        if indices is None:
+            indices = range(self._size)
+        for i in indices:
+            yield self.row(i)
+
+    def get(self, column, value):
+        i = self.unique_indexes[column].get(value)
+        return self.row(i) if i is not None else None
+
+    def lookup(self, column, value) -> list:
+        if column in self.unique_indexes:
+            i = self.unique_indexes[column].get(value)
+            return [i] if i is not None else []
+        return list(self.indexes[column].get(value, ()))
+
+    def find(self, column, value) -> list:
+        return list(self.rows(self.lookup(column, value)))
+
+    def sorted_indices(self, column) -> list:
+        # Row order of a column, computed on first use and kept until the table changes
+        if column not in self._sorted_indices:
+            self._sorted_indices[column] = sorted(range(self._size), key=_sort_key(self.schema[column], self.columns[column]))
+        return self._sorted_indices[column]
+
+
+# Dataset name -> (schema, extractors, unique indexes, indexes). Extractors map a column to its path in the bulk record.
+DATASETS = {
+    'products': (
+        {'id': INT, 'title': STR, 'product_type': STR, 'vendor': STR, 'status': STR, 'total_inventory': INT,
+         'created_at': STR, 'updated_at': STR},
+        {'id': ('id',), 'title': ('title',), 'product_type': ('productType',), 'vendor': ('vendor',),
+         'status': ('status',), 'total_inventory': ('totalInventory',), 'created_at': ('createdAt',),
+         'updated_at': ('updatedAt',)},
+        ('id',), (),
+    ),
+    'variants': (
+        {'variant_id': INT, 'product_id': INT, 'variant_title': STR, 'sku': STR, 'price': FLOAT,
+         'inventory_quantity': INT, 'inventory_item_id': INT, 'unit_cost': FLOAT},
+        {'variant_id': ('id',), 'product_id': ('product', 'id'), 'variant_title': ('title',), 'sku': ('sku',),
+         'price': ('price',), 'inventory_quantity': ('inventoryQuantity',), 'inventory_item_id': ('inventoryItem', 'id'),
+         'unit_cost': ('inventoryItem', 'unitCost', 'amount')},
+        ('variant_id', 'inventory_item_id'), ('product_id', 'sku'),
+    ),
+    'orders': (
+        {'id': INT, 'created_at': STR, 'cancelled_at': STR, 'currency_code': STR, 'total_price': FLOAT,
+         'current_total_discounts': FLOAT, 'current_total_price': FLOAT},
+        {'id': ('id',), 'created_at': ('createdAt',), 'cancelled_at': ('cancelledAt',),
+         'currency_code': ('currencyCode',), 'total_price': ('totalPrice',),
+         'current_total_discounts': ('currentTotalDiscountsSet', 'shopMoney', 'amount'),
+         'current_total_price': ('currentTotalPriceSet', 'shopMoney', 'amount')},
+        ('id',), (),
+    ),
+    'line_items': (
+        {'id': INT, 'order_id': INT, 'product_id': INT, 'variant_id': INT, 'sku': STR, 'quantity': INT,
+         'original_unit_price': FLOAT, 'discounted_unit_price': FLOAT},
+        {'id': ('id',), 'order_id': ('__parentId',), 'product_id': ('product', 'id'), 'variant_id': ('variant', 'id'),
+         'sku': ('sku',), 'quantity': ('quantity',),
+         'original_unit_price': ('originalUnitPriceSet', 'shopMoney', 'amount'),
+         'discounted_unit_price': ('discountedUnitPriceSet', 'shopMoney', 'amount')},
+        ('id',), ('order_id', 'variant_id', 'sku'),
+    ),
+    # one row per inventory item and location, records prepared by ShopData#load_inventory_levels
+    'inventory_levels': (
+        {'level_key': STR, 'inventory_item_id': INT, 'variant_id': INT, 'location_id': INT, 'location_name': STR,
+         'available': INT, 'on_hand': INT, 'committed': INT, 'incoming': INT, 'updated_at': STR},
+        {'level_key': ('levelKey',), 'inventory_item_id': ('inventoryItem', 'id'), 'variant_id': ('inventoryItem', 'variant', 'id'),
+         'location_id': ('location', 'id'), 'location_name': ('location', 'name'), 'available': ('available',),
+         'on_hand': ('on_hand',), 'committed': ('committed',), 'incoming': ('incoming',), 'updated_at': ('updatedAt',)},
+        ('level_key',), ('inventory_item_id', 'variant_id', 'location_id'),
+    ),
+}
+
+# Datasets synced from a bulk operation -> the tables they fill
+SYNCED_DATASETS = {"variants": ("variants",), "orders": ("orders", "line_items"), "products": ("products",),
+                   "inventory_levels": ("inventory_levels",)}
+
+GID_COLUMNS = {'id', 'variant_id', 'product_id', 'order_id', 'inventory_item_id', 'location_id'}
+
+
+def new_table(name) -> Table:
+    schema, _, unique_indexes, indexes = DATASETS[name]
+    return Table(schema, unique_indexes=unique_indexes, indexes=indexes)
+
+
+def table_from_columns(name, columns: dict) -> Table:
+    # Builds a table from whole columns (e.g. read back from a snapshot) without going through a row dict per row;
+    #   missing values come in as None
+    table = new_table(name)
+    size = None
+    for column, kind in table.schema.items():
+        values = columns[column]
+        if kind == INT:
+            table.columns[column] = array('q', [NULL_ID if value is None else value for value in values])
+        elif kind == FLOAT:
+            table.columns[column] = array('d', [math.nan if value is None else value for value in values])
+        else:
+            table.columns[column] = [None if value is None else sys.intern(value) for value in values]
+        size = len(values)
+    table._size = size or 0
+
+    for column, index in table.unique_indexes.items():
+        index.update((value, i) for i, value in enumerate(table.columns[column]))
+    for column, index in table.indexes.items():
+        for i, value in enumerate(table.columns[column]):
+            if value not in index:
+                index[value] = array('I')
+            index[value].append(i)
+    return table
+
+
+def _upsert(table: Table, name, rows):
+    key = DATASETS[name][2][0]
+    for row in rows:
+        table.upsert(row, key)
+
+
+def level_key(inventory_item_id: int, location_id: int) -> str:
+    # inventory levels are unique per inventory item and location
+    return f"{inventory_item_id}:{location_id}"
+
+
+def extract_row(name, record: dict) -> dict:
+    _, extractors, _, _ = DATASETS[name]
+    row = {}
+    for column, path in extractors.items():
+        value = get_path(record, path)
+        row[column] = gid_to_int(value) if column in GID_COLUMNS else value
+    return row
+
+
+# Dataset versions come from one process wide sequence, so a dropped and reloaded shop never reuses a version
+_versions = itertools.count(1)
+
+
+class ShopData:
+    # Loads build their tables aside and swap them in, merges update the loaded tables in place. Both hold `lock`
+    #   while they change the tables, readers that need a consistent view of rows or whole columns take it too.
+    #   Merges that come in while a load builds its tables are applied again to the new ones before the swap.
+
+    def __init__(self, shop):
+        self.shop = shop
+        self.tables = {}
+        self.versions = {}
+        self.lock = threading.RLock()
+        # loads building their tables, and the (name, rows) merged since the first of them started
+        self._loading = 0
+        self._merged = []
+
+    def _changed(self, *names):
+        version = next(_versions)
+        for name in names:
+            self.versions[name] = version
+
+    def version(self, *names) -> tuple:
+        # goes up whenever a sync or a webhook delta changes one of the datasets, see response_cache.py
+        return tuple(self.versions.get(name, 0) for name in names)
+
+    def unload(self, *names):
+        with self.lock:
+            for name in names:
+                self.tables.pop(name, None)
+            self._changed(*names)
+
+    def install(self, name, table: Table):
+        with self.lock:
+            self.tables[name] = table
+            self._changed(name)
+
+    def has(self, name) -> bool:
+        return name in self.tables
+
+    def table(self, name) -> Table:
+        return self.tables[name]
+
+    def _build(self) -> int:
+        # a load starts building, returns its mark in the merge log for #_swap
+        with self.lock:
+            self._loading += 1
+            return len(self._merged)
+
+    def _swap(self, mark: int, tables: dict):
+        # installs the tables a load built (None: it failed), with the merges on them since the load started
+        with self.lock:
+            try:
+                if tables is not None:
+                    for name, rows in self._merged[mark:]:
+                        if name in tables:
+                            _upsert(tables[name], name, rows)
+                    self.tables.update(tables)
+                    self._changed(*tables)
+            finally:
+                self._loading -= 1
+                if not self._loading:
+                    self._merged = []
+
+    def load(self, name, records):
+        # Builds the table aside and swaps it in, readers never see a half loaded dataset
+        mark = self._build()
+        table = new_table(name)
+        try:
+            for record in records:
+                table.append(extract_row(name, record))
+        except BaseException:
+            self._swap(mark, None)
+            raise
+        self._swap(mark, {name: table})
+        return table
+
+    def load_orders(self, records):
+        # records: orders with their line items grouped under `lineItems` (see bulk_reader)
+        mark = self._build()
+        orders = new_table('orders')
+        line_items = new_table('line_items')
+        try:
+            for record in records:
+                orders.append(extract_row('orders', record))
+                for line_item in record.get('lineItems', ()):
+                    line_items.append(extract_row('line_items', line_item))
+        except BaseException:
+            self._swap(mark, None)
+            raise
+        self._swap(mark, {'orders': orders, 'line_items': line_items})
+        return orders, line_items
+
+    def load_inventory_levels(self, records):
+        # records: inventory items with their levels grouped under `inventoryLevels` (see bulk_reader), one row per level
+        mark = self._build()
+        table = new_table('inventory_levels')
+        try:
+            for record in records:
+                for level in record.get('inventoryLevels', ()):
+                    quantities = {quantity['name']: quantity['quantity'] for quantity in level.get('quantities', ())}
+                    level_record = dict(level, inventoryItem=record, **quantities,
+                                        levelKey=level_key(gid_to_int(record['id']), gid_to_int(get_path(level, ('location', 'id')))))
+                    table.append(extract_row('inventory_levels', level_record))
+        except BaseException:
+            self._swap(mark, None)
+            raise
+        self._swap(mark, {'inventory_levels': table})
+        return table
+
+    def merge(self, name, rows):
+        # rows: store rows (see extract_row), upserted on the dataset's unique key
+        rows = list(rows)
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = new_table(name)
+            table = self.tables[name]
+            _upsert(table, name, rows)
+            if self._loading:
+                self._merged.append((name, rows))
+            self._changed(name)
+        return table
+
+    def merge_records(self, name, records) -> dict:
+        # Same as #load but for a delta export: bulk records are upserted into the existing dataset.
+        #   Returns table -> the rows merged, for the snapshot (see snapshots.py)
+        rows = [extract_row(name, record) for record in records]
+        self.merge(name, rows)
+        return {name: rows}
+
+    def merge_orders(self, records) -> dict:
+        orders, line_items = [], []
+        for record in records:
+            orders.append(extract_row('orders', record))
+            line_items.extend(extract_row('line_items', line_item) for line_item in record.get('lineItems', ()))
+        # readers see an order's line items with it
+        with self.lock:
+            self.merge('orders', orders)
+            self.merge('line_items', line_items)
+        return {'orders': orders, 'line_items': line_items}
+
+    def product(self, product_id: int):
+        with self.lock:
+            if 'products' not in self.tables:
+                return None
+            return self.tables['products'].get('id', product_id)
+
+    def variant(self, variant_id: int):
+        with self.lock:
+            return self.tables['variants'].get('variant_id', variant_id)
+
+    def variants_of(self, product_id: int) -> list:
+        with self.lock:
+            return self.tables['variants'].find('product_id', product_id)
+
+    def variants_by_sku(self, sku: str) -> list:
+        with self.lock:
+            return self.tables['variants'].find('sku', sku)
+
+    def order(self, order_id: int):
+        with self.lock:
+            return self.tables['orders'].get('id', order_id)
+
+    def line_items_of(self, order_id: int) -> list:
+        with self.lock:
+            return self.tables['line_items'].find('order_id', order_id)
+
+    def inventory_levels_of(self, variant_id: int) -> list:
+        with self.lock:
+            if 'inventory_levels' not in self.tables:
+                return []
+            return self.tables['inventory_levels'].find('variant_id', variant_id)
+
+
+class DataStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shops = {}
+
+    def shop(self, shop) -> ShopData:
+        with self._lock:
+            if shop not in self._shops:
+                self._shops[shop] = ShopData(shop)
+            return self._shops[shop]
+
+    def drop(self, shop):
+        with self._lock:
+            self._shops.pop(shop, None)
+
+
+STORE = DataStore()
@@ -0,0 +1,251 @@
+import os
+import time
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+from data_store import STORE, SYNCED_DATASETS
+from bulk_cache import BULK_CACHE
+from shared_state import SHARED_STATE
+from snapshots import SNAPSHOTS
+
+load_dotenv()
+
+# Webhook deltas kept between two full loads. Past that the other processes drop the dataset and the next sync of it
+#   is a full one.
+DATASET_HANDLE_MAX_DELTAS = int(os.environ.get('DATASET_HANDLE_MAX_DELTAS', 10000))
+# An entry whose position was taken but that is still not written after this long (its process died in between)
+#   is given up on like a full handle
+DATASET_HANDLE_GAP_SECONDS = float(os.environ.get('DATASET_HANDLE_GAP_SECONDS', 60))
+
+# What a worker process applied to its data store, so that the others can do the same. The operations on a shop's
+#   synced dataset (variants, orders, products) since its last full load are entries of their own, one per position:
+#     ('load', path) / ('load_orders', path) / ('load_inventory_levels', path)
+#                                                               bulk cache file (None: empty), replaces the dataset
+#     ('merge_records', path) / ('merge_orders', path)          incremental export merged into it
+#     ('merge', table, rows)                                    webhook delta
+#   keyed by (shop, dataset, generation, position). A full load starts a new generation at position 0. The handle
+#   itself is only the current (generation, position), so recording an entry and checking for new ones stay small
+#   however many deltas came in. Each process replays the entries it has not applied yet before serving the shop, see
+#   #refresh. A process that has not seen a dataset yet (e.g. after a restart) starts from its snapshot (see
+#   snapshots.py) and only replays the entries recorded after it.
+
+# ShopData methods taking the records alone, the others take the dataset name first
+RECORDS_ONLY_OPS = ("load_orders", "merge_orders", "load_inventory_levels")
+
+
+def _key(shop, dataset) -> str:
+    return f"{shop}|{dataset}"
+
+
+def _entry_prefix(shop, dataset, generation) -> str:
+    return f"{shop}|{dataset}|{generation:08d}|"
+
+
+def _entry_key(shop, dataset, generation, position) -> str:
+    return f"{_entry_prefix(shop, dataset, generation)}{position:010d}"
+
+
+class DatasetHandles:
+    def __init__(self, state=SHARED_STATE, store=STORE):
+        self.state = state
+        self.store = store
+        self._lock = threading.Lock()
+        self._shop_locks = {}
+        # (shop, dataset) -> (generation, entries applied) in this process
+        self._applied = {}
+        # (shop, dataset) whose snapshot this process already looked for
+        self._restored = set()
+        # (shop, dataset) -> (generation, position, first seen) of an entry missing before later ones
+        self._gaps = {}
+
+    def _shop_lock(self, shop) -> threading.Lock:
+        with self._lock:
+            return self._shop_locks.setdefault(shop, threading.Lock())
+
+    def record(self, shop, dataset, op, *args) -> list:
+        # Called by the process that just applied `op` to its own store, returns the handle's position after it
+        entry = [op, *args] if op == "merge" else [op, str(args[0]) if args[0] else None]
+        full = op.startswith("load")
+        taken = []
+
+        def advance(handle):
+            taken.clear()
+            if full:
+                taken.append(0)
+            if full or handle is None:
+                return {'generation': (handle['generation'] + 1) if handle else 1, 'position': len(taken), 'incomplete': not full}
+            if handle['incomplete']:
+                return handle
+            if handle['position'] >= DATASET_HANDLE_MAX_DELTAS:
+                logging.warning(f"Dataset handle of {dataset} for shop {shop} is full, the next sync is a full load")
+                return {'generation': handle['generation'] + 1, 'position': 0, 'incomplete': True}
+            taken.append(handle['position'])
+            return handle | {'position': handle['position'] + 1}
+
+        handle = self.state.update("datasets", _key(shop, dataset), advance)
+        generation = handle['generation']
+        if taken:
+            self.state.set("dataset_entries", _entry_key(shop, dataset, generation, taken[0]), entry)
+            if op != "merge" and entry[1]:
+                # kept in the bulk cache while the entry may be replayed, see #paths
+                self.state.set("dataset_files", _entry_key(shop, dataset, generation, taken[0]), entry[1])
+        if generation > 1 and (full or handle['incomplete']):
+            self._clear(shop, dataset, generation - 1)
+        with self._lock:
+            # entries other processes recorded in between are left to #refresh
+            if taken and (full or self._applied.get((shop, dataset)) == (generation, taken[0])):
+                self._applied[(shop, dataset)] = (generation, taken[0] + 1)
+        return [generation, handle['position']]
+
+    def needs_full_load(self, shop, dataset) -> bool:
+        # the entries since the last full load could not all be kept, see DATASET_HANDLE_MAX_DELTAS
+        handle = self.state.get("datasets", _key(shop, dataset))
+        return handle is not None and handle['incomplete']
+
+    def _start_over(self, shop, dataset, generation):
+        # a new generation without a full load, the processes drop the dataset and the next sync of it is a full one
+        def restart(handle):
+            if handle is None or handle['generation'] != generation:
+                return handle
+            return {'generation': generation + 1, 'position': 0, 'incomplete': True}
+
+        handle = self.state.update("datasets", _key(shop, dataset), restart)
+        if handle is not None and handle['generation'] == generation + 1:
+            self._clear(shop, dataset, generation)
+
+    def _clear(self, shop, dataset, generation):
+        # entries of a generation no process replays any more
+        self.state.delete_prefix("dataset_entries", _entry_prefix(shop, dataset, generation))
+        self.state.delete_prefix("dataset_files", _entry_prefix(shop, dataset, generation))
+
+    def paths(self) -> list:
+        # bulk files of the entries that may still be replayed
+        return [path for _, path in self.state.items("dataset_files")]
+
+    def refresh(self, shop):
+        # Replays what other processes applied since this one last looked, one small read per dataset when nothing changed
+        with self._shop_lock(shop):
+            for dataset in SYNCED_DATASETS:
+                self._refresh(shop, dataset)
+
+    def _refresh(self, shop, dataset):
+        handle = self.state.get("datasets", _key(shop, dataset))
+        with self._lock:
+            applied = self._applied.get((shop, dataset))
+        if applied is None and (shop, dataset) not in self._restored and not self.store.shop(shop).has(SYNCED_DATASETS[dataset][0]):
+            self._restored.add((shop, dataset))
+            snapshot = SNAPSHOTS.restore(shop, dataset, self.store.shop(shop))
+            if snapshot and snapshot['position']:
+                applied = tuple(snapshot['position'])
+                with self._lock:
+                    self._applied[(shop, dataset)] = applied
+            if snapshot and handle is None:
+                return
+        if handle is None:
+            if applied is not None:
+                self._drop(shop, dataset)
+            return
+        generation, position = handle['generation'], handle['position']
+        if applied is not None and (generation, position) <= applied:
+            return
+
+        start = applied[1] if applied is not None and applied[0] == generation else 0
+        if handle['incomplete']:
+            # nothing to replay until the next full load
+            if start == 0:
+                self._drop(shop, dataset)
+            with self._lock:
+                self._applied[(shop, dataset)] = (generation, position)
+            return
+
+        entries = []
+        after = _entry_key(shop, dataset, generation, start - 1) if start else None
+        for key, entry in self.state.items("dataset_entries", _entry_prefix(shop, dataset, generation), after):
+            if int(key.rsplit("|", 1)[1]) != start + len(entries):
+                break
+            entries.append(entry)
+        if start + len(entries) < position and self._gap(shop, dataset, generation, start + len(entries)):
+            return
+        if not entries:
+            return
+        replayed = self._replay(shop, dataset, entries)
+        if replayed < len(entries):
+            self._recover(shop, dataset, generation, start + replayed)
+            return
+        with self._lock:
+            self._applied[(shop, dataset)] = (generation, start + replayed)
+
+    def _recover(self, shop, dataset, generation, position):
+        # The bulk file of entry `position` is gone (evicted, or the cache was wiped). A snapshot saved past it has
+        #   the entry applied already and replaying goes on from there, otherwise the dataset is dropped and the next
+        #   sync of it is a full load.
+        meta = SNAPSHOTS.meta(shop, dataset)
+        if meta and meta['position'] and tuple(meta['position']) > (generation, position):
+            snapshot = SNAPSHOTS.restore(shop, dataset, self.store.shop(shop))
+            if snapshot and snapshot['position']:
+                logging.warning(f"Dataset {dataset} of shop {shop} restored from its snapshot at {snapshot['position']}")
+                with self._lock:
+                    self._applied[(shop, dataset)] = tuple(snapshot['position'])
+                return
+        logging.error(f"Dataset {dataset} of shop {shop} cannot be replayed past entry {position}, the next sync is a full load")
+        self._start_over(shop, dataset, generation)
+        self._drop(shop, dataset)
+
+    def _gap(self, shop, dataset, generation, position) -> bool:
+        # An entry not written yet: its process took the position and is about to write it, or died in between.
+        #   The entries before it are replayed meanwhile, True once it was given up on.
+        now = time.time()
+        with self._lock:
+            gap = self._gaps.get((shop, dataset))
+            if gap is None or gap[:2] != (generation, position):
+                self._gaps[(shop, dataset)] = (generation, position, now)
+                return False
+        if now - gap[2] < DATASET_HANDLE_GAP_SECONDS:
+            return False
+        logging.error(f"Entry {position} of dataset {dataset} for shop {shop} still missing after {now - gap[2]:.0f}s, "
+                      f"the next sync is a full load")
+        self._start_over(shop, dataset, generation)
+        self._drop(shop, dataset)
+        return True
+
+    def _replay(self, shop, dataset, entries) -> int:
+        # returns how many of the entries were applied, replaying stops at one whose bulk file is gone
+        shop_data = self.store.shop(shop)
+        for i, (op, *args) in enumerate(entries):
+            if op == "merge":
+                table, rows = args
+                shop_data.merge(table, rows)
+                continue
+            path = args[0]
+            if path and not os.path.exists(path):
+                logging.error(f"Bulk file {path} of dataset {dataset} for shop {shop} is gone")
+                return i
+            records = BULK_CACHE.read_records_mmap(path) if path else []
+            if op in RECORDS_ONLY_OPS:
+                getattr(shop_data, op)(records)
+            else:
+                getattr(shop_data, op)(dataset, records)
+        logging.info(f"Replayed {len(entries)} operations on dataset {dataset} for shop {shop}")
+        return len(entries)
+
+    def _drop(self, shop, dataset):
+        self.store.shop(shop).unload(*SYNCED_DATASETS[dataset])
+        with self._lock:
+            self._applied.pop((shop, dataset), None)
+
+    def drop(self, shop):
+        SNAPSHOTS.drop(shop)
+        self.state.delete_prefix("datasets", f"{shop}|")
+        self.state.delete_prefix("dataset_entries", f"{shop}|")
+        self.state.delete_prefix("dataset_files", f"{shop}|")
+        with self._lock:
+            for key in [key for key in self._applied if key[0] == shop]:
+                del self._applied[key]
+            self._restored = {key for key in self._restored if key[0] != shop}
+            self._gaps = {key: gap for key, gap in self._gaps.items() if key[0] != shop}
+
+
+HANDLES = DatasetHandles()
+BULK_CACHE.add_references(HANDLES.paths)
@@ -0,0 +1,86 @@
+from data_store import Table, STR
+
+# DataTables server-side processing protocol
+#   https://datatables.net/manual/server-side
+
+MAX_PAGE_LENGTH = 1000
+
+
+class DataTablesRequest:
+    def __init__(self, args):
+        # args: the request's query string (a werkzeug MultiDict), values that are not numbers fall back to the defaults
+        self.draw = args.get('draw', 0, type=int)
+        self.start = max(args.get('start', 0, type=int), 0)
+        length = args.get('length', 50, type=int)
+        # -1 asks for every row, capped like any other length
+        self.length = MAX_PAGE_LENGTH if length < 0 else min(length, MAX_PAGE_LENGTH)
+        self.search = (args.get('search[value]') or '').strip()
+
+        self.columns = []
+        i = 0
+        while f'columns[{i}][data]' in args:
+            self.columns.append(args.get(f'columns[{i}][data]'))
+            i += 1
+
+        self.order = []
+        i = 0
+        while f'order[{i}][column]' in args:
+            column_index = args.get(f'order[{i}][column]', -1, type=int)
+            if 0 <= column_index < len(self.columns):
+                self.order.append((self.columns[column_index], args.get(f'order[{i}][dir]', 'asc') == 'desc'))
+            i += 1
+
+
+def search_indices(table: Table, search: str, columns=None) -> list:
+    columns = [name for name in (columns or table.schema) if name in table.schema]
+    needle = search.lower()
+    number = int(search) if search.isdigit() else None
+
+    matches = []
+    for i in range(len(table)):
+        for name in columns:
+            value = table.columns[name][i]
+            if table.schema[name] == STR:
+                if value and needle in value.lower():
+                    matches.append(i)
+                    break
+            elif number is not None and value == number:
+                matches.append(i)
+                break
+    return matches
+
+
+def query_table(table: Table, query: DataTablesRequest, fn_row=None) -> dict:
+    order = [(column, descending) for column, descending in query.order if column in table.schema]
+
+    descending = False
+    if order:
+        # only the first ordering column is honoured, which is what the views send
+        column, descending = order[0]
+        indices = table.sorted_indices(column)
+    else:
+        indices = range(len(table))
+
+    records_filtered = len(table)
+    if query.search:
+        matching = set(search_indices(table, query.search, query.columns))
+        indices = [i for i in indices if i in matching]
+        records_filtered = len(indices)
+
+    # slice the page straight out of the ascending order, descending pages are read from the end
+    if descending:
+        stop = max(len(indices) - query.start, 0)
+        page = list(indices[max(stop - query.length, 0):stop])[::-1]
+    else:
+        page = indices[query.start:query.start + query.length]
+
+    rows = [table.row(i) for i in page]
+    if fn_row:
+        rows = [fn_row(row) for row in rows]
+
+    return {
+        'draw': query.draw,
+        'recordsTotal': len(table),
+        'recordsFiltered': records_filtered,
+        'data': rows,
+    }
@@ -0,0 +1,168 @@
+import os
+import math
+
+import numpy as np
+from dotenv import load_dotenv
+
+from normalize import timestamps_to_datetime64
+
+load_dotenv()
+
+# Days of sales history the matrices cover, ending with the current (UTC) day
+DEMAND_HISTORY_DAYS = int(os.environ.get('DEMAND_HISTORY_DAYS', 365))
+# Trailing windows velocities are reported for, in days
+DEMAND_VELOCITY_WINDOWS = tuple(int(days) for days in os.environ.get('DEMAND_VELOCITY_WINDOWS', '7,28,90').split(','))
+# Window the reorder point is based on, one of DEMAND_VELOCITY_WINDOWS
+DEMAND_REORDER_WINDOW = int(os.environ.get('DEMAND_REORDER_WINDOW', 28))
+DEMAND_LEAD_TIME_DAYS = float(os.environ.get('DEMAND_LEAD_TIME_DAYS', 14))
+# Safety stock in standard deviations of daily demand, 1.65 ~ 95% service level
+DEMAND_SAFETY_FACTOR = float(os.environ.get('DEMAND_SAFETY_FACTOR', 1.65))
+
+
+def match(keys: np.ndarray, values: np.ndarray):
+    # Position of each value in `keys` (unique) and whether it is there at all, without a Python level dict
+    if not len(keys):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    order = np.argsort(keys, kind='stable')
+    positions = np.minimum(np.searchsorted(keys[order], values), len(keys) - 1)
+    return order[positions], keys[order][positions] == values
+
+
+class DemandMatrix:
+    # Units sold (and revenue) per variant and day: rows follow `variant_ids`, columns the days from `start` to `end`.
+    #   Built in one pass from line item columns, every metric below is computed for all variants at once.
+
+    def __init__(self, variant_ids: np.ndarray, start: np.datetime64, units: np.ndarray, revenue: np.ndarray):
+        self.variant_ids = variant_ids
+        self.start = start
+        self.units = units
+        self.revenue = revenue
+
+    @property
+    def days(self) -> np.ndarray:
+        return self.start + np.arange(self.units.shape[1])
+
+    @classmethod
+    def from_line_items(cls, variant_ids, line_item_variant_ids, created_at, quantities, unit_prices,
+                        history_days: int = DEMAND_HISTORY_DAYS, as_of=None):
+        # variant_ids: the row axis (e.g. the variants dataset), line items of other variants are left out.
+        #   created_at: datetime64 of the line item's order, unit_prices: discounted unit price (NaN when unknown)
+        variant_ids = np.asarray(variant_ids, dtype=np.int64)
+        end = np.datetime64(as_of, 'D') if as_of is not None else np.datetime64('today', 'D')
+        start = end - (history_days - 1)
+
+        rows, known = match(variant_ids, np.asarray(line_item_variant_ids, dtype=np.int64))
+        created_at = np.asarray(created_at, dtype='datetime64[s]')
+        days = (created_at.astype('datetime64[D]') - start).astype(np.int64)
+        keep = known & ~np.isnat(created_at) & (days >= 0) & (days < history_days)
+
+        cells = rows[keep] * history_days + days[keep]
+        quantities = np.asarray(quantities, dtype=np.float64)[keep]
+        revenue = quantities * np.nan_to_num(np.asarray(unit_prices, dtype=np.float64)[keep])
+
+        size = len(variant_ids) * history_days
+        units = np.bincount(cells, weights=quantities, minlength=size).reshape(len(variant_ids), history_days)
+        revenue = np.bincount(cells, weights=revenue, minlength=size).reshape(len(variant_ids), history_days)
+        return cls(variant_ids, start, units, revenue)
+
+    @classmethod
+    def from_shop_data(cls, shop_data, history_days: int = DEMAND_HISTORY_DAYS, as_of=None):
+        # Line items of the data store joined with their order's createdAt, cancelled orders left out.
+        #   The columns are copied under the shop's lock, so a merge never leaves them of different lengths.
+        with shop_data.lock:
+            variants = shop_data.table('variants')
+            orders = shop_data.table('orders')
+            line_items = shop_data.table('line_items')
+            variant_ids = np.array(variants.columns['variant_id'], dtype=np.int64)
+            order_ids = np.array(orders.columns['id'], dtype=np.int64)
+            order_created_at = list(orders.columns['created_at'])
+            cancelled = np.array([value is not None for value in orders.columns['cancelled_at']], dtype=bool)
+            line_item_order_ids = np.array(line_items.columns['order_id'], dtype=np.int64)
+            line_item_variant_ids = np.array(line_items.columns['variant_id'], dtype=np.int64)
+            quantities = np.array(line_items.columns['quantity'], dtype=np.float64)
+            unit_prices = np.array(line_items.columns['discounted_unit_price'], dtype=np.float64)
+
+        order_created_at = timestamps_to_datetime64(order_created_at)
+        order_created_at[cancelled] = np.datetime64('NaT')
+
+        rows, matched = match(order_ids, line_item_order_ids)
+        created_at = np.full(len(rows), np.datetime64('NaT'), dtype='datetime64[s]')
+        created_at[matched] = order_created_at[rows[matched]]
+
+        return cls.from_line_items(variant_ids, line_item_variant_ids, created_at, quantities, unit_prices,
+                                   history_days=history_days, as_of=as_of)
+
+    def weekly(self) -> np.ndarray:
+        # 7 day sums, the last column is the week ending with `end`; days before the first full week are dropped
+        n_weeks = self.units.shape[1] // 7
+        trimmed = self.units[:, self.units.shape[1] - n_weeks * 7:]
+        return trimmed.reshape(len(self.variant_ids), n_weeks, 7).sum(axis=2)
+
+    def rolling(self, window: int) -> np.ndarray:
+        # Average units per day over the `window` days ending with each day (shorter at the start of the history)
+        cumulative = np.cumsum(self.units, axis=1)
+        shifted = np.zeros_like(cumulative)
+        shifted[:, window:] = cumulative[:, :-window]
+        counts = np.minimum(np.arange(1, self.units.shape[1] + 1), window)
+        return (cumulative - shifted) / counts
+
+    def velocity(self, window: int) -> np.ndarray:
+        # Average units per day over the last `window` days
+        window = min(window, self.units.shape[1])
+        return self.units[:, -window:].sum(axis=1) / window if window else np.zeros(len(self.variant_ids))
+
+    def demand_std(self, window: int) -> np.ndarray:
+        window = min(window, self.units.shape[1])
+        return self.units[:, -window:].std(axis=1) if window else np.zeros(len(self.variant_ids))
+
+
+def days_of_cover(inventory: np.ndarray, velocity: np.ndarray) -> np.ndarray:
+    # inf for variants that did not sell in the window
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cover = np.where(velocity > 0, inventory / velocity, np.inf)
+    return np.where(inventory <= 0, 0.0, cover)
+
+
+def reorder_points(velocity: np.ndarray, std: np.ndarray, lead_time: float = DEMAND_LEAD_TIME_DAYS,
+                   safety_factor: float = DEMAND_SAFETY_FACTOR) -> np.ndarray:
+    # demand over the lead time plus safety stock
+    return velocity * lead_time + safety_factor * std * math.sqrt(lead_time)
+
+
+def inventory_metrics(shop_data, history_days: int = DEMAND_HISTORY_DAYS, as_of=None,
+                      lead_time: float = DEMAND_LEAD_TIME_DAYS) -> dict:
+    # {column: np.ndarray}, one entry per variant of the shop (rows follow the variants dataset)
+    with shop_data.lock:
+        matrix = DemandMatrix.from_shop_data(shop_data, history_days=history_days, as_of=as_of)
+        variants = shop_data.table('variants')
+        inventory = np.array(variants.columns['inventory_quantity'], dtype=np.float64)
+        product_ids = np.array(variants.columns['product_id'], dtype=np.int64)
+
+    metrics = {
+        'variant_id': matrix.variant_ids,
+        'product_id': product_ids,
+        'inventory_quantity': inventory,
+        'units_sold': matrix.units.sum(axis=1),
+        'revenue': matrix.revenue.sum(axis=1),
+    }
+    for window in DEMAND_VELOCITY_WINDOWS:
+        metrics[f'velocity_{window}d'] = matrix.velocity(window)
+
+    velocity = matrix.velocity(DEMAND_REORDER_WINDOW)
+    reorder_point = reorder_points(velocity, matrix.demand_std(DEMAND_REORDER_WINDOW), lead_time=lead_time)
+    metrics['days_of_cover'] = days_of_cover(inventory, velocity)
+    metrics['reorder_point'] = reorder_point
+    # variants without recent sales are never flagged, whatever their stock
+    metrics['reorder'] = (velocity > 0) & (inventory <= reorder_point)
+    return metrics
+
+
+def metrics_rows(metrics: dict) -> list:
+    # column arrays -> JSON ready rows, inf days of cover become None
+    columns = {}
+    for name, values in metrics.items():
+        values = values.tolist()
+        if name == 'days_of_cover':
+            values = [None if math.isinf(value) else value for value in values]
+        columns[name] = values
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
@@ -0,0 +1,257 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+from lazy import lazy_module
+
+# prefect takes seconds to import, it is loaded when the first flow run is submitted or read
+deployments = lazy_module('prefect.deployments')
+orchestration = lazy_module('prefect.client.orchestration')
+
+load_dotenv()
+
+# Variants per batched forecast / optimization flow run
+FLOW_BATCH_SIZE = int(os.environ.get('FLOW_BATCH_SIZE', 500))
+# Flow runs a single shop may have scheduled or running at once
+FLOW_MAX_IN_FLIGHT_PER_SHOP = int(os.environ.get('FLOW_MAX_IN_FLIGHT_PER_SHOP', 8))
+FLOW_POLL_INTERVAL = float(os.environ.get('FLOW_POLL_INTERVAL', 10))
+# A chain of batches (forecast then optimization) gives up when its batches have not all finished after this long
+FLOW_CHAIN_TIMEOUT = float(os.environ.get('FLOW_CHAIN_TIMEOUT', 6 * 60 * 60))
+# Batches listed per shop (see #flow_batches in server.py): the most recent FLOW_BATCH_HISTORY, none older than FLOW_BATCH_HISTORY_SECONDS
+FLOW_BATCH_HISTORY = int(os.environ.get('FLOW_BATCH_HISTORY', 50))
+FLOW_BATCH_HISTORY_SECONDS = float(os.environ.get('FLOW_BATCH_HISTORY_SECONDS', 24 * 60 * 60))
+
+# Batched deployments take a `variants` list of {'product_id', 'variant_id'} instead of a single pair
+FORECAST_BATCH_DEPLOYMENT = os.environ.get('FORECAST_BATCH_DEPLOYMENT', "forecast_batch_v0.1/forecast_batch")
+OPTIMIZATION_BATCH_DEPLOYMENT = os.environ.get('OPTIMIZATION_BATCH_DEPLOYMENT', "optimization_batch_v0.1/optimization_batch")
+SYNTHETIC_SALES_BATCH_DEPLOYMENT = os.environ.get('SYNTHETIC_SALES_BATCH_DEPLOYMENT', "synthetic_sales_batch_v0.1/synthetic_sales_batch")
+
+
+def submit_deployment(name, flow_run_name, parameters):
+    # timeout=0 returns the created flow run right away instead of waiting for it to finish
+    return deployments.run_deployment( name = name, flow_run_name = flow_run_name, parameters = parameters, timeout = 0 )
+
+
+def run_ingest_orders(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
+    return FLOWS.submit( shop_name, "ingest_orders_v0.1/ingest_orders", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+def run_ingest_products(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
+    return FLOWS.submit( shop_name, "ingest_products_v0.1/ingest_products", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+def run_ingestion_variants(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
+    return FLOWS.submit( shop_name, "ingest_variants_v0.1/ingest_variants", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+def run_forecast(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
+    return FLOWS.submit( shop_name, "forecast_v0.1/forecast", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+def run_optimization(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
+    return FLOWS.submit( shop_name, "optimization_v0.1/optimization", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+def run_generate_synthetic_sales(shop_name, **kwargs):
+    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
+    return FLOWS.submit( shop_name, "synthetic_sales_v0.1/synthetic_sales", flow_run_name, {'shop_name': shop_name} | kwargs )
+
+# variants: iterable of (product_id, variant_id)
+
+def run_forecast_batches(shop_name, variants, **kwargs):
+    return FLOWS.submit_variant_batches( shop_name, FORECAST_BATCH_DEPLOYMENT, variants, **kwargs )
+
+def run_optimization_batches(shop_name, variants, **kwargs):
+    return FLOWS.submit_variant_batches( shop_name, OPTIMIZATION_BATCH_DEPLOYMENT, variants, **kwargs )
+
+def run_generate_synthetic_sales_batches(shop_name, variants, **kwargs):
+    return FLOWS.submit_variant_batches( shop_name, SYNTHETIC_SALES_BATCH_DEPLOYMENT, variants, **kwargs )
+
+def run_forecast_then_optimization(shop_name, variants, timeout: float = FLOW_CHAIN_TIMEOUT):
+    # optimization reads the forecasts, so its batches are only submitted once every forecast batch has finished
+    return FLOWS.chain( shop_name, [FORECAST_BATCH_DEPLOYMENT, OPTIMIZATION_BATCH_DEPLOYMENT], variants, timeout=timeout )
+
+
+async def _read_flow_runs(flow_run_ids):
+    async with orchestration.get_client() as client:
+        return await asyncio.gather(*[client.read_flow_run(flow_run_id) for flow_run_id in flow_run_ids])
+
+
+def read_flow_runs(flow_run_ids) -> list:
+    if not flow_run_ids:
+        return []
+    return asyncio.run(_read_flow_runs(list(flow_run_ids)))
+
+
+class FlowBatch:
+    def __init__(self, shop, deployment):
+        self.id = uuid.uuid4().hex
+        self.shop = shop
+        self.deployment = deployment
+        self.created_at = time.time()
+        self.flow_run_ids = []
+        self._states = {}
+        self._final = set()
+
+    def add(self, flow_run):
+        self.flow_run_ids.append(flow_run.id)
+        self._states[flow_run.id] = flow_run.state.name if flow_run.state else None
+
+    def refresh(self):
+        pending = [flow_run_id for flow_run_id in self.flow_run_ids if flow_run_id not in self._final]
+        for flow_run in read_flow_runs(pending):
+            self._states[flow_run.id] = flow_run.state.name
+            if flow_run.state.is_final():
+                self._final.add(flow_run.id)
+
+    def done(self) -> bool:
+        return len(self._final) == len(self.flow_run_ids)
+
+    def status(self, refresh: bool = True) -> dict:
+        if refresh and not self.done():
+            self.refresh()
+        counts = {}
+        for state in self._states.values():
+            counts[state] = counts.get(state, 0) + 1
+        return {
+            'id': self.id,
+            'shop': self.shop,
+            'deployment': self.deployment,
+            'created_at': self.created_at,
+            'flow_runs': len(self.flow_run_ids),
+            'done': self.done(),
+            'states': counts,
+        }
+
+    def wait(self, timeout: float = None, poll_interval: float = FLOW_POLL_INTERVAL) -> bool:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            self.refresh()
+            if self.done():
+                return True
+            if deadline is not None and time.monotonic() + poll_interval > deadline:
+                return False
+            time.sleep(poll_interval)
+
+
+class FlowDispatcher:
+    # Submits Prefect flow runs without waiting for them and caps how many are in flight per shop.
+    #   Submitting past the cap blocks the caller until earlier runs finish, so batches are submitted from a chain's
+    #   own thread (see #chain) rather than from a request or a job pool worker.
+
+    def __init__(self, max_in_flight_per_shop: int = FLOW_MAX_IN_FLIGHT_PER_SHOP, batch_size: int = FLOW_BATCH_SIZE,
+                 history: int = FLOW_BATCH_HISTORY, history_seconds: float = FLOW_BATCH_HISTORY_SECONDS):
+        self.max_in_flight_per_shop = max_in_flight_per_shop
+        self.batch_size = batch_size
+        self.history = history
+        self.history_seconds = history_seconds
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._batches = {}
+        self._chains = {}
+
+    def _wait_for_capacity(self, shop):
+        # the shop's finished flow runs are dropped on every check, a shop whose runs all finished leaves no entry
+        while True:
+            with self._lock:
+                in_flight = set(self._in_flight.get(shop, ()))
+            if not in_flight:
+                return
+
+            finished = {flow_run.id for flow_run in read_flow_runs(in_flight) if flow_run.state.is_final()}
+            with self._lock:
+                remaining = self._in_flight.get(shop, set()) - finished
+                if remaining:
+                    self._in_flight[shop] = remaining
+                else:
+                    self._in_flight.pop(shop, None)
+            if len(remaining) < self.max_in_flight_per_shop:
+                return
+            if not finished:
+                time.sleep(FLOW_POLL_INTERVAL)
+
+    def submit(self, shop, deployment, flow_run_name, parameters):
+        self._wait_for_capacity(shop)
+        flow_run = submit_deployment(deployment, flow_run_name, parameters)
+        with self._lock:
+            self._in_flight.setdefault(shop, set()).add(flow_run.id)
+        logging.info(f"Submitted flow run {flow_run.id} ({deployment}) for shop {shop}")
+        return flow_run
+
+    def submit_variant_batches(self, shop, deployment, variants, batch_size: int = None, **kwargs) -> FlowBatch:
+        batch_size = batch_size or self.batch_size
+        variants = [{'product_id': product_id, 'variant_id': variant_id} for product_id, variant_id in variants]
+        chunks = [variants[i:i + batch_size] for i in range(0, len(variants), batch_size)]
+
+        batch = FlowBatch(shop, deployment)
+        with self._lock:
+            self._prune(shop)
+            self._batches[batch.id] = batch
+        for i, chunk in enumerate(chunks):
+            flow_run_name = f"<{shop}><batch {i + 1}/{len(chunks)}>"
+            batch.add(self.submit(shop, deployment, flow_run_name, {'shop_name': shop, 'variants': chunk} | kwargs))
+        return batch
+
+    def chain(self, shop, deployments: list, variants, timeout: float = FLOW_CHAIN_TIMEOUT, **kwargs) -> bool:
+        # Submits the variants' batches of each deployment once those of the previous one have all finished, on a
+        #   thread of its own that mostly sleeps between polls. One chain per shop at a time, False when one runs already.
+        variants = list(variants)
+        with self._lock:
+            running = self._chains.get(shop)
+            if running and running.is_alive():
+                return False
+            thread = threading.Thread(target=self._run_chain, args=(shop, deployments, variants, timeout, kwargs),
+                                      name=f"flow-chain-{shop}", daemon=True)
+            self._chains[shop] = thread
+        thread.start()
+        return True
+
+    def _run_chain(self, shop, deployments, variants, timeout, kwargs):
+        deadline = time.monotonic() + timeout
+        try:
+            for i, deployment in enumerate(deployments):
+                batch = self.submit_variant_batches(shop, deployment, variants, **kwargs)
+                if i == len(deployments) - 1:
+                    return
+                if not batch.wait(timeout=max(deadline - time.monotonic(), 0)):
+                    logging.error(f"Flow runs of {deployment} for shop {shop} not finished after {timeout:.0f}s, "
+                                  f"{', '.join(deployments[i + 1:])} not submitted")
+                    return
+        except Exception:
+            logging.exception(f"Flow batches of shop {shop} could not be submitted")
+
+    def chain_running(self, shop) -> bool:
+        with self._lock:
+            running = self._chains.get(shop)
+            return running is not None and running.is_alive()
+
+    def _prune(self, shop):
+        # drops the shop's batches past the history, their flow runs stay in Prefect
+        cutoff = time.time() - self.history_seconds
+        batches = [batch for batch in self._batches.values() if batch.shop == shop]
+        recent = [batch.id for batch in batches if batch.created_at >= cutoff][-self.history:] if self.history > 0 else []
+        keep = set(recent)
+        for batch in batches:
+            if batch.id not in keep:
+                del self._batches[batch.id]
+
+    def batch(self, batch_id) -> FlowBatch:
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def batches(self, shop) -> list:
+        with self._lock:
+            self._prune(shop)
+            return [batch for batch in self._batches.values() if batch.shop == shop]
+
+    def in_flight(self, shop) -> int:
+        with self._lock:
+            return len(self._in_flight.get(shop, ()))
+
+
+FLOWS = FlowDispatcher()
@@ -0,0 +1,134 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# GraphQL Admin API calculated query cost, standard plan values until Shopify reports the shop's own
+#   https://shopify.dev/docs/api/usage/rate-limits#graphql-admin-api-rate-limits
+GRAPHQL_MAXIMUM_AVAILABLE = float(os.environ.get('GRAPHQL_MAXIMUM_AVAILABLE', 1000))
+GRAPHQL_RESTORE_RATE = float(os.environ.get('GRAPHQL_RESTORE_RATE', 50))
+GRAPHQL_DEFAULT_QUERY_COST = float(os.environ.get('GRAPHQL_DEFAULT_QUERY_COST', 50))
+GRAPHQL_MAX_RETRIES = int(os.environ.get('GRAPHQL_MAX_RETRIES', 5))
+
+
+def query_key(query: str) -> str:
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def is_throttled(response: dict) -> bool:
+    errors = response.get('errors') or []
+    return any((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors)
+
+
+class CostBudget:
+    # Per-shop mirror of extensions.cost.throttleStatus. Queries reserve their estimated cost before they are sent
+    #   and wait, first come first served, until the restored budget covers it.
+
+    def __init__(self, shop, maximum_available: float = GRAPHQL_MAXIMUM_AVAILABLE, restore_rate: float = GRAPHQL_RESTORE_RATE):
+        self.shop = shop
+        self.maximum_available = maximum_available
+        self.restore_rate = restore_rate
+        self.currently_available = maximum_available
+        self._updated_at = time.monotonic()
+        self._estimates = {}
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+        self.queries = 0
+        self.throttled = 0
+        self.requested_cost = 0.0
+        self.actual_cost = 0.0
+
+    def _restore(self, now):
+        elapsed = now - self._updated_at
+        self.currently_available = min(self.currently_available + elapsed * self.restore_rate, self.maximum_available)
+        self._updated_at = now
+
+    def estimate(self, query: str) -> float:
+        # requestedQueryCost of the last run of the same query, a flat default for queries not seen yet
+        with self._condition:
+            return self._estimates.get(query_key(query), GRAPHQL_DEFAULT_QUERY_COST)
+
+    def reserve(self, cost: float):
+        cost = min(cost, self.maximum_available)
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while True:
+                self._restore(time.monotonic())
+                if ticket == self._serving and self.currently_available >= cost:
+                    self.currently_available -= cost
+                    self._serving += 1
+                    self._condition.notify_all()
+                    return
+                wait = None
+                if ticket == self._serving:
+                    wait = (cost - self.currently_available) / self.restore_rate
+                self._condition.wait(wait)
+
+    def record(self, query: str, cost: dict, throttled: bool = False):
+        # cost: the response's extensions.cost
+        with self._condition:
+            self.queries += 1
+            self.throttled += 1 if throttled else 0
+            if not cost:
+                return
+
+            requested = cost.get('requestedQueryCost')
+            actual = cost.get('actualQueryCost')
+            if requested is not None:
+                self._estimates[query_key(query)] = float(requested)
+                self.requested_cost += requested
+            if actual is not None:
+                self.actual_cost += actual
+
+            status = cost.get('throttleStatus') or {}
+            if status:
+                self.maximum_available = float(status['maximumAvailable'])
+                self.restore_rate = float(status['restoreRate'])
+                self.currently_available = float(status['currentlyAvailable'])
+                self._updated_at = time.monotonic()
+            self._condition.notify_all()
+
+        logging.debug(f"GraphQL query for shop {self.shop} cost requested={requested} actual={actual}, "
+                      f"available={self.currently_available}/{self.maximum_available}")
+
+    def stats(self) -> dict:
+        with self._condition:
+            self._restore(time.monotonic())
+            return {
+                'shop': self.shop,
+                'currently_available': self.currently_available,
+                'maximum_available': self.maximum_available,
+                'restore_rate': self.restore_rate,
+                'waiting': self._next_ticket - self._serving,
+                'queries': self.queries,
+                'throttled': self.throttled,
+                'requested_cost': self.requested_cost,
+                'actual_cost': self.actual_cost,
+            }
+
+
+class CostBudgetRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._budgets = {}
+
+    def for_shop(self, shop) -> CostBudget:
+        with self._lock:
+            if shop not in self._budgets:
+                self._budgets[shop] = CostBudget(shop)
+            return self._budgets[shop]
+
+    def drop(self, shop):
+        with self._lock:
+            self._budgets.pop(shop, None)
+
+
+COST_BUDGETS = CostBudgetRegistry()
@@ -0,0 +1,18 @@
+import os
+
+# Preload-then-fork: server.py is imported once in the master with its lazily loaded dependencies preloaded
+#   (see server.preload), workers are forked from it and share those pages instead of each importing them.
+#   Run from src/:  gunicorn server:app
+
+os.environ['PRELOAD_APP'] = '1'
+
+preload_app = True
+wsgi_app = "server:app"
+bind = f"0.0.0.0:{os.environ.get('APP_PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+
+def post_fork(arbiter, worker):
+    import server
+    server.start_workers()
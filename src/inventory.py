@@ -0,0 +1,256 @@
+import os
+import math
+import time
+import heapq
+import threading
+from collections import deque
+
+from dotenv import load_dotenv
+
+from data_store import level_key
+from lazy import lazy_module
+
+load_dotenv()
+
+# numpy, only needed when an index is (re)built
+demand = lazy_module('demand')
+
+# Order of the low-stock index:
+#   days_of_cover   available / sales velocity, variants without recent sales last
+#   threshold       available - reorder point (LOW_STOCK_THRESHOLD units for variants without recent sales)
+LOW_STOCK_ORDER = os.environ.get('LOW_STOCK_ORDER', 'days_of_cover')
+LOW_STOCK_THRESHOLD = float(os.environ.get('LOW_STOCK_THRESHOLD', 5))
+# Reorder alerts kept per shop
+LOW_STOCK_ALERTS = int(os.environ.get('LOW_STOCK_ALERTS', 200))
+
+# datasets the index is built from, a change that did not go through #LowStockIndexes.apply rebuilds it
+RISK_DATASETS = ("variants", "orders", "line_items")
+
+
+class IndexedHeap:
+    # Binary min-heap of (score, key) with the position of every key: set, remove in O(log n), the k lowest in O(k log k)
+
+    def __init__(self, items=()):
+        self._heap = [(score, key) for key, score in items]
+        self._heap.sort()
+        self._positions = {key: i for i, (_, key) in enumerate(self._heap)}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def score(self, key):
+        i = self._positions.get(key)
+        return self._heap[i][0] if i is not None else None
+
+    def set(self, key, score):
+        i = self._positions.get(key)
+        if i is None:
+            self._heap.append((score, key))
+            self._positions[key] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+            return
+        old_score = self._heap[i][0]
+        self._heap[i] = (score, key)
+        if score < old_score:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def remove(self, key):
+        i = self._positions.pop(key, None)
+        if i is None:
+            return
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._positions[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._positions[last[1]])
+
+    def lowest(self, k: int) -> list:
+        # [(score, key)], best first search from the root, the heap is left untouched
+        result = []
+        candidates = [(self._heap[0], 0)] if self._heap else []
+        while candidates and len(result) < k:
+            item, i = heapq.heappop(candidates)
+            result.append(item)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self._heap):
+                    heapq.heappush(candidates, (self._heap[child], child))
+        return result
+
+    def _swap(self, i, j):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._positions[self._heap[i][1]] = i
+        self._positions[self._heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._heap[i] >= self._heap[parent]:
+                return
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        size = len(self._heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self._heap[child] < self._heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+
+class LowStockIndex:
+    # Variants of one shop ordered by risk of running out. Velocities and reorder points come from the sales history
+    #   (see demand.py) when the index is built, stock updates only move the variant they are about.
+
+    def __init__(self, ordering: str = LOW_STOCK_ORDER):
+        self.ordering = ordering
+        self.version = None
+        self.day = None
+        self.available = {}
+        self.velocity = {}
+        self.reorder_point = {}
+        self.heap = IndexedHeap()
+
+    def score(self, variant_id) -> float:
+        available = self.available[variant_id]
+        velocity = self.velocity.get(variant_id, 0.0)
+        if self.ordering == 'threshold':
+            threshold = self.reorder_point.get(variant_id, 0.0) if velocity > 0 else LOW_STOCK_THRESHOLD
+            return available - threshold
+        if available <= 0:
+            return 0.0
+        return available / velocity if velocity > 0 else math.inf
+
+    def needs_reorder(self, variant_id) -> bool:
+        # same rule as the reorder flag of /inventory_metrics
+        return self.velocity.get(variant_id, 0.0) > 0 and self.available[variant_id] <= self.reorder_point.get(variant_id, 0.0)
+
+    def build(self, shop_data):
+        # the metrics follow the variants' rows, no merge may add one in between
+        with shop_data.lock:
+            variants = shop_data.table('variants')
+            variant_ids = list(variants.columns['variant_id'])
+            self.available = dict(zip(variant_ids, variants.columns['inventory_quantity']))
+            metrics = demand.inventory_metrics(shop_data) if all(shop_data.has(name) for name in RISK_DATASETS) else None
+        self.velocity, self.reorder_point = {}, {}
+        if metrics is not None:
+            velocity = metrics[f'velocity_{demand.DEMAND_REORDER_WINDOW}d'].tolist()
+            self.velocity = dict(zip(variant_ids, velocity))
+            self.reorder_point = dict(zip(variant_ids, metrics['reorder_point'].tolist()))
+        self.heap = IndexedHeap((variant_id, self.score(variant_id)) for variant_id in variant_ids)
+
+    def update(self, variant_id, available) -> bool:
+        # O(log n), True when the variant just crossed its reorder point
+        was_flagged = variant_id in self.available and self.needs_reorder(variant_id)
+        self.available[variant_id] = available
+        self.heap.set(variant_id, self.score(variant_id))
+        return self.needs_reorder(variant_id) and not was_flagged
+
+    def lowest(self, n: int) -> list:
+        return [variant_id for _, variant_id in self.heap.lowest(n)]
+
+
+class LowStockIndexes:
+    def __init__(self, ordering: str = LOW_STOCK_ORDER):
+        self.ordering = ordering
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._alerts = {}
+
+    def for_shop(self, shop_data) -> LowStockIndex:
+        # Built on first use and again once the datasets changed other than through #apply, or the day changed
+        #   (velocities are relative to today)
+        version = shop_data.version(*RISK_DATASETS)
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        with self._lock:
+            index = self._indexes.get(shop_data.shop)
+            if index is None or index.version != version or index.day != day:
+                index = LowStockIndex(self.ordering)
+                index.build(shop_data)
+                index.version, index.day = version, day
+                self._indexes[shop_data.shop] = index
+            return index
+
+    def apply(self, shop_data, version_before, variant_id, available) -> bool:
+        # Stock change of one variant already merged into the shop's store, O(log n) when the index was current before
+        #   the merge (built again otherwise). Returns True when the variant just crossed its reorder point.
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        with self._lock:
+            index = self._indexes.get(shop_data.shop)
+            if index is not None and index.version == version_before and index.day == day:
+                alert = index.update(variant_id, available)
+                index.version = shop_data.version(*RISK_DATASETS)
+            else:
+                index = None
+        if index is None:
+            previous = self._indexes.get(shop_data.shop)
+            was_flagged = previous is not None and variant_id in previous.available and previous.needs_reorder(variant_id)
+            index = self.for_shop(shop_data)
+            alert = variant_id in index.available and index.needs_reorder(variant_id) and not was_flagged
+
+        if alert:
+            with self._lock:
+                self._alerts.setdefault(shop_data.shop, deque(maxlen=LOW_STOCK_ALERTS)).append({
+                    'variant_id': variant_id,
+                    'available': available,
+                    'reorder_point': index.reorder_point.get(variant_id),
+                    'at': time.time(),
+                })
+        return alert
+
+    def alerts(self, shop) -> list:
+        with self._lock:
+            return list(self._alerts.get(shop, ()))
+
+    def drop(self, shop):
+        with self._lock:
+            self._indexes.pop(shop, None)
+            self._alerts.pop(shop, None)
+
+
+LOW_STOCK = LowStockIndexes()
+
+
+def low_stock_rows(shop_data, n: int) -> list:
+    # The n variants most at risk with their stock per location
+    index = LOW_STOCK.for_shop(shop_data)
+    rows = []
+    for variant_id in index.lowest(n):
+        variant = shop_data.variant(variant_id)
+        score = index.heap.score(variant_id)
+        rows.append({
+            'variant_id': variant_id,
+            'product_id': variant['product_id'],
+            'sku': variant['sku'],
+            'variant_title': variant['variant_title'],
+            'available': index.available[variant_id],
+            'velocity': index.velocity.get(variant_id, 0.0),
+            'reorder_point': index.reorder_point.get(variant_id),
+            'reorder': index.needs_reorder(variant_id),
+            index.ordering: None if math.isinf(score) else score,
+            'locations': [{'location_id': level['location_id'], 'location_name': level['location_name'], 'available': level['available']}
+                          for level in shop_data.inventory_levels_of(variant_id)],
+        })
+    return rows
+
+
+def level_row_from_webhook(payload: dict) -> dict:
+    # inventory_levels/update: {"inventory_item_id": 271878346596884015, "location_id": 24826418, "available": 42,
+    #   "updated_at": "...", "admin_graphql_api_id": "gid://shopify/InventoryLevel/24826418?inventory_item_id=..."}
+    return {
+        'level_key': level_key(payload['inventory_item_id'], payload['location_id']),
+        'inventory_item_id': payload['inventory_item_id'],
+        'location_id': payload['location_id'],
+        'available': payload.get('available'),
+        'updated_at': payload.get('updated_at'),
+    }
@@ -0,0 +1,147 @@
+import os
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Finished jobs listed per shop: the most recent JOB_HISTORY of them, none older than JOB_HISTORY_SECONDS
+JOB_HISTORY = int(os.environ.get('JOB_HISTORY', 50))
+JOB_HISTORY_SECONDS = float(os.environ.get('JOB_HISTORY_SECONDS', 24 * 60 * 60))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class Job:
+    def __init__(self, shop, name):
+        self.id = uuid.uuid4().hex
+        self.shop = shop
+        self.name = name
+        self.status = JOB_QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'shop': self.shop,
+            'name': self.name,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobManager:
+    # Runs per-shop pipelines of blocking steps (bulk fetches) on a worker pool.
+    # Steps of a pipeline run one after another, and pipelines of the same shop never overlap:
+    #   Shopify only allows a single bulk operation per shop at a time. The pipelines waiting for their shop stay in a
+    #   FIFO per shop instead of on the pool, the next one is submitted once the previous finished, so a shop with a
+    #   long sync holds a single worker and the other shops keep the rest.
+
+    def __init__(self, max_workers: int = JOB_WORKERS, history: int = JOB_HISTORY, history_seconds: float = JOB_HISTORY_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        # shop -> pipelines waiting, present while one of the shop's pipelines is on the pool
+        self._queues = {}
+        self._jobs = {}
+        self.history = history
+        self.history_seconds = history_seconds
+
+    def submit(self, shop, name, fn, *args, **kwargs) -> Job:
+        return self.submit_pipeline(shop, [(name, lambda: fn(*args, **kwargs))])[0]
+
+    def submit_pipeline(self, shop, steps: list) -> list:
+        # steps: list of (name, callable) pairs
+        jobs = [Job(shop, name) for name, _ in steps]
+        job_steps = list(zip(jobs, [fn for _, fn in steps]))
+        with self._lock:
+            self._prune(shop)
+            self._jobs.setdefault(shop, []).extend(jobs)
+            if shop in self._queues:
+                self._queues[shop].append(job_steps)
+                return jobs
+            self._queues[shop] = deque()
+        self._executor.submit(self._run_pipeline, shop, job_steps)
+        return jobs
+
+    def _run_pipeline(self, shop, job_steps):
+        try:
+            self._run_steps(shop, job_steps)
+        finally:
+            with self._lock:
+                queue = self._queues[shop]
+                next_steps = queue.popleft() if queue else None
+                if next_steps is None:
+                    del self._queues[shop]
+            if next_steps is not None:
+                self._executor.submit(self._run_pipeline, shop, next_steps)
+
+    def _run_steps(self, shop, job_steps):
+        # steps are independent fetches, a failing one does not stop the rest of the pipeline
+        for job, fn in job_steps:
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            try:
+                logging.info(f"Job {job.name} started for shop {shop}")
+                fn()
+                job.status = JOB_DONE
+                logging.info(f"Job {job.name} finished for shop {shop}")
+            except Exception as ex:
+                logging.exception(f"Job {job.name} failed for shop {shop}")
+                job.status = JOB_FAILED
+                job.error = str(ex)
+            finally:
+                job.finished_at = time.time()
+
+    def _prune(self, shop):
+        # drops the finished jobs past the history, queued and running ones are always kept
+        jobs = self._jobs.get(shop)
+        if not jobs:
+            return
+        cutoff = time.time() - self.history_seconds
+        finished = [job for job in jobs if job.finished_at and job.finished_at >= cutoff][-self.history:] if self.history > 0 else []
+        keep = set(finished)
+        self._jobs[shop] = [job for job in jobs if not job.finished_at or job in keep]
+
+    def get_jobs(self, shop) -> list:
+        with self._lock:
+            self._prune(shop)
+            return list(self._jobs.get(shop, []))
+
+    def active(self, shop) -> bool:
+        # queued or running jobs for the shop in this process
+        return any(job.status in (JOB_QUEUED, JOB_RUNNING) for job in self.get_jobs(shop))
+
+    def clear_jobs(self, shop):
+        with self._lock:
+            self._jobs.pop(shop, None)
+
+    def status(self, shop) -> dict:
+        jobs = self.get_jobs(shop)
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        active = counts.get(JOB_QUEUED, 0) + counts.get(JOB_RUNNING, 0)
+        return {
+            'shop': shop,
+            'done': len(jobs) > 0 and active == 0,
+            'counts': counts,
+            'jobs': [job.to_dict() for job in jobs],
+        }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
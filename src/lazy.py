@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import importlib
+import subprocess
+
+# Heavy dependencies (prefect, the Shopify SDK, toolz, numpy) are imported on first use instead of at module import,
+#   so workers only serving dashboard pages never load them. Under a prefork server they are preloaded once in the
+#   master instead (see #preload and gunicorn.conf.py) and shared copy-on-write by the forked workers.
+#
+# Per-module import time of a cold start:
+#   python lazy.py [module]        (module defaults to server, runs python -X importtime in a fresh interpreter)
+
+# module -> seconds its import took when first used, see module_import_seconds on /metrics
+IMPORT_SECONDS = {}
+
+_LAZY_MODULES = []
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        _LAZY_MODULES.append(self)
+
+    def _load(self):
+        if self._module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            IMPORT_SECONDS.setdefault(self._name, time.perf_counter() - started)
+            logging.info(f"Imported {self._name} in {IMPORT_SECONDS[self._name]:.3f}s")
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name}{' (loaded)' if self._module is not None else ''}>"
+
+
+def lazy_module(name) -> LazyModule:
+    # Stands in for `import name`: the import happens on the first attribute access
+    return LazyModule(name)
+
+
+def preload():
+    # Imports every lazy module now, before the prefork server forks its workers
+    for module in _LAZY_MODULES:
+        try:
+            module._load()
+        except ImportError as ex:
+            logging.error(f"Could not preload {module._name}: {ex}")
+
+
+def import_times(module: str = "server") -> list:
+    # [(cumulative seconds, self seconds, module)] of `import module` in a fresh interpreter, slowest first
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.realpath(__file__)))
+    times = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        times.append((int(cumulative) / 1e6, int(own) / 1e6, name.strip()))
+    if process.returncode != 0:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+    return sorted(times, reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-module import time of a cold start")
+    parser.add_argument('module', nargs='?', default="server")
+    parser.add_argument('--top', type=int, default=30)
+    args = parser.parse_args(argv)
+
+    print(f"{'cumulative':>10} {'self':>8}  module")
+    for cumulative, own, name in import_times(args.module)[:args.top]:
+        print(f"{cumulative:10.3f} {own:8.3f}  {name}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
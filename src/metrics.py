@@ -0,0 +1,276 @@
+import os
+import math
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from shared_state import SHARED_STATE
+
+load_dotenv()
+
+# Counters, gauges and histograms rendered in the Prometheus text exposition format, see #metrics in server.py
+#   https://prometheus.io/docs/instrumenting/exposition_formats/
+# Updates only change values held in the process. Every METRICS_FLUSH_SECONDS (and before it answers a scrape) a
+#   process writes all of its values to the shared state (see shared_state.py) as one entry, and a scrape reads the
+#   entries of every worker with one query and returns the totals. Counters and histograms of a stopped process are
+#   folded into a `retired` entry so totals never go down, its gauges are dropped. Gauges read at scrape time (`fn`)
+#   describe what they read: the shared state, or the worker answering the scrape for process-local values.
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 10))
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RATE_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+RETIRED = "retired"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), state=SHARED_STATE):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.state = state
+        # label values -> value in this process
+        self._local = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def _update(self, key: tuple, fn):
+        with _LOCK:
+            self._local[key] = fn(self._local.get(key))
+        FLUSHER.changed()
+
+    def _combine(self, value, other):
+        return value + other
+
+    def dump(self) -> list:
+        # [label values, value] pairs of this process, as flushed to the shared state
+        with _LOCK:
+            return [[list(key), value] for key, value in self._local.items()]
+
+    def add(self, values: dict, dumped: list):
+        # adds the values of a process, as returned by #dump
+        for key, value in dumped:
+            key = tuple(key)
+            values[key] = self._combine(values[key], value) if key in values else value
+
+    def samples(self, values: dict):
+        # (suffix, label values, extra labels, value)
+        return [("", key, (), value) for key, value in values.items()]
+
+    def render(self, values: dict) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples(values):
+            lines.append(f"{self.name}{suffix}{_labels(self.labelnames, key, extra)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._update(self._key(labels), lambda value: (value or 0) + amount)
+
+
+class Gauge(Metric):
+    # fn: callable returning {label values tuple: value}, read at scrape time instead of set values.
+    #   Set values are kept per process and summed over the live ones.
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None, state=SHARED_STATE):
+        super().__init__(name, documentation, labelnames, state=state)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        self._update(self._key(labels), lambda _: value)
+
+    def inc(self, amount=1, **labels):
+        self._update(self._key(labels), lambda value: (value or 0) + amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self, values: dict):
+        if self.fn is None:
+            return super().samples(values)
+        return [("", key, (), value) for key, value in self.fn().items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        def add(current):
+            counts, total = current or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            return [counts, total + value]
+
+        self._update(self._key(labels), add)
+
+    def _combine(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1]]
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self, values: dict):
+        samples = []
+        for key, (counts, total) in values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append(("_bucket", key, (("le", _number(bound)),), count))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), counts[-1]))
+        return samples
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Flusher:
+    # Writes the values of this process to the shared state, from a thread of its own started with the first update
+
+    def __init__(self, state=SHARED_STATE, interval: float = METRICS_FLUSH_SECONDS):
+        self.state = state
+        self.interval = interval
+        self._event = threading.Event()
+        self._thread = None
+        # what a forked worker inherits was counted by its parent, and the flush thread is not carried over
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        for metric in REGISTRY:
+            metric._local = {}
+        self._event = threading.Event()
+        self._thread = None
+
+    def changed(self):
+        if self._thread is None:
+            with _LOCK:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                    self._thread.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Metrics could not be written to the shared state")
+            time.sleep(self.interval)
+
+    def flush(self):
+        dumped = {metric.name: metric.dump() for metric in REGISTRY if metric._local}
+        if dumped:
+            self.state.set("metrics", str(os.getpid()), dumped)
+
+    def collect(self) -> dict:
+        # metric name -> label values -> total over every process, one read of the shared state
+        self.flush()
+        metrics = {metric.name: metric for metric in REGISTRY}
+        totals = {name: {} for name in metrics}
+        for process, dumped in self.state.items("metrics"):
+            alive = process == RETIRED or _alive(int(process))
+            if not alive:
+                self._retire(process)
+            for name, values in dumped.items():
+                if name in metrics and (alive or metrics[name].kind != "gauge"):
+                    metrics[name].add(totals[name], values)
+        return totals
+
+    def _retire(self, process):
+        # folds what a stopped process counted into the retired entry, popped first so it is folded once
+        dumped = self.state.pop("metrics", process)
+        if dumped is None:
+            return
+        metrics = {metric.name: metric for metric in REGISTRY}
+
+        def fold(retired):
+            retired = retired or {}
+            for name, values in dumped.items():
+                metric = metrics.get(name)
+                if metric is None or metric.kind == "gauge":
+                    continue
+                total = {tuple(key): value for key, value in retired.get(name, ())}
+                metric.add(total, values)
+                retired[name] = [[list(key), value] for key, value in total.items()]
+            return retired
+
+        self.state.update("metrics", RETIRED, fold)
+
+
+_LOCK = threading.Lock()
+REGISTRY = []
+FLUSHER = Flusher()
+
+
+def render() -> str:
+    totals = FLUSHER.collect()
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render(totals[metric.name])
+    return "\n".join(lines) + "\n"
+
+
+# Bulk sync pipeline, per shop and resource (orders, products, productVariants). Stages:
+#   queue     waiting for a free bulk operation or download slot (see BulkSlots)
+#   create    bulkOperationRunQuery mutation round trip
+#   shopify   createdAt -> completedAt as reported by Shopify
+#   wait      mutation -> terminal status seen by the app (webhook or polling)
+#   download  result file to the bulk cache
+#   ingest    handing the file to the Prefect ingestion flow
+#   load      reading the cached file into the data store
+BULK_STAGE_SECONDS = Histogram('bulk_stage_seconds', "Duration of each stage of a bulk sync", ('shop', 'resource', 'stage'))
+BULK_OPERATIONS = Counter('bulk_operations_total', "Bulk operations by final status", ('shop', 'resource', 'status'))
+BULK_OBJECTS = Counter('bulk_objects_total', "Objects exported by completed bulk operations", ('shop', 'resource'))
+BULK_BYTES = Counter('bulk_bytes_total', "Size of the result files of completed bulk operations", ('shop', 'resource'))
+BULK_OBJECTS_PER_SECOND = Histogram('bulk_objects_per_second', "objectCount / (completedAt - createdAt)", ('shop', 'resource'), buckets=RATE_BUCKETS)
+BULK_BYTES_PER_SECOND = Histogram('bulk_bytes_per_second', "fileSize / (completedAt - createdAt)", ('shop', 'resource'), buckets=RATE_BUCKETS)
+BULK_IN_FLIGHT = Gauge('bulk_operations_in_flight', "Bulk operations created and not finished yet", ('shop', 'resource'))
+BULK_RESUMES = Counter('bulk_operations_resumed_total', "Remainders of FAILED bulk operations exported again from their last complete object", ('shop', 'resource'))
+BULK_WEBHOOK_DELAY = Histogram('bulk_webhook_delay_seconds', "completedAt -> bulk_operations/finish webhook handled", ('shop',))
+
+# Variants crossing their reorder point on an inventory_levels/update webhook, see inventory.py
+LOW_STOCK_ALERTS_TOTAL = Counter('low_stock_alerts_total', "Reorder alerts raised by stock updates", ('shop',))
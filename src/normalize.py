@@ -0,0 +1,131 @@
+import json
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
+
+from data_store import get_path
+
+# Turns bulk operation JSONL into typed columnar batches: a chunk of lines is parsed, each column collected
+#   as one raw array and converted in bulk (GIDs -> int64, money -> fixed-point int64, timestamps -> datetime64).
+#   demand.py parses its timestamps with it, bench/run.py times the orders export.
+
+NORMALIZE_CHUNK_SIZE = 100_000
+
+# Money is stored as int64 in 1/MONEY_SCALE units of the shop currency (covers 3 decimal currencies)
+MONEY_SCALE = 10_000
+# Missing amount, so that an absent price is not read as a free item
+MONEY_MISSING = np.iinfo(np.int64).min
+
+GID = 'gid'
+MONEY = 'money'
+TIMESTAMP = 'timestamp'
+INT = 'int'
+STR = 'str'
+
+# Dataset -> column name -> (kind, path in the bulk record)
+ORDER_COLUMNS = {
+    'id': (GID, ('id',)),
+    'created_at': (TIMESTAMP, ('createdAt',)),
+    'cancelled_at': (TIMESTAMP, ('cancelledAt',)),
+    'currency_code': (STR, ('currencyCode',)),
+    'total_price': (MONEY, ('totalPrice',)),
+    'current_total_price': (MONEY, ('currentTotalPriceSet', 'shopMoney', 'amount')),
+    'current_total_discounts': (MONEY, ('currentTotalDiscountsSet', 'shopMoney', 'amount')),
+    'current_total_tax': (MONEY, ('currentTotalTaxSet', 'shopMoney', 'amount')),
+}
+
+LINE_ITEM_COLUMNS = {
+    'id': (GID, ('id',)),
+    'order_id': (GID, ('__parentId',)),
+    # copied from the parent order, line items carry no date of their own
+    'created_at': (TIMESTAMP, ('__orderCreatedAt',)),
+    'product_id': (GID, ('product', 'id')),
+    'variant_id': (GID, ('variant', 'id')),
+    'sku': (STR, ('sku',)),
+    'quantity': (INT, ('quantity',)),
+    'original_unit_price': (MONEY, ('originalUnitPriceSet', 'shopMoney', 'amount')),
+    'discounted_unit_price': (MONEY, ('discountedUnitPriceSet', 'shopMoney', 'amount')),
+}
+
+def gids_to_int64(values: list) -> np.ndarray:
+    # gid://shopify/Order/123 -> 123, missing -> 0
+    raw = np.array([value or '/0' for value in values], dtype=np.str_)
+    return np.char.rpartition(raw, '/')[:, 2].astype(np.int64) if len(raw) else np.zeros(0, dtype=np.int64)
+
+
+def money_to_fixed(values: list) -> np.ndarray:
+    # "12.50" -> 125000, missing -> MONEY_MISSING
+    amounts = np.array([value if value is not None else np.nan for value in values], dtype=np.float64)
+    missing = np.isnan(amounts)
+    fixed = np.rint(np.where(missing, 0, amounts) * MONEY_SCALE).astype(np.int64)
+    fixed[missing] = MONEY_MISSING
+    return fixed
+
+
+def timestamps_to_datetime64(values: list) -> np.ndarray:
+    # GraphQL timestamps are UTC ("2024-05-01T12:00:00Z"), numpy parses them without the zone designator.
+    #   REST payloads (webhooks) carry the shop's offset ("2024-05-01T08:00:00-04:00"), those are converted one by one.
+    raw = np.array([value or 'NaT' for value in values], dtype=np.str_)
+    if not len(raw):
+        return np.zeros(0, dtype='datetime64[s]')
+    utc = np.char.endswith(raw, 'Z') | (np.char.str_len(raw) <= 19)
+    result = np.empty(len(raw), dtype='datetime64[s]')
+    result[utc] = np.char.rstrip(raw[utc], 'Z').astype('datetime64[s]')
+    result[~utc] = [int(datetime.fromisoformat(value).timestamp()) for value in raw[~utc]]
+    return result
+
+
+def ints_to_int64(values: list) -> np.ndarray:
+    return np.array([value if value is not None else 0 for value in values], dtype=np.int64)
+
+
+def strs_to_objects(values: list) -> np.ndarray:
+    return np.array(values, dtype=object)
+
+
+CONVERTERS = {
+    GID: gids_to_int64,
+    MONEY: money_to_fixed,
+    TIMESTAMP: timestamps_to_datetime64,
+    INT: ints_to_int64,
+    STR: strs_to_objects,
+}
+
+
+def to_columns(records: list, columns: dict) -> dict:
+    # records -> {column: np.ndarray}, one bulk conversion per column
+    return {name: CONVERTERS[kind]([get_path(record, path) for record in records]) for name, (kind, path) in columns.items()}
+
+
+def iter_chunks(lines, chunk_size: int = NORMALIZE_CHUNK_SIZE):
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield [json.loads(line) for line in chunk if line and not line.isspace()]
+
+
+def normalize_orders(lines, chunk_size: int = NORMALIZE_CHUNK_SIZE):
+    # orders bulk export JSONL -> (orders, line_items) column batches per chunk of lines.
+    #   Line items follow their order, so the order's createdAt is carried over even across chunk boundaries.
+    order_created_at = {}
+    for chunk in iter_chunks(lines, chunk_size):
+        orders, line_items = [], []
+        for obj in chunk:
+            parent_id = obj.get('__parentId')
+            if parent_id is None:
+                orders.append(obj)
+                order_created_at = {obj['id']: obj.get('createdAt')}
+            else:
+                obj['__orderCreatedAt'] = order_created_at.get(parent_id)
+                line_items.append(obj)
+        yield to_columns(orders, ORDER_COLUMNS), to_columns(line_items, LINE_ITEM_COLUMNS)
+
+
+def concat(batches) -> dict:
+    batches = list(batches)
+    if not batches:
+        return {}
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
@@ -0,0 +1,102 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Field profile of the orders bulk export, see PROFILES
+ORDERS_QUERY_PROFILE = os.environ.get('ORDERS_QUERY_PROFILE', 'full')
+# Width of the created_at windows a full orders export is split into, 0 exports the whole history at once
+ORDERS_SHARD_DAYS = int(os.environ.get('ORDERS_SHARD_DAYS', 90))
+# Shards exported at once. Keep at 1 unless the shop's API version allows concurrent bulk queries (2026-01 and later)
+ORDERS_SHARD_CONCURRENCY = int(os.environ.get('ORDERS_SHARD_CONCURRENCY', 1))
+# Closed windows exported at most this long ago are reused from the bulk cache when a full export is retried
+ORDERS_SHARD_REUSE_AGE = float(os.environ.get('ORDERS_SHARD_REUSE_AGE', 6 * 60 * 60))
+
+SHOP_MONEY = 'shop'
+ALL_MONEY = 'all'
+
+# Profile -> what ends up in the query. Money sets are selected with shopMoney only or shopMoney and presentmentMoney,
+#   `full` is the selection queries/orders.graphql held before profiles existed.
+PROFILES = {
+    'full': {
+        'order_fields': ['id', 'createdAt', 'cancelledAt', 'closedAt', 'currencyCode', 'customerLocale', 'totalPrice',
+                         'updatedAt', 'processedAt', 'subtotalPrice', 'totalTax', 'totalShippingPrice', 'totalDiscounts',
+                         'totalWeight'],
+        'order_money_sets': ['currentTotalPriceSet', 'currentTotalDiscountsSet', 'currentTotalTaxSet', 'currentSubtotalPriceSet'],
+        'line_item_fields': ['id', 'quantity', 'sku', 'vendor', 'fulfillableQuantity', 'fulfillmentStatus',
+                             'product { id }', 'variant { id }'],
+        'line_item_money_sets': ['originalUnitPriceSet', 'discountedUnitPriceSet'],
+        'money': ALL_MONEY,
+        'shipping_address': True,
+    },
+    # what the data store, normalization and forecasting read: shop currency amounts only, no fulfillment or address data
+    'forecasting-minimal': {
+        'order_fields': ['id', 'createdAt', 'updatedAt', 'cancelledAt', 'currencyCode', 'totalPrice'],
+        'order_money_sets': ['currentTotalPriceSet', 'currentTotalDiscountsSet', 'currentTotalTaxSet'],
+        'line_item_fields': ['id', 'quantity', 'sku', 'product { id }', 'variant { id }'],
+        'line_item_money_sets': ['originalUnitPriceSet', 'discountedUnitPriceSet'],
+        'money': SHOP_MONEY,
+        'shipping_address': False,
+    },
+}
+
+
+def _money_set(name, money, indent):
+    pad = ' ' * indent
+    selections = ['shopMoney'] if money == SHOP_MONEY else ['shopMoney', 'presentmentMoney']
+    lines = [f"{pad}{name} {{"]
+    for selection in selections:
+        lines += [f"{pad}    {selection} {{", f"{pad}        amount", f"{pad}        currencyCode", f"{pad}    }}"]
+    lines.append(f"{pad}}}")
+    return lines
+
+
+def build_orders_query(profile: str = ORDERS_QUERY_PROFILE) -> str:
+    # Bulk query body in the layout of queries/*.graphql, ready for sync.with_search and fetch_bulk_operation_data
+    spec = PROFILES[profile]
+    lines = ["orders {", "edges {", "node {"]
+    lines += [f"        {field}" for field in spec['order_fields']]
+    for name in spec['order_money_sets']:
+        lines += _money_set(name, spec['money'], 8)
+
+    lines += ["        lineItems {", "        edges {", "        node {"]
+    lines += [f"                {field}" for field in spec['line_item_fields']]
+    for name in spec['line_item_money_sets']:
+        lines += _money_set(name, spec['money'], 16)
+    lines += ["        }", "        }", "        }"]
+
+    if spec['shipping_address']:
+        lines += ["        shippingAddress {", "            provinceCode", "            countryCode", "            city", "        }"]
+    lines += ["}", "}", "}"]
+    return "\n".join(lines)
+
+
+def _format(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def created_at_windows(start: datetime, days: int = ORDERS_SHARD_DAYS, end: datetime = None) -> list:
+    # [start, start + days), [start + days, ...), ... The last window is left open so orders created while
+    #   the export runs are not missed. Windows never overlap, so the shard files concatenate into one export.
+    if not days:
+        return [(None, None)]
+    end = end or datetime.now(timezone.utc)
+    windows = []
+    since = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while since + timedelta(days=days) <= end:
+        windows.append((since, since + timedelta(days=days)))
+        since += timedelta(days=days)
+    windows.append((since, None))
+    windows[0] = (None, windows[0][1])
+    return windows
+
+
+def created_at_search(since: datetime, until: datetime) -> str:
+    terms = []
+    if since is not None:
+        terms.append(f"created_at:>='{_format(since)}'")
+    if until is not None:
+        terms.append(f"created_at:<'{_format(until)}'")
+    return " AND ".join(terms)
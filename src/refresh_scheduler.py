@@ -0,0 +1,191 @@
+import os
+import math
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from jobs import JOB_WORKERS, JOB_FAILED
+from data_store import SYNCED_DATASETS
+from shared_state import SHARED_STATE
+from snapshots import SNAPSHOTS
+
+load_dotenv()
+
+# Daily UTC window the scheduled refreshes run in, HH:MM-HH:MM (may wrap past midnight). Empty disables them.
+REFRESH_WINDOW = os.environ.get('REFRESH_WINDOW', '01:00-05:00')
+# A shop is due once its least recently synced dataset is this old
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 12 * 60 * 60))
+# Shops refreshing at once. Half the job workers by default, the rest stays free for installs and webhooks
+REFRESH_MAX_IN_FLIGHT = int(os.environ.get('REFRESH_MAX_IN_FLIGHT', max(JOB_WORKERS // 2, 1)))
+# A shop whose refresh failed is left alone this long
+REFRESH_RETRY_DELAY = float(os.environ.get('REFRESH_RETRY_DELAY', 60 * 60))
+# How often the scheduler looks for due shops
+REFRESH_TICK = float(os.environ.get('REFRESH_TICK', 30))
+
+
+def parse_window(window: str) -> tuple:
+    # "01:00-05:00" -> (60, 300) minutes after midnight, None when empty
+    if not window:
+        return None
+    start, end = (int(hours) * 60 + int(minutes) for hours, minutes in (part.split(':') for part in window.split('-')))
+    return start, end
+
+
+def window_remaining(window: tuple, now: datetime) -> float:
+    # seconds left of the window `now` is in, 0 outside of it
+    if window is None:
+        return 0.0
+    start, end = window
+    minute = now.hour * 60 + now.minute + now.second / 60
+    inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+    return ((end - minute) % (24 * 60)) * 60 if inside else 0.0
+
+
+class RefreshScheduler:
+    # Incremental refresh of every installed shop once per REFRESH_INTERVAL, within REFRESH_WINDOW. One worker process
+    #   leads (a lease in the shared state). Each tick it ranks the due shops and starts as many as spread the rest
+    #   evenly over what is left of the window, at most REFRESH_MAX_IN_FLIGHT at once. Bulk operations and downloads
+    #   are further capped over every worker, one operation per shop (see BulkSlots).
+
+    def __init__(self, window: str = REFRESH_WINDOW, interval: float = REFRESH_INTERVAL, max_in_flight: int = REFRESH_MAX_IN_FLIGHT,
+                 tick: float = REFRESH_TICK, state=SHARED_STATE):
+        self.window_spec = window
+        self.window = parse_window(window)
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self.tick = tick
+        self.state = state
+        self._id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {'leader': False, 'due': 0, 'started': 0, 'finished': 0, 'failed': 0}
+        self._shops = self._submit = self._busy = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def register(self, shops, submit, busy=lambda shop: False):
+        # shops() -> installed shops, submit(shop) -> the refresh's jobs, busy(shop) -> whether the shop syncs already
+        self._shops, self._submit, self._busy = shops, submit, busy
+
+    def start(self):
+        if self.window is None or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="refresh-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Refresh scheduler tick failed")
+
+    def _lead(self, now: float) -> bool:
+        # the lease outlives a few ticks, so it moves to another worker only when this one stopped ticking
+        def claim(current):
+            if current and current['holder'] != self._id and current['expires_at'] > now:
+                return current
+            return {'holder': self._id, 'expires_at': now + 3 * self.tick}
+
+        return self.state.update("refresh_scheduler", "leader", claim)['holder'] == self._id
+
+    def staleness(self, shop, now: datetime) -> tuple:
+        # (seconds since the least recently synced dataset, rows), infinite for a shop missing a dataset
+        metas = SNAPSHOTS.metas(shop)
+        size = sum(meta['rows'] for meta in metas.values())
+        watermarks = [metas[dataset]['watermark'] for dataset in SYNCED_DATASETS if dataset in metas and metas[dataset]['watermark']]
+        if len(watermarks) < len(SYNCED_DATASETS):
+            return math.inf, size
+        oldest = min(datetime.fromisoformat(watermark) for watermark in watermarks)
+        return (now - oldest).total_seconds(), size
+
+    def due(self, now: datetime) -> list:
+        # [(shop, staleness, rows)], the shops overdue by the most intervals first and the biggest of them first, so the
+        #   longest refreshes start early instead of spilling past the window
+        with self._lock:
+            in_flight = set(self._in_flight)
+        due = []
+        for shop in self._shops():
+            if shop in in_flight or self._busy(shop) or self.state.get("refreshes", shop):
+                continue
+            staleness, rows = self.staleness(shop, now)
+            if staleness >= self.interval:
+                due.append((shop, staleness, rows))
+        due.sort(key=lambda item: (-(item[1] // self.interval if item[1] != math.inf else math.inf), -item[2]))
+        return due
+
+    def run_once(self, now: datetime = None):
+        now = now or datetime.now(timezone.utc)
+        self._reap()
+        leader = self._lead(time.time())
+        remaining = window_remaining(self.window, now)
+        with self._lock:
+            self._stats['leader'] = leader
+            free = self.max_in_flight - len(self._in_flight)
+        if not leader or remaining <= 0 or free <= 0:
+            return
+
+        due = self.due(now)
+        # paced so the due shops are spread over the rest of the window instead of all starting at its opening
+        paced = math.ceil(len(due) * self.tick / max(remaining, self.tick))
+        with self._lock:
+            self._stats['due'] = len(due)
+        # for the gauges of whichever worker is scraped, see #shared_stats
+        self.state.set("refresh_scheduler", "due", len(due), ttl=3 * self.tick)
+        for shop, staleness, rows in due[:min(free, paced)]:
+            self._start(shop, staleness, rows)
+
+    def _start(self, shop, staleness, rows):
+        # marked in the shared state so that a new leader does not start it again
+        self.state.set("refreshes", shop, {'holder': self._id, 'started_at': time.time()}, ttl=self.interval)
+        try:
+            jobs = self._submit(shop)
+        except Exception:
+            logging.exception(f"Scheduled refresh of shop {shop} could not start")
+            self.state.set("refreshes", shop, {'failed_at': time.time()}, ttl=REFRESH_RETRY_DELAY)
+            return
+        logging.info(f"Scheduled refresh of shop {shop} started ({'never synced' if staleness == math.inf else f'{staleness / 3600:.1f}h old'}, {rows} rows)")
+        with self._lock:
+            self._in_flight[shop] = (jobs, time.monotonic())
+            self._stats['started'] += 1
+
+    def _reap(self):
+        with self._lock:
+            finished = [(shop, jobs, started) for shop, (jobs, started) in self._in_flight.items() if all(job.finished_at for job in jobs)]
+            for shop, _, _ in finished:
+                del self._in_flight[shop]
+        for shop, jobs, started in finished:
+            failed = [job.name for job in jobs if job.status == JOB_FAILED]
+            if failed:
+                logging.error(f"Scheduled refresh of shop {shop} failed for {', '.join(failed)}, next attempt in {REFRESH_RETRY_DELAY:.0f}s")
+                self.state.set("refreshes", shop, {'failed_at': time.time(), 'failed': failed}, ttl=REFRESH_RETRY_DELAY)
+            else:
+                logging.info(f"Scheduled refresh of shop {shop} finished in {time.monotonic() - started:.0f}s")
+                self.state.pop("refreshes", shop)
+            with self._lock:
+                self._stats['failed' if failed else 'finished'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, in_flight=sorted(self._in_flight), window=self.window_spec or None)
+
+    def shared_stats(self) -> dict:
+        # over every worker: shops due at the leader's last tick, scheduled refreshes running
+        running = [self.state.get("refreshes", shop) for shop in self.state.keys("refreshes")]
+        return {'due': self.state.get("refresh_scheduler", "due", 0),
+                'in_flight': sum(1 for refresh in running if refresh and 'holder' in refresh)}
+
+    def drop(self, shop):
+        self.state.pop("refreshes", shop)
+
+
+SCHEDULER = RefreshScheduler()
@@ -0,0 +1,195 @@
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+from dotenv import load_dotenv
+
+from data_store import STORE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Bodies smaller than this are sent as they are
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', 1024))
+COMPRESSIBLE_MIMETYPES = ('text/html', 'application/json', 'text/plain', 'text/css', 'application/javascript')
+
+# Query parameters that change on every request without changing the result: the DataTables draw counter
+#   (echoed back, see #table_data in server.py) and jQuery's cache buster
+VOLATILE_ARGS = ('draw', '_')
+
+
+def accepted_encoding() -> str:
+    accepted = request.headers.get('Accept-Encoding', '')
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CachedResponse:
+    def __init__(self, version, etag, body: bytes, mimetype):
+        self.version = version
+        self.etag = etag
+        self.mimetype = mimetype
+        self.bodies = {None: body}
+
+    @property
+    def size(self) -> int:
+        return sum(len(body) for body in self.bodies.values())
+
+
+class ResponseCache:
+    # LRU of rendered responses and computed results under a byte budget. Entries carry the version of the datasets
+    #   they were built from and are rebuilt once a sync or webhook delta moves that version on.
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0].version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def resize(self, key, value):
+        # a CachedResponse grew by a compressed body
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is value:
+                self._size += value.size - entry[1]
+                self._entries[key] = (value, value.size)
+
+    def drop(self, shop):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == shop]:
+                self._size -= self._entries.pop(key)[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+RESPONSES = ResponseCache()
+
+
+def request_key(shop) -> tuple:
+    args = tuple(sorted((key, value) for key, value in request.args.items(multi=True) if key not in VOLATILE_ARGS))
+    return (request.path, shop, args)
+
+
+def dataset_version(shop, datasets) -> tuple:
+    return STORE.shop(shop).version(*datasets) if datasets else ()
+
+
+def _encoded_response(key, entry: CachedResponse):
+    encoding = accepted_encoding() if len(entry.bodies[None]) >= RESPONSE_COMPRESS_MIN_BYTES else None
+    if encoding not in entry.bodies:
+        entry.bodies[encoding] = compress(entry.bodies[None], encoding)
+        RESPONSES.resize(key, entry)
+
+    response = make_response(entry.bodies[encoding])
+    response.mimetype = entry.mimetype
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(entry.etag)
+    # revalidate on every load, unchanged pages are answered with an empty 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached(*datasets, vary=None):
+    # Caches a GET view per shop, path and query parameters until one of `datasets` changes (or the value returned by
+    #   `vary`, e.g. the day for views relative to today). Answers If-None-Match with 304 and sends the body gzip or
+    #   brotli compressed when the client accepts it.
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            shop = request.args.get('shop')
+            key = request_key(shop)
+            version = dataset_version(shop, datasets)
+            if vary is not None:
+                version += (vary(),)
+            entry = RESPONSES.get(key, version)
+
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                # from the body, not the version: versions are counted per worker process (and from scratch after a
+                #   restart), the same version can stand for different data in another one
+                body = response.get_data()
+                entry = CachedResponse(version, hashlib.sha1(body).hexdigest(), body, response.mimetype)
+                RESPONSES.put(key, entry, entry.size)
+
+            if entry.etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(entry.etag)
+                return response
+            return _encoded_response(key, entry)
+        return wrapper
+    return decorator
+
+
+def memoize(key, version, fn, size_of=len):
+    # Result cache for views whose response differs per request (e.g. the echoed DataTables draw counter)
+    #   while the expensive part does not
+    entry = RESPONSES.get(key, version)
+    if entry is None:
+        value = fn()
+        entry = CachedResponse(version, None, value, None)
+        RESPONSES.put(key, entry, size_of(value))
+    return entry.bodies[None]
+
+
+def compress_response(response):
+    # after_request hook for responses not built by #cached
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    body = response.get_data()
+    encoding = accepted_encoding()
+    if encoding and len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
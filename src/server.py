@@ -1,50 +1,82 @@
 import uuid
 import os
+from datetime import datetime
 import json
 import logging
 
-from flask import Flask, redirect, request, render_template, jsonify
-import shopify
+from flask import Flask, Response, redirect, request, render_template, jsonify
 import helpers
-from shopify_client import ShopifyStoreClient
+import lazy
+from shopify_client import ShopifyStoreClient, WEBHOOK_REGISTRY, preload_queries
+from jobs import JobManager
+from client_pool import TOKENS, NONCES, CLIENTS, UnknownShop
+from graphql_cost import COST_BUDGETS
+from bulk_cache import BULK_CACHE
+from flow_dispatch import FLOWS, run_forecast_then_optimization
+from bulk_operations import DISPATCHER, BULK_CHECKPOINTS, BULK_SLOTS
+from refresh_scheduler import SCHEDULER
+from webhook_queue import WEBHOOKS
+from dataset_handles import HANDLES
+from snapshots import SNAPSHOTS
+from response_cache import RESPONSES, cached, memoize, request_key, dataset_version, compress_response
+import metrics
+from metrics import BULK_STAGE_SECONDS, BULK_WEBHOOK_DELAY, LOW_STOCK_ALERTS_TOTAL, Gauge
+from data_store import STORE, DATASETS
+from datatables import DataTablesRequest, query_table
+from inventory import LOW_STOCK, RISK_DATASETS, low_stock_rows, level_row_from_webhook
+from sync import WATERMARKS, DELTA_TOPICS, ROOT_FIELDS, utc_now, updated_at_search, order_rows_from_webhook, product_rows_from_webhook
 
 from dotenv import load_dotenv
-from pprint import pprint
 
 load_dotenv()
 
 SHOPIFY_API_KEY = os.environ.get('SHOPIFY_API_KEY')
 APP_NAME = os.environ.get('APP_NAME')
+# Set by gunicorn.conf.py: the app is imported once in the master and forked into the workers
+PRELOAD_APP = os.environ.get('PRELOAD_APP', '0') == '1'
 
 WEBHOOK_APP_UNINSTALL_URL = os.environ.get('WEBHOOK_APP_UNINSTALL_URL')
 WEBHOOK_QUERY_FINISHED_URL = os.environ.get('WEBHOOK_QUERY_FINISHED_URL')
+WEBHOOK_DATA_UPDATED_URL = os.environ.get('WEBHOOK_DATA_UPDATED_URL')
 print('webhook 1', WEBHOOK_APP_UNINSTALL_URL)
 print('webhook 2', WEBHOOK_QUERY_FINISHED_URL)
 
 
 app = Flask(__name__)
 
+# numpy, loaded with the first /inventory_metrics request
+demand = lazy.lazy_module('demand')
+
 
-ACCESS_TOKEN = None
-NONCE = None
 ACCESS_MODE = []  # Defaults to offline access mode if left blank or omitted. https://shopify.dev/apps/auth/oauth/access-modes
 SCOPES = ['write_script_tags', "read_products", "read_orders", "read_all_orders", "read_customers", "read_inventory"] #]  # https://shopify.dev/docs/admin-api/access-scopes
 
-
-class DataManager:
-    data = {}
-
-    @staticmethod
-    def get_data(shop, name):
-        return DataManager.data[shop][name]
-
-    @staticmethod
-    def set_data(shop, name, value):
-        if not shop in DataManager.data:
-            DataManager.data[shop] = {}
-        DataManager.data[shop][name] = value
-
-
+JOBS = JobManager()
+
+# read at scrape time. The webhook queue, refresh and bulk slot gauges cover every worker, the response cache and
+#   import time ones the worker answering the scrape
+Gauge('webhook_queue_depth', "Webhooks received and not handled yet", fn=lambda: {(): WEBHOOKS.stats()['depth']})
+Gauge('webhook_queue_lag_seconds', "Age of the oldest webhook not handled yet", fn=lambda: {(): WEBHOOKS.stats()['lag']})
+Gauge('response_cache_bytes', "Size of the cached dashboard responses", fn=lambda: {(): RESPONSES.stats()['bytes']})
+Gauge('response_cache_hits', "Dashboard requests answered from the response cache", fn=lambda: {(): RESPONSES.stats()['hits']})
+Gauge('response_cache_misses', "Dashboard requests rendered", fn=lambda: {(): RESPONSES.stats()['misses']})
+Gauge('refresh_shops_due', "Shops due for a scheduled refresh at the last tick", fn=lambda: {(): SCHEDULER.shared_stats()['due']})
+Gauge('refresh_in_flight', "Scheduled shop refreshes running", fn=lambda: {(): SCHEDULER.shared_stats()['in_flight']})
+Gauge('bulk_slots_in_use', "Bulk operation and download slots taken over every worker", ('kind',),
+      fn=lambda: {(kind,): count for kind, count in BULK_SLOTS.in_use().items()})
+Gauge('module_import_seconds', "Import time of modules loaded on first use", ('module',),
+      fn=lambda: {(name,): seconds for name, seconds in lazy.IMPORT_SECONDS.items()})
+
+# compress what #cached did not
+app.after_request(compress_response)
+
+
+@app.before_request
+def refresh_shop_data():
+    # catch up with syncs and webhook deltas applied by the other worker processes, see dataset_handles.py
+    shop = request.args.get('shop')
+    if shop and request.method == 'GET':
+        HANDLES.refresh(shop)
 
 
 @app.route('/app_launched', methods=['GET'])
@@ -52,15 +84,11 @@ class DataManager:
 def app_launched():
     shop = request.args.get('shop')
     embedded = request.args.get('embedded', '0')
-    global ACCESS_TOKEN, NONCE
 
-    if ACCESS_TOKEN:
+    if TOKENS.get(shop):
 
-        ###
-        shopify_client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-        webhook_app_uninstall_url = f"{WEBHOOK_APP_UNINSTALL_URL}?shop={shop}"
-        shopify_client.create_webook(address=webhook_app_uninstall_url, topic="app/uninstalled", overwrite=True)
-        ###
+        # no API calls unless the subscriptions changed since they were last reconciled
+        CLIENTS.get(shop).ensure_webhooks(desired_webhooks(shop))
 
         if embedded == '1':
             return render_template('welcome.html', shop=shop, api_key=SHOPIFY_API_KEY)
@@ -70,8 +98,9 @@ def app_launched():
     
     # The NONCE is a single-use random value we send to Shopify so we know the next call from Shopify is valid (see #app_installed)
     #   https://en.wikipedia.org/wiki/Cryptographic_nonce
-    NONCE = uuid.uuid4().hex
-    redirect_url = helpers.generate_install_redirect_url(shop=shop, scopes=SCOPES, nonce=NONCE, access_mode=ACCESS_MODE)
+    nonce = uuid.uuid4().hex
+    NONCES.set(shop, nonce)
+    redirect_url = helpers.generate_install_redirect_url(shop=shop, scopes=SCOPES, nonce=nonce, access_mode=ACCESS_MODE)
     return redirect(redirect_url, code=302)
 
 
@@ -79,125 +108,433 @@ def app_launched():
 @helpers.verify_web_call
 def app_installed():
     state = request.args.get('state')
-    global NONCE, ACCESS_TOKEN
+    shop = request.args.get('shop')
 
     # Shopify passes our NONCE, created in #app_launched, as the `state` parameter, we need to ensure it matches!
-    if state != NONCE:
+    # Popping it gets rid of it in the same step (a nonce, by definition, should only be used once)
+    nonce = NONCES.pop(shop)
+    if not nonce or state != nonce:
         return "Invalid `state` received", 400
-    NONCE = None
 
-    # Ok, NONCE matches, we can get rid of it now (a nonce, by definition, should only be used once)
     # Using the `code` received from Shopify we can now generate an access token that is specific to the specified `shop` with the
     #   ACCESS_MODE and SCOPES we asked for in #app_installed
-    shop = request.args.get('shop')
     code = request.args.get('code')
-    ACCESS_TOKEN = ShopifyStoreClient.authenticate(shop=shop, code=code)
-
-    # We have an access token! Now let's register a webhook so Shopify will notify us if/when the app gets uninstalled
-    # NOTE This webhook will call the #app_uninstalled function defined below
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-
-    webhook_app_uninstall_url = f"{WEBHOOK_APP_UNINSTALL_URL}?shop={shop}"
-    client.create_webook(address=webhook_app_uninstall_url, topic="app/uninstalled", overwrite=True)
-
-    webhook_query_finished_url = f"{WEBHOOK_QUERY_FINISHED_URL}?shop={shop}"
-    client.create_webook(address=webhook_query_finished_url, topic="bulk_operations/finish", overwrite=True)
-
-
-    client.fetch_variants()
-    #DataManager.set_data(shop, "variants", variants)
+    access_token = ShopifyStoreClient.authenticate(shop=shop, code=code)
+    if not access_token:
+        return "Could not authenticate shop", 400
+    TOKENS.set(shop, access_token)
 
-    client.fetch_orders()
-    #DataManager.set_data(shop, "orders", orders)
-    #DataManager.set_data(shop, "line_items", line_items)
+    # We have an access token! Now let's register the webhooks we need, see #desired_webhooks
+    client = CLIENTS.get(shop)
+    client.ensure_webhooks(desired_webhooks(shop), force=True)
 
-    client.fetch_products()
-    #DataManager.set_data(shop, "products", products)
+    # The bulk fetches block until Shopify finishes each bulk operation, so they run on the job pool
+    #   and the merchant is redirected right away. Progress is available from #jobs_status
+    submit_initial_sync(shop)
 
     redirect_url = helpers.generate_app_redirect_url(shop=shop)
     return redirect(redirect_url, code=302)
 
 
 
+def desired_webhooks(shop) -> list:
+    # NOTE app/uninstalled calls the #app_uninstalled function defined below, bulk_operations/finish #query_finished,
+    #   and the change webhooks carry deltas between syncs to #data_updated
+    webhooks = [
+        ("app/uninstalled", f"{WEBHOOK_APP_UNINSTALL_URL}?shop={shop}"),
+        ("bulk_operations/finish", f"{WEBHOOK_QUERY_FINISHED_URL}?shop={shop}"),
+    ]
+    webhooks += [(topic, f"{WEBHOOK_DATA_UPDATED_URL}?shop={shop}") for topic in DELTA_TOPICS]
+    return webhooks
+
+
+def submit_initial_sync(shop):
+    return submit_sync(shop, incremental=False)
+
+
+def submit_sync(shop, incremental):
+    # a sync already queued or running for the shop covers this one
+    if JOBS.active(shop):
+        return [job for job in JOBS.get_jobs(shop) if not job.finished_at]
+    steps = [(name, lambda name=name: sync_dataset(shop, name, incremental)) for name in ("variants", "orders", "products", "inventory_levels")]
+    return JOBS.submit_pipeline(shop, steps)
+
+
+def sync_dataset(shop, name, incremental=False):
+    # Runs the bulk fetch (which also hands the file to the Prefect ingestion flow) and loads the result in the shop's store.
+    #   Incremental syncs only export what changed since the last watermark and merge it into the loaded dataset.
+    HANDLES.refresh(shop)
+    shop_data = STORE.shop(shop)
+    # after a restart the watermark comes with the dataset's snapshot
+    watermark = WATERMARKS.get(shop, name) or SNAPSHOTS.watermark(shop, name)
+    # inventory levels have no updatedAt to search on, between full exports webhooks keep them current
+    incremental = incremental and name != "inventory_levels" and watermark is not None and shop_data.has(name) \
+        and not HANDLES.needs_full_load(shop, name)
+    search = updated_at_search(watermark) if incremental else None
+
+    started_at = utc_now()
+    client = CLIENTS.get(shop)
+    fetch = {"variants": client.fetch_variants, "orders": client.fetch_orders, "products": client.fetch_products,
+             "inventory_levels": client.fetch_inventory_levels}[name]
+    path = fetch(search=search)
+    records = BULK_CACHE.read_records_mmap(path) if path else []
+
+    # table -> rows an incremental sync merged, upserted in the snapshot instead of saving it whole
+    merged = None
+    with BULK_STAGE_SECONDS.time(shop=shop, resource=ROOT_FIELDS[name], stage="load"):
+        if name == "orders" and incremental:
+            op = "merge_orders"
+            merged = shop_data.merge_orders(records)
+        elif name == "orders":
+            op = "load_orders"
+            shop_data.load_orders(records)
+        elif name == "inventory_levels":
+            op = "load_inventory_levels"
+            shop_data.load_inventory_levels(records)
+        elif incremental:
+            op = "merge_records"
+            merged = shop_data.merge_records(name, records)
+        else:
+            op = "load"
+            shop_data.load(name, records)
+    if path or not incremental:
+        position = HANDLES.record(shop, name, op, path)
+        manifest = BULK_CACHE.manifest(path) if path else None
+        operation_id = manifest.get('operation_id') if manifest else None
+        with BULK_STAGE_SECONDS.time(shop=shop, resource=ROOT_FIELDS[name], stage="snapshot"):
+            if merged is None or not SNAPSHOTS.upsert(shop, name, merged, position=position, operation_id=operation_id,
+                                                      watermark=started_at):
+                SNAPSHOTS.save(shop, name, shop_data, operation_id=operation_id, watermark=started_at, position=position)
+    else:
+        SNAPSHOTS.set_watermark(shop, name, started_at)
+    WATERMARKS.set(shop, name, started_at)
+
+
+def merge_delta(shop, dataset, table, rows):
+    # webhook delta, applied here and recorded for the other worker processes and the snapshot
+    STORE.shop(shop).merge(table, rows)
+    position = HANDLES.record(shop, dataset, "merge", table, rows)
+    SNAPSHOTS.upsert(shop, dataset, {table: rows}, position=position)
+
+
+def apply_inventory_update(shop, inventory_item_id):
+    # inventory_levels/update is per location, the variant's total is read back from Shopify
+    client = CLIENTS.get(shop)
+    variant = client.fetch_inventory_item_variant(inventory_item_id)
+    if variant:
+        rows = [{'variant_id': int(variant['id'].rsplit('/', 1)[1]), 'inventory_quantity': variant['inventoryQuantity']}]
+        HANDLES.refresh(shop)
+        shop_data = STORE.shop(shop)
+        version_before = shop_data.version(*RISK_DATASETS)
+        merge_delta(shop, "variants", "variants", rows)
+        check_low_stock(shop, version_before, rows[0]['variant_id'], rows[0]['inventory_quantity'])
+
+
+def apply_inventory_level(shop, payload):
+    # inventory_levels/update with the per location levels loaded: the variant's total is the sum of its levels, no
+    #   round trip to Shopify. Falls back to #apply_inventory_update until they are, on the webhook queue's worker
+    #   like the rest of the shop's events rather than behind its sync on the job pool.
+    shop_data = STORE.shop(shop)
+    row = level_row_from_webhook(payload)
+    variant = shop_data.table('variants').get('inventory_item_id', row['inventory_item_id']) if shop_data.has('variants') else None
+    if variant is None or row['available'] is None or not shop_data.has('inventory_levels'):
+        apply_inventory_update(shop, payload['inventory_item_id'])
+        return
+    version_before = shop_data.version(*RISK_DATASETS)
+    merge_delta(shop, "inventory_levels", "inventory_levels", [dict(row, variant_id=variant['variant_id'])])
+    available = sum(level['available'] for level in shop_data.table('inventory_levels').find('inventory_item_id', row['inventory_item_id']))
+    merge_delta(shop, "variants", "variants", [{'variant_id': variant['variant_id'], 'inventory_quantity': available}])
+    check_low_stock(shop, version_before, variant['variant_id'], available)
+
+
+def check_low_stock(shop, version_before, variant_id, available):
+    if LOW_STOCK.apply(STORE.shop(shop), version_before, variant_id, available):
+        LOW_STOCK_ALERTS_TOTAL.inc(shop=shop)
+        logging.warning(f"Variant {variant_id} of shop {shop} is at its reorder point ({available} available)")
+
+
+# Webhook endpoints only verify the call and record it in the durable queue, Shopify gets its answer right away.
+#   The handlers below run on the queue's worker threads, once per X-Shopify-Webhook-Id (see webhook_queue.py)
+
+def enqueue_webhook():
+    shop = request.args.get('shop') or request.headers.get('X-Shopify-Shop-Domain')
+    WEBHOOKS.enqueue(request.headers.get('X-Shopify-Webhook-Id'), shop, request.headers.get('X-Shopify-Topic'), request.get_data())
+    return "OK", 200
+
+
 @app.route('/app_uninstalled', methods=['POST'])
 @helpers.verify_webhook_call
 def app_uninstalled():
     # https://shopify.dev/docs/admin-api/rest/reference/events/webhook?api[version]=2020-04
-    # Someone uninstalled your app, clean up anything you need to
-    # NOTE the shop ACCESS_TOKEN is now void!
-    global ACCESS_TOKEN
-    ACCESS_TOKEN = None
-
-    webhook_topic = request.headers.get('X-Shopify-Topic')
-    webhook_payload = request.get_json()
-    logging.error(f"webhook call received {webhook_topic}:\n{json.dumps(webhook_payload, indent=4)}")
-
-    return "OK"
+    return enqueue_webhook()
 
 
 @app.route('/data_removal_request', methods=['POST'])
 @helpers.verify_webhook_call
 def data_removal_request():
     # https://shopify.dev/tutorials/add-gdpr-webhooks-to-your-app
-    # Clear all personal information you may have stored about the specified shop
-    return "OK"
+    return enqueue_webhook()
 
 @app.route('/query_finished', methods=['POST'])
+@helpers.verify_webhook_call
 def query_finished():
-    print("--- query_finished ---")
+    return enqueue_webhook()
+
+@app.route('/data_updated', methods=['POST'])
+@helpers.verify_webhook_call
+def data_updated():
+    return enqueue_webhook()
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    # Prometheus scrape endpoint, see metrics.py
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/webhook_queue', methods=['GET'])
+def webhook_queue():
+    # depth: events received but not handled yet, lag: age of the oldest of them in seconds
+    return jsonify(WEBHOOKS.stats())
+
+
+def handle_app_uninstalled(shop, webhook_topic, webhook_payload):
+    # Someone uninstalled your app, clean up anything you need to
+    # NOTE the shop access token is now void!
+    TOKENS.pop(shop)
+    CLIENTS.evict(shop)
+    WEBHOOK_REGISTRY.drop(shop)
+    logging.error(f"webhook call received {webhook_topic}:\n{json.dumps(webhook_payload, indent=4)}")
+
+
+def handle_data_removal_request(shop, webhook_topic, webhook_payload):
+    # Clear all personal information you may have stored about the specified shop
+    if webhook_topic == "shop/redact":
+        STORE.drop(shop)
+        HANDLES.drop(shop)
+        RESPONSES.drop(shop)
+        LOW_STOCK.drop(shop)
+        BULK_CACHE.drop(shop)
+        BULK_CHECKPOINTS.drop(shop)
+        BULK_SLOTS.drop(shop)
+        SCHEDULER.drop(shop)
+        WATERMARKS.drop(shop)
+        JOBS.clear_jobs(shop)
+    logging.info(f"Data removal request {webhook_topic} for shop {shop} handled")
+
+
+def handle_query_finished(shop, webhook_topic, webhook_payload):
+    # bulk_operations/finish payload: {"admin_graphql_api_id": "gid://shopify/BulkOperation/...", "status": "completed", ...}
+    operation_id = webhook_payload.get('admin_graphql_api_id')
+    if not operation_id:
+        logging.error(f"query_finished webhook without operation id for shop {shop}: {webhook_payload}")
+        return
+    DISPATCHER.notify(shop, operation_id, webhook_payload)
+    if webhook_payload.get('completed_at'):
+        completed_at = datetime.fromisoformat(webhook_payload['completed_at'].replace('Z', '+00:00'))
+        BULK_WEBHOOK_DELAY.observe((utc_now() - completed_at).total_seconds(), shop=shop)
+
+
+def handle_data_updated(shop, webhook_topic, webhook_payload):
+    HANDLES.refresh(shop)
+
+    if webhook_topic == "orders/updated":
+        order, line_items = order_rows_from_webhook(webhook_payload)
+        merge_delta(shop, "orders", "orders", [order])
+        merge_delta(shop, "orders", "line_items", line_items)
+    elif webhook_topic == "products/update":
+        product, variants = product_rows_from_webhook(webhook_payload)
+        merge_delta(shop, "products", "products", [product])
+        merge_delta(shop, "variants", "variants", variants)
+    elif webhook_topic == "inventory_levels/update":
+        apply_inventory_level(shop, webhook_payload)
+    else:
+        logging.error(f"Unexpected webhook topic on data_updated: {webhook_topic}")
+
+
+WEBHOOKS.register("app/uninstalled", handle_app_uninstalled)
+WEBHOOKS.register("bulk_operations/finish", handle_query_finished)
+for topic in ("shop/redact", "customers/redact", "customers/data_request"):
+    WEBHOOKS.register(topic, handle_data_removal_request)
+for topic in DELTA_TOPICS:
+    WEBHOOKS.register(topic, handle_data_updated)
+
+SCHEDULER.register(TOKENS.shops, lambda shop: submit_sync(shop, incremental=True), busy=JOBS.active)
+
+
+def preload():
+    # Loads what workers otherwise load on first use, once, so the forked workers share it
+    lazy.preload()
+    preload_queries()
+
+
+def start_workers():
+    # Background threads do not survive fork(), under a preloading server this runs in each worker (post_fork)
+    WEBHOOKS.start()
+    SCHEDULER.start()
+
+
+if PRELOAD_APP:
+    preload()
+else:
+    start_workers()
+
+@app.route('/refresh', methods=['GET'])
+@helpers.verify_web_call
+def refresh():
+    # Incremental refresh of the shop's datasets, falls back to a full export for datasets never synced
+    shop = request.args.get('shop')
+    if not TOKENS.get(shop):
+        return "Unknown shop", 404
+    submit_sync(shop, incremental=True)
+    return jsonify(JOBS.status(shop))
+
+@app.route('/refresh_schedule', methods=['GET'])
+def refresh_schedule():
+    # Scheduled refreshes (see refresh_scheduler.py) and the bulk slots taken over every worker
+    return jsonify(dict(SCHEDULER.stats(), bulk_slots=BULK_SLOTS.in_use()))
+
+@app.route('/reingest', methods=['GET'])
+@helpers.verify_web_call
+def reingest():
+    shop = request.args.get('shop')
+    name = request.args.get('dataset')
+    if name not in ("products", "variants", "orders"):
+        return "Unknown dataset", 404
+    try:
+        client = CLIENTS.get(shop)
+    except UnknownShop:
+        return "Unknown shop", 404
+    flow_run = client.reingest_cached(name)
+    if not flow_run:
+        return "No cached export", 404
+    return jsonify({'shop': shop, 'dataset': name, 'flow_run_id': str(flow_run.id)})
+
+@app.route('/run_forecasts', methods=['GET'])
+@helpers.verify_web_call
+def run_forecasts():
+    # Forecast then optimize every variant of the shop in chunked flow runs; submission waits on the per-shop
+    #   in-flight cap, so it runs on a thread of its own, away from the shop's syncs. Progress is available from #flow_batches
+    shop = request.args.get('shop')
+    shop_data = STORE.shop(shop)
+    if not shop_data.has("variants"):
+        return "Datasets not loaded yet", 404
+    with shop_data.lock:
+        variants = shop_data.table("variants")
+        pairs = list(zip(variants.columns['product_id'], variants.columns['variant_id']))
+    started = run_forecast_then_optimization(shop, pairs)
+    return jsonify({'shop': shop, 'started': started, 'running': FLOWS.chain_running(shop)})
+
+@app.route('/inventory_metrics', methods=['GET'])
+@cached("variants", "orders", "line_items", vary=lambda: utc_now().date())
+def inventory_metrics_view():
+    # Sales velocities, days of cover and reorder points of every variant, computed in process from the loaded datasets
+    shop = request.args.get('shop')
+    shop_data = STORE.shop(shop)
+    if not all(shop_data.has(name) for name in ("variants", "orders", "line_items")):
+        return "Datasets not loaded yet", 404
+    lead_time = request.args.get('lead_time', demand.DEMAND_LEAD_TIME_DAYS, type=float)
+    return jsonify(demand.metrics_rows(demand.inventory_metrics(shop_data, lead_time=lead_time)))
+
+@app.route('/low_stock', methods=['GET'])
+@cached("variants", "orders", "line_items", "inventory_levels", vary=lambda: utc_now().date())
+def low_stock_view():
+    # The variants closest to running out (see inventory.py for the ordering) with their stock per location, and the
+    #   latest reorder alerts raised by stock updates
+    shop = request.args.get('shop')
+    shop_data = STORE.shop(shop)
+    if not shop_data.has('variants'):
+        return "Datasets not loaded yet", 404
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'shop': shop, 'ordering': LOW_STOCK.ordering, 'variants': low_stock_rows(shop_data, limit),
+                    'alerts': LOW_STOCK.alerts(shop)})
+
+@app.route('/flow_batches', methods=['GET'])
+def flow_batches():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    client.data_notification_push()
-    return "Webhook received", 200
+    return jsonify({'shop': shop, 'in_flight': FLOWS.in_flight(shop), 'batches': [batch.status() for batch in FLOWS.batches(shop)]})
+
+@app.route('/jobs_status', methods=['GET'])
+def jobs_status():
+    shop = request.args.get('shop')
+    return jsonify(JOBS.status(shop))
+
+@app.route('/graphql_budget', methods=['GET'])
+def graphql_budget():
+    shop = request.args.get('shop')
+    return jsonify(COST_BUDGETS.for_shop(shop).stats())
 
 @app.route('/home', methods=['GET'])
+@cached()
 def home():
     shop = request.args.get('shop')
     return render_template('home.html', products=[], shop=shop, api_key=SHOPIFY_API_KEY)
 
 @app.route('/products', methods=['GET'])
+@cached()
 def products():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    products = DataManager.get_data(shop, "products")
-    pprint(products[0])
-    return render_template('products.html', products=products, shop=shop, api_key=SHOPIFY_API_KEY)
+    return render_template('products.html', shop=shop, api_key=SHOPIFY_API_KEY)
 
 @app.route('/products2', methods=['GET'])
+@cached()
 def products2():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-
-    products = DataManager.get_data(shop, "products")
-    variants = DataManager.get_data(shop, "variants")
-
-    grouped_variants = {}
-    for variant in variants:
-        grouped_variants[ variant['product_id'] ] = variant
+    # variants are fetched per product when a row is expanded, see #product_variants
+    return render_template('products2.html', shop=shop, api_key=SHOPIFY_API_KEY)
 
-    return render_template('products2.html', products=products, grouped_variants=grouped_variants, shop=shop, api_key=SHOPIFY_API_KEY)
+@app.route('/product_variants', methods=['GET'])
+@cached("products", "variants")
+def product_variants():
+    shop = request.args.get('shop')
+    product_id = request.args.get('product_id', type=int)
+    return jsonify(STORE.shop(shop).variants_of(product_id))
 
 @app.route('/variants', methods=['GET'])
+@cached()
 def variants():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    variants = DataManager.get_data(shop, "variants")
-    pprint(variants[0])
-    return render_template('variants.html', variants=variants, shop=shop, api_key=SHOPIFY_API_KEY)
+    return render_template('variants.html', shop=shop, api_key=SHOPIFY_API_KEY)
 
 @app.route('/orders', methods=['GET'])
+@cached()
 def orders():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    orders = DataManager.get_data(shop, "orders")
-    return render_template('orders.html', orders=orders, shop=shop, api_key=SHOPIFY_API_KEY)
+    return render_template('orders.html', shop=shop, api_key=SHOPIFY_API_KEY)
 
 @app.route('/line_items', methods=['GET'])
+@cached()
 def line_items():
     shop = request.args.get('shop')
-    client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    line_items = DataManager.get_data(shop, "line_items")
-    return render_template('line_items.html', line_items=line_items, shop=shop, api_key=SHOPIFY_API_KEY)
+    return render_template('line_items.html', shop=shop, api_key=SHOPIFY_API_KEY)
+
+@app.route('/data/<name>', methods=['GET'])
+def table_data(name):
+    # DataTables server-side processing endpoint backing the views above, only the rows on screen are serialized
+    shop = request.args.get('shop')
+    if name not in DATASETS:
+        return "Unknown dataset", 404
+
+    shop_data = STORE.shop(shop)
+    if not shop_data.has(name):
+        return jsonify({'draw': request.args.get('draw', 0, type=int), 'recordsTotal': 0, 'recordsFiltered': 0, 'data': []})
+
+    fn_row = None
+    if name == "variants":
+        def fn_row(row):
+            product = shop_data.product(row['product_id'])
+            row['product_title'] = product['title'] if product else None
+            return row
+
+    # the page is computed once per dataset version, only the echoed draw counter differs between requests
+    datasets = (name, "products") if name == "variants" else (name,)
+    query = DataTablesRequest(request.args)
+
+    def query_page():
+        with shop_data.lock:
+            return query_table(shop_data.table(name), query, fn_row=fn_row)
+
+    page = memoize(request_key(shop), dataset_version(shop, datasets), query_page,
+                   size_of=lambda page: len(json.dumps(page['data'], default=str)))
+    return jsonify(dict(page, draw=query.draw))
 
 
 if __name__ == '__main__':
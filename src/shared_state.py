@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import importlib
+import threading
+from abc import ABC, abstractmethod
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# State every worker process of the app must see: OAuth nonces, access tokens, bulk operation completion signals and
+#   checkpoints, dataset handles (see dataset_handles.py). Backends:
+#     sqlite   a local SQLite file, shared by the processes of one host. Put it on /dev/shm to keep it in memory.
+#     memory   this process only, for a single worker
+#   <module>:<factory>   any other SharedState, e.g. one backed by a network store to share state across hosts
+SHARED_STATE_BACKEND = os.environ.get('SHARED_STATE_BACKEND', 'sqlite')
+SHARED_STATE_PATH = os.environ.get('SHARED_STATE_PATH', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'shared_state.sqlite3'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS state_expires_at ON state (expires_at);
+"""
+
+
+class SharedState(ABC):
+    # Values are anything JSON serializable, `ttl` in seconds (None: kept until popped)
+
+    @abstractmethod
+    def get(self, namespace, key, default=None):
+        pass
+
+    @abstractmethod
+    def set(self, namespace, key, value, ttl: float = None):
+        pass
+
+    @abstractmethod
+    def pop(self, namespace, key, default=None):
+        pass
+
+    @abstractmethod
+    def update(self, namespace, key, fn, ttl: float = None):
+        # Atomically replaces the value with fn(current value or None) and returns it
+        pass
+
+    @abstractmethod
+    def keys(self, namespace, prefix: str = "") -> list:
+        pass
+
+    @abstractmethod
+    def items(self, namespace, prefix: str = "", after: str = None) -> list:
+        # (key, value) pairs of the keys starting with prefix and sorted after `after`, in key order
+        pass
+
+    def delete_prefix(self, namespace, prefix: str):
+        for key in self.keys(namespace, prefix):
+            self.pop(namespace, key)
+
+
+class MemoryState(SharedState):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _live(self, namespace, key):
+        entry = self._values.get((namespace, key))
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._values[(namespace, key)]
+            return None
+        return entry
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            return entry[0] if entry else default
+
+    def set(self, namespace, key, value, ttl: float = None):
+        with self._lock:
+            self._values[(namespace, key)] = (value, time.time() + ttl if ttl is not None else None)
+
+    def pop(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            if entry is None:
+                return default
+            del self._values[(namespace, key)]
+            return entry[0]
+
+    def update(self, namespace, key, fn, ttl: float = None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            value = fn(entry[0] if entry else None)
+            self._values[(namespace, key)] = (value, time.time() + ttl if ttl is not None else None)
+            return value
+
+    def keys(self, namespace, prefix: str = "") -> list:
+        with self._lock:
+            return [key for (ns, key) in list(self._values)
+                    if ns == namespace and key.startswith(prefix) and self._live(ns, key)]
+
+    def items(self, namespace, prefix: str = "", after: str = None) -> list:
+        with self._lock:
+            keys = sorted(key for (ns, key) in list(self._values)
+                          if ns == namespace and key.startswith(prefix) and (after is None or key > after) and self._live(ns, key))
+            return [(key, self._values[(namespace, key)][0]) for key in keys]
+
+
+class SQLiteState(SharedState):
+    # WAL mode: readers do not block the writer, every process opens its own connections
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+        # access tokens are kept here
+        os.chmod(path, 0o600)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _read(self, db, namespace, key):
+        row = db.execute("SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                         (namespace, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, db, namespace, key, value, ttl):
+        db.execute("INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                   (namespace, key, json.dumps(value), time.time() + ttl if ttl is not None else None))
+
+    def get(self, namespace, key, default=None):
+        value = self._read(self._connection(), namespace, key)
+        return default if value is None else value
+
+    def set(self, namespace, key, value, ttl: float = None):
+        self._write(self._connection(), namespace, key, value, ttl)
+        if ttl is not None and time.time() - self._last_purge > 10 * 60:
+            self.purge()
+
+    def pop(self, namespace, key, default=None):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            value = self._read(db, namespace, key)
+            db.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return default if value is None else value
+
+    def update(self, namespace, key, fn, ttl: float = None):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            value = fn(self._read(db, namespace, key))
+            self._write(db, namespace, key, value, ttl)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return value
+
+    def keys(self, namespace, prefix: str = "") -> list:
+        rows = self._connection().execute(
+            "SELECT key FROM state WHERE namespace = ? AND substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, len(prefix), prefix, time.time())).fetchall()
+        return [row[0] for row in rows]
+
+    def items(self, namespace, prefix: str = "", after: str = None) -> list:
+        rows = self._connection().execute(
+            "SELECT key, value FROM state WHERE namespace = ? AND substr(key, 1, ?) = ? AND key > ? "
+            "AND (expires_at IS NULL OR expires_at > ?) ORDER BY key",
+            (namespace, len(prefix), prefix, after if after is not None else "", time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def delete_prefix(self, namespace, prefix: str):
+        self._connection().execute("DELETE FROM state WHERE namespace = ? AND substr(key, 1, ?) = ?", (namespace, len(prefix), prefix))
+
+    def purge(self):
+        self._last_purge = time.time()
+        self._connection().execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+
+
+BACKENDS = {
+    'memory': lambda: MemoryState(),
+    'sqlite': lambda: SQLiteState(SHARED_STATE_PATH),
+}
+
+
+def create_state(backend: str = SHARED_STATE_BACKEND) -> SharedState:
+    if ':' in backend:
+        module, factory = backend.split(':', 1)
+        return getattr(importlib.import_module(module), factory)()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown SHARED_STATE_BACKEND {backend}, one of {', '.join(BACKENDS)}")
+    logging.info(f"Shared state backend: {backend}")
+    return BACKENDS[backend]()
+
+
+SHARED_STATE = create_state()
@@ -1,4 +1,5 @@
 import os
+import re
 import json
 from typing import List
 import logging
@@ -8,25 +9,48 @@ import requests
 from requests.exceptions import HTTPError
 
 from dotenv import load_dotenv
-import shopify
 import threading
 import queue
-
-from toolz.dicttoolz import get_in
-from pprint import pprint
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps, lru_cache
 from pathlib import Path
 
-from prefect.deployments import run_deployment
+from lazy import lazy_module
+
+from flow_dispatch import run_ingest_orders, run_ingest_products, run_ingestion_variants
+from bulk_cache import BULK_CACHE
+from sync import with_search, and_search
+from order_query import (build_orders_query, created_at_windows, created_at_search, ORDERS_QUERY_PROFILE,
+                         ORDERS_SHARD_DAYS, ORDERS_SHARD_CONCURRENCY, ORDERS_SHARD_REUSE_AGE)
+from transport import TRANSPORTS
+from graphql_cost import COST_BUDGETS, GRAPHQL_MAX_RETRIES, is_throttled
+from metrics import (BULK_STAGE_SECONDS, BULK_IN_FLIGHT, BULK_OPERATIONS, BULK_OBJECTS, BULK_BYTES, BULK_OBJECTS_PER_SECOND,
+                     BULK_BYTES_PER_SECOND, BULK_RESUMES)
+from bulk_operations import (DISPATCHER, BULK_CHECKPOINTS, BULK_SLOTS, BulkOperationTimeout, BulkOperationFailed, BULK_OPERATION_TIMEOUT,
+                             BULK_POLL_INITIAL_INTERVAL, BULK_POLL_MAX_INTERVAL, BULK_TERMINAL_STATUSES, BULK_RESUME_MAX_ATTEMPTS,
+                             BULK_CHECKPOINT_REUSE_AGE, BULK_CHECKPOINT_MAX_REUSES)
 
 
 # to-do: check that all the prefect deployments exist 
 
-query_dir = os.path.dirname(os.path.realpath(__file__))
-read_query = lambda fname_query: Path( os.path.join(query_dir, fname_query) ).read_text()
-query_fetch_products = read_query("queries/products.graphql")
-query_fetch_variants = read_query("queries/variants.graphql")
-query_fetch_orders = read_query("queries/orders.graphql")
-query_bulkop_status = read_query("queries/bulkop_status.graphql")
+# imported on first use, see lazy.py
+shopify = lazy_module('shopify')
+dicttoolz = lazy_module('toolz.dicttoolz')
+get_in = lambda keys, coll: dicttoolz.get_in(keys, coll)
+
+query_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "queries")
+
+@lru_cache(maxsize=None)
+def read_query(name) -> str:
+    # queries/<name>.graphql, read once on first use
+    return Path( os.path.join(query_dir, f"{name}.graphql") ).read_text()
+
+def preload_queries():
+    for path in Path(query_dir).glob("*.graphql"):
+        read_query(path.stem)
 
 
 
@@ -36,114 +60,200 @@ SHOPIFY_SECRET = os.environ.get('SHOPIFY_SECRET')
 SHOPIFY_API_KEY = os.environ.get('SHOPIFY_API_KEY')
 SHOPIFY_API_VERSION = os.environ.get('SHOPIFY_API_VERSION')
 
+# Origin serving the Admin API instead of https://<shop>, e.g. the local stand-in of bench/. Unset in production.
+SHOPIFY_ADMIN_ORIGIN = os.environ.get('SHOPIFY_ADMIN_ORIGIN')
+
 BACKEND_HOSTNAME = os.environ.get('BACKEND_HOSTNAME')
 BACKEND_PORT = os.environ.get('BACKEND_PORT')
 
 REQUEST_METHODS = {
-    "GET": requests.get,
-    "POST": requests.post,
-    "PUT": requests.put,
-    "DEL": requests.delete
+    "GET": "GET",
+    "POST": "POST",
+    "PUT": "PUT",
+    "DEL": "DELETE"
 }
 
 
-def run_ingest_orders(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
-    result = run_deployment( name = "ingest_orders_v0.1/ingest_orders", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
+_thread_sessions = threading.local()
 
-def run_ingest_products(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
-    result = run_deployment( name = "ingest_products_v0.1/ingest_products", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
 
-def run_ingestion_variants(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['json_url']}>"
-    result = run_deployment( name = "ingest_variants_v0.1/ingest_variants", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
+def query_resource(query) -> str:
+    # root connection of a bulk query: orders, products, productVariants
+    match = re.match(r'\s*(\w+)', query)
+    return match.group(1) if match else ""
 
-def run_optimization(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
-    result = run_deployment( name = "forecast_v0.1/forecast", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
 
-def run_optimization(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
-    result = run_deployment( name = "optimization_v0.1/optimization", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
+def parse_timestamp(value) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00')) if value else None
 
-def run_generate_synthetic_sales(shop_name, **kwargs):
-    flow_run_name = f"<{shop_name}><{kwargs['product_id']}><{kwargs['variant_id']}>"
-    result = run_deployment( name = "synthetic_sales_v0.1/synthetic_sales", flow_run_name = flow_run_name, parameters = {'shop_name': shop_name} | kwargs )
-    return result
 
-class EventManager:
-    events = {}
+def record_bulk_operation(operation, shop, resource):
+    # Final status, size and Shopify side duration / throughput of a finished bulk operation (bulkop_node_status.graphql)
+    if not operation:
+        return
+    BULK_OPERATIONS.inc(shop=shop, resource=resource, status=operation['status'])
+    if operation['status'] != "COMPLETED":
+        return
 
-    @staticmethod
-    def _exists_event(name):
-        if name not in EventManager.events:
-            EventManager.events[name] = threading.Event()
+    objects = int(operation.get('objectCount') or 0)
+    size = int(operation.get('fileSize') or 0)
+    BULK_OBJECTS.inc(objects, shop=shop, resource=resource)
+    BULK_BYTES.inc(size, shop=shop, resource=resource)
 
-    @staticmethod
-    def signal(name):
-        EventManager._exists_event(name)
-        EventManager.events[name].set()
+    created_at, completed_at = parse_timestamp(operation.get('createdAt')), parse_timestamp(operation.get('completedAt'))
+    if created_at and completed_at:
+        seconds = (completed_at - created_at).total_seconds()
+        BULK_STAGE_SECONDS.observe(seconds, shop=shop, resource=resource, stage="shopify")
+        if seconds > 0:
+            BULK_OBJECTS_PER_SECOND.observe(objects / seconds, shop=shop, resource=resource)
+            BULK_BYTES_PER_SECOND.observe(size / seconds, shop=shop, resource=resource)
 
-    @staticmethod
-    def wait(name):
-        EventManager._exists_event(name)
-        EventManager.events[name].wait()
-        EventManager.events[name].clear()
 
+@contextmanager
+def bulk_slot(kind, labels):
+    # Waits for a free bulk operation or download slot (see BulkSlots), timed as the "queue" stage
+    with BULK_STAGE_SECONDS.time(stage="queue", **labels):
+        lease = BULK_SLOTS.acquire(kind, labels['shop'])
+    try:
+        yield
+    finally:
+        BULK_SLOTS.release(lease)
 
-class Events:
-    def __init__(self, shop):
-        self.shop = shop
 
-    def signal(self, id):
-        EventManager.wait( (self.shop, id) )
+def admin_origin(shop) -> str:
+    return SHOPIFY_ADMIN_ORIGIN or f"https://{shop}"
+
+
+def _activate(session):
+    shopify.ShopifyResource.activate_session(session)
+    if SHOPIFY_ADMIN_ORIGIN:
+        shopify.ShopifyResource.site = f"{SHOPIFY_ADMIN_ORIGIN}/admin/api/{SHOPIFY_API_VERSION}"
+
 
-    def wait(self, id):
-        EventManager.signal( (self.shop, id) )
+@contextmanager
+def activated_session(session):
+    # The Shopify SDK keeps the active session per thread. Activate it for the duration of a call only,
+    #   restoring whichever session the thread had before so nested calls for other shops are safe.
+    stack = _thread_sessions.__dict__.setdefault('stack', [])
+    stack.append(session)
+    _activate(session)
+    try:
+        yield session
+    finally:
+        stack.pop()
+        if stack:
+            _activate(stack[-1])
+        else:
+            shopify.ShopifyResource.clear_session()
 
 
+def with_session(f):
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with activated_session(self.session):
+            return f(self, *args, **kwargs)
+    return wrapper
+
 
 class ShopifyGraphQLClient:
     def __init__(self, shop, access_token):
         self.shop = shop
         self.access_token = access_token
-        self.events = Events(shop)
 
         self.session = shopify.Session(
             shop_url=f"{shop}.myshopify.com", 
             version=SHOPIFY_API_VERSION, 
             token=access_token
         )
-        shopify.ShopifyResource.activate_session( self.session )
-
-    def execute_graphql_query(self, query):
-        response = shopify.GraphQL().execute(query)
-        return json.loads(response)
-
-    def check_bulk_operation_status(self):
-        return self.execute_graphql_query( query_bulkop_status )
-
-    def _read_bulk_operation_data(self, url):
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise an error for bad status codes
+        # keep-alive, rate limited HTTP shared by every client of this shop
+        self.http = TRANSPORTS.for_shop(shop)
+
+    @with_session
+    def execute_graphql_query(self, query, variables=None):
+        # Paced by the shop's query cost budget; THROTTLED responses are retried once the budget has been restored
+        budget = COST_BUDGETS.for_shop(self.shop)
+        attempt = 0
+        while True:
+            budget.reserve(budget.estimate(query))
+            response = json.loads(shopify.GraphQL().execute(query, variables=variables))
+            throttled = is_throttled(response)
+            budget.record(query, get_in(['extensions', 'cost'], response), throttled=throttled)
+            if not throttled or attempt >= GRAPHQL_MAX_RETRIES:
+                return response
+
+            logging.warning(f"GraphQL query throttled for shop {self.shop}, retrying")
+            attempt += 1
+
+    def check_bulk_operation_status(self, operation_id=None) -> dict:
+        # Without an ID this is the shop's current bulk operation, otherwise the given one even if a newer one exists
+        if operation_id is None:
+            response = self.execute_graphql_query( read_query("bulkop_status") )
+            return get_in(['data', 'currentBulkOperation'], response)
+
+        response = self.execute_graphql_query( read_query("bulkop_node_status"), variables={'id': operation_id} )
+        return get_in(['data', 'node'], response)
+
+    def fetch_inventory_item_variant(self, inventory_item_id) -> dict:
+        # {'id': <variant gid>, 'inventoryQuantity': <total across locations>} of an inventory item
+        response = self.execute_graphql_query( read_query("inventory_item_variant"), variables={'id': f"gid://shopify/InventoryItem/{inventory_item_id}"} )
+        return get_in(['data', 'inventoryItem', 'variant'], response)
+
+    def fetch_first_order_created_at(self) -> datetime:
+        # createdAt of the shop's oldest order, None without orders
+        response = self.execute_graphql_query( read_query("orders_first_created_at") )
+        edges = get_in(['data', 'orders', 'edges'], response) or []
+        if not edges:
+            return None
+        return datetime.fromisoformat(edges[0]['node']['createdAt'].replace('Z', '+00:00'))
 
-        # Read the response line by line and parse each line as JSON
-        data = []
-        for line in response.iter_lines():
-            if line:
-                data.append(json.loads(line))
+    def wait_for_bulk_operation(self, operation_id, timeout=BULK_OPERATION_TIMEOUT) -> dict:
+        # Wait for the bulk_operations/finish webhook, polling the operation status with exponential backoff
+        #   in case the webhook is lost. Raises BulkOperationTimeout once the deadline passes.
+        deadline = time.monotonic() + timeout
+        poll_interval = BULK_POLL_INITIAL_INTERVAL
+        waiter = DISPATCHER.register(self.shop, operation_id)
 
-        return data
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise BulkOperationTimeout(f"Bulk operation {operation_id} of shop {self.shop} did not finish within {timeout}s")
+
+                notified = waiter.wait(min(poll_interval, remaining))
+                operation = self.check_bulk_operation_status(operation_id)
+                status = operation['status'] if operation else None
+                if status in BULK_TERMINAL_STATUSES:
+                    return operation
+
+                if notified:
+                    logging.warning(f"Bulk operation {operation_id} notified but status is {status}, polling")
+                    waiter.clear()
+                else:
+                    logging.info(f"Bulk operation {operation_id} status {status}, next poll in {poll_interval}s")
+                poll_interval = min(poll_interval * 2, BULK_POLL_MAX_INTERVAL)
 
+        finally:
+            DISPATCHER.unregister(self.shop, operation_id)
 
     def fetch_bulk_operation_data(self, query, fn_read_bulk_operation_data):
-        query = f"""
+        # Returns the local path of the cached result file (see bulk_cache.py), None when the export matched nothing
+        path, download_url = self.run_bulk_operation(query, keep_checkpoint=True)
+        if path is None:
+            return None
+
+        logging.info("Starting data retrieval.")
+        # json_path lets ingestion read the cached copy instead of downloading it again (the signed URL expires)
+        BULK_CACHE.pin(path)
+        with BULK_STAGE_SECONDS.time(shop=self.shop, resource=query_resource(query), stage="ingest"):
+            result = fn_read_bulk_operation_data( self.shop, json_url = download_url, json_path = str(path) )
+        # until here a sync interrupted by a crash hands the same export over again instead of running it again
+        BULK_CHECKPOINTS.clear(self.shop, query)
+        logging.info("Bulk operation data fetched successfully.")
+        return path
+
+    def start_bulk_operation(self, query, labels) -> str:
+        # bulkOperationRunQuery, returns the operation's ID
+        mutation = f"""
                 mutation {{
                     bulkOperationRunQuery(
                         query: \"\"\"
@@ -164,51 +274,134 @@ class ShopifyGraphQLClient:
                 }}
         """
 
-        try:
-            logging.info("Executing GraphQL query for bulk operation.")
-            initiate_response = self.execute_graphql_query(query)
-            
-            query_status = get_in(['data', 'bulkOperationRunQuery', 'bulkOperation', 'status'], initiate_response)
-            if (not query_status) or (not query_status == 'CREATED'):
-                logging.error(str(initiate_response))
-                raise f"*** GraphQL query failed. ***"
+        logging.info("Executing GraphQL query for bulk operation.")
+        with BULK_STAGE_SECONDS.time(stage="create", **labels):
+            initiate_response = self.execute_graphql_query(mutation)
 
-            while True:
-                logging.info("Waiting for data notification.")
-                data_notification = self.data_notification_pop()
+        query_status = get_in(['data', 'bulkOperationRunQuery', 'bulkOperation', 'status'], initiate_response)
+        if query_status != 'CREATED':
+            logging.error(str(initiate_response))
+            errors = get_in(['data', 'bulkOperationRunQuery', 'userErrors'], initiate_response) or initiate_response.get('errors')
+            raise BulkOperationFailed(f"Bulk operation for {labels['resource']} of shop {self.shop} not created: {errors}")
+        return get_in(['data', 'bulkOperationRunQuery', 'bulkOperation', 'id'], initiate_response)
 
-                query_status = get_in(['data', 'currentBulkOperation', 'status'], data_notification)
-                if query_status == "FAILED":
-                    error_code = data_notification['data']['currentBulkOperation']['errorCode']
-                    logging.error(f"GraphQL query failure. Error code: {error_code}")
-                    raise Exception(f"GraphQL query failure. Error code: {error_code}")
+    def await_bulk_operation(self, operation_id, labels) -> dict:
+        logging.info(f"Waiting for bulk operation {operation_id} to finish.")
+        BULK_IN_FLIGHT.inc(**labels)
+        try:
+            with BULK_STAGE_SECONDS.time(stage="wait", **labels):
+                operation = self.wait_for_bulk_operation(operation_id)
+        finally:
+            BULK_IN_FLIGHT.dec(**labels)
+        record_bulk_operation(operation, **labels)
+        return operation
+
+    def run_bulk_operation(self, query, keep_checkpoint=False):
+        # Runs the bulk query and caches its result file, without handing it to ingestion.
+        #   Returns (cached path, download URL), (None, None) when the export matched nothing.
+        #   The objects of a FAILED operation's partial file are kept and only the rest is exported again, `id:>` the
+        #   last one kept (exports come in ID order, the default sort of the root connections queried), up to
+        #   BULK_RESUME_MAX_ATTEMPTS times. A partial file whose objects are not in ascending ID order would make that
+        #   cursor skip objects, the whole query is exported again instead. Progress is checkpointed (see BulkCheckpoints), so a sync interrupted by a
+        #   crash or a timeout resumes with the next one: it waits for the operation still running and keeps the parts
+        #   already downloaded. With `keep_checkpoint` the finished export is returned again until the caller clears it,
+        #   within BULK_CHECKPOINT_REUSE_AGE and BULK_CHECKPOINT_MAX_REUSES.
+        resource = query_resource(query)
+        labels = {'shop': self.shop, 'resource': resource}
+
+        checkpoint = BULK_CHECKPOINTS.get(self.shop, query) or {}
+        if checkpoint.get('path') and Path(checkpoint['path']).exists():
+            age, reuses = time.time() - checkpoint.get('finished_at', 0), checkpoint.get('reuses', 0)
+            if age <= BULK_CHECKPOINT_REUSE_AGE and reuses < BULK_CHECKPOINT_MAX_REUSES:
+                logging.info(f"Bulk export of {resource} for shop {self.shop} finished before and was not handed over, reusing it")
+                BULK_CHECKPOINTS.update(self.shop, query, reuses=reuses + 1)
+                return Path(checkpoint['path']), checkpoint['url']
+            logging.warning(f"Bulk export of {resource} for shop {self.shop} finished {age:.0f}s ago and was reused {reuses} "
+                            f"times without being handed over, exporting it again")
+            BULK_CHECKPOINTS.clear(self.shop, query)
+            checkpoint = {}
+        operation_id, cursor = checkpoint.get('operation_id'), checkpoint.get('cursor')
+        parts = [Path(part) for part in checkpoint.get('parts', [])]
+        if not all(part.exists() for part in parts):
+            logging.warning(f"Parts of the bulk export of {resource} for shop {self.shop} were evicted, exporting it again")
+            operation_id, cursor, parts = None, None, []
+
+        def checkpoint_progress(**fields):
+            BULK_CHECKPOINTS.update(self.shop, query, operation_id=operation_id, cursor=cursor, parts=[str(part) for part in parts], **fields)
+
+        def remainder_query():
+            # parts are cached under the query that exported them, so none is ever taken for a whole export
+            return and_search(query, resource, f"id:>{cursor.rsplit('/', 1)[-1]}") if cursor else query
 
-                elif query_status == "RUNNING":
-                    continue
+        try:
+            attempts = 0
+            while True:
+                with bulk_slot("operations", labels):
+                    operation = self.check_bulk_operation_status(operation_id) if operation_id else None
+                    if operation is None:
+                        operation_id = self.start_bulk_operation(remainder_query(), labels)
+                        checkpoint_progress()
+                    else:
+                        logging.info(f"Resuming bulk operation {operation_id} of shop {self.shop} ({operation['status']})")
+                    if operation is None or operation['status'] not in BULK_TERMINAL_STATUSES:
+                        operation = self.await_bulk_operation(operation_id, labels)
 
-                download_url = data_notification['data']['currentBulkOperation']['url']
-                logging.info(f"Fetching data from bulk operation download URL: {download_url}")
-                if download_url:
+                query_status, error_code = operation['status'], operation['errorCode']
+                if query_status == "COMPLETED":
                     break
+                resumable = query_status == "FAILED" and error_code != "ACCESS_DENIED"
+                if not resumable or attempts >= BULK_RESUME_MAX_ATTEMPTS:
+                    if not resumable:
+                        BULK_CHECKPOINTS.clear(self.shop, query)
+                    logging.error(f"GraphQL query failure. Status: {query_status}, error code: {error_code}")
+                    raise BulkOperationFailed(f"GraphQL query failure. Status: {query_status}, error code: {error_code}")
+
+                attempts += 1
+                if operation.get('partialDataUrl'):
+                    with bulk_slot("downloads", labels), BULK_STAGE_SECONDS.time(stage="download", **labels):
+                        part = BULK_CACHE.store(self.shop, remainder_query(), operation_id, operation['partialDataUrl'], self.http)
+                        last_id, ascending = BULK_CACHE.trim_partial(part)
+                    if not ascending:
+                        logging.warning(f"Partial data of bulk operation {operation_id} of shop {self.shop} is not in "
+                                        f"ascending ID order, {resource} cannot be resumed from it")
+                        parts, cursor = [], None
+                    elif last_id:
+                        parts.append(part)
+                        cursor = last_id
+                logging.warning(f"Bulk operation {operation_id} of shop {self.shop} failed ({error_code}) after "
+                                f"{operation.get('objectCount')} objects, exporting {resource} again from {cursor or 'the start'}")
+                BULK_RESUMES.inc(**labels)
+                operation_id = None
+                checkpoint_progress()
+
+            download_url = operation['url']
+            if download_url:
+                logging.info(f"Fetching data from bulk operation download URL: {download_url}")
+                with bulk_slot("downloads", labels), BULK_STAGE_SECONDS.time(stage="download", **labels):
+                    parts.append(BULK_CACHE.store(self.shop, remainder_query(), operation_id, download_url, self.http))
+            if not parts:
+                # Shopify returns no file when the query matched no objects
+                logging.info(f"Bulk operation {operation_id} returned no data.")
+                BULK_CHECKPOINTS.clear(self.shop, query)
+                return None, None
+
+            if len(parts) > 1 or cursor:
+                key = "resumed-" + hashlib.sha256("".join(str(part) for part in parts).encode('utf-8')).hexdigest()[:16]
+                path = BULK_CACHE.merge(self.shop, query, key, parts)
+                download_url = path.as_uri()
+            else:
+                path = parts[0]
+            if keep_checkpoint:
+                operation_id = None
+                checkpoint_progress(path=str(path), url=download_url, finished_at=time.time(), reuses=0)
+            else:
+                BULK_CHECKPOINTS.clear(self.shop, query)
+            return path, download_url
 
-            logging.info("Starting data retrieval.")
-            #data = self._read_bulk_operation_data(download_url)
-            result = fn_read_bulk_operation_data( self.shop, json_url = download_url )
-            logging.info("Bulk operation data fetched successfully.")
-
-            #return data
-        
         except Exception as ex:
             logging.exception("An error occurred during the bulk operation process.")
             raise ex
 
-    def data_notification_pop(self):
-        self.events.wait( "webhook" )
-        return self.check_bulk_operation_status()
-
-    def data_notification_push(self):
-        self.events.signal( "webhook" )
-
 if False:
     class BackendClient:
         def __init__(self, shop):
@@ -232,6 +425,29 @@ if False:
             response = requests.get(url_endpoint, params)
 
 
+class WebhookRegistry:
+    # Subscriptions last reconciled per shop
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._webhooks = {}
+
+    def get(self, shop) -> frozenset:
+        with self._lock:
+            return self._webhooks.get(shop)
+
+    def set(self, shop, webhooks: frozenset):
+        with self._lock:
+            self._webhooks[shop] = webhooks
+
+    def drop(self, shop):
+        with self._lock:
+            self._webhooks.pop(shop, None)
+
+
+WEBHOOK_REGISTRY = WebhookRegistry()
+
+
 class WebhookClient:
     def __init__(self, shop):
         self.shop = shop
@@ -259,6 +475,7 @@ class WebhookClient:
     #        return None
     #    return webhook_response['webhook']
 
+    @with_session
     def create_webook(self, address: str, topic: str, overwrite = False) -> dict:
 
         # remove webhook first if it already exists and is different, otherwise (if it exists and is the same), quit
@@ -285,6 +502,7 @@ class WebhookClient:
             logging.exception(ex)
             return None
 
+    @with_session
     def get_webhooks_count(self, topic: str):
         try:
             webhooks_count = shopify.Webhook.count(topic=topic)
@@ -293,6 +511,7 @@ class WebhookClient:
             logging.exception(ex)
             return None
 
+    @with_session
     def get_existing_webhooks(self, topic = None):
         try:
             webhooks_it = shopify.Webhook.find()
@@ -307,20 +526,76 @@ class WebhookClient:
             logging.exception(ex)
             return None
     
+    @with_session
     def remove_webhooks(self, topic: str):
         try:
-            existing_webhooks = self.get_existing_webhooks(topic)
-            if existing_webhooks:
-                for webhook in existing_webhooks:
-                    webhook_id = webhook["id"]
-                    webhook_obj = shopify.Webhook.find(webhook_id)
-                    if webhook_obj.destroy():
-                        logging.info(f"Removed webhook with ID: {webhook_id} and topic: {topic}")
-                    else:
-                        logging.error(f"Failed to remove webhook with ID: {webhook_id} and topic: {topic}")
+            for webhook in shopify.Webhook.find(topic=topic):
+                self._destroy_webhook(webhook)
+
+        except Exception as ex:
+            logging.exception(ex)
+
+    def _destroy_webhook(self, webhook) -> bool:
+        # destroys the listed resource directly, no need to find it again by ID
+        try:
+            webhook.destroy()
+            logging.info(f"Removed webhook with ID: {webhook.id} and topic: {webhook.topic}")
+            return True
+        except Exception as ex:
+            logging.error(f"Failed to remove webhook with ID: {webhook.id} and topic: {webhook.topic}: {ex}")
+            return False
+
+    @with_session
+    def reconcile_webhooks(self, desired) -> dict:
+        # desired: (topic, address) pairs. Lists the shop's subscriptions once, then only creates what is missing
+        #   and removes other addresses (or duplicates) registered for the desired topics. Other topics are left alone.
+        desired = set(desired)
+        topics = {topic for topic, _ in desired}
+        result = {'created': [], 'removed': [], 'kept': [], 'failed': []}
+
+        seen = set()
+        for webhook in shopify.Webhook.find(limit=250):
+            key = (webhook.topic, webhook.address)
+            if webhook.topic not in topics:
+                continue
+            if key in desired and key not in seen:
+                seen.add(key)
+                result['kept'].append(key)
+            elif self._destroy_webhook(webhook):
+                result['removed'].append(key)
+            else:
+                result['failed'].append(key)
+
+        for topic, address in desired - seen:
+            webhook = shopify.Webhook()
+            webhook.topic = topic
+            webhook.address = address
+            webhook.format = "json"
+            if webhook.save():
+                result['created'].append((topic, address))
+            else:
+                logging.error(f"Failed to create webhook {topic} -> {address}: {webhook.errors.full_messages()}")
+                result['failed'].append((topic, address))
 
+        return result
+
+    def ensure_webhooks(self, desired, force: bool = False) -> dict:
+        # Reconciles only when the desired set differs from the one last applied for this shop,
+        #   so routine app launches make no webhook API calls
+        desired = frozenset(desired)
+        if not force and WEBHOOK_REGISTRY.get(self.shop) == desired:
+            return {'created': [], 'removed': [], 'kept': list(desired), 'failed': []}
+
+        try:
+            result = self.reconcile_webhooks(desired)
         except Exception as ex:
             logging.exception(ex)
+            return None
+
+        # anything that failed is retried on the next call
+        if not result['failed']:
+            WEBHOOK_REGISTRY.set(self.shop, desired)
+        return result
 
 
 
@@ -329,18 +604,18 @@ class ShopifyStoreClient(ShopifyGraphQLClient, WebhookClient):
     def __init__(self, shop, access_token):
         ShopifyGraphQLClient.__init__(self, shop, access_token)
         WebhookClient.__init__(self, shop)
-        self.base_url = f"https://{shop}/admin/api/{SHOPIFY_API_VERSION}/"
+        self.base_url = f"{admin_origin(shop)}/admin/api/{SHOPIFY_API_VERSION}/"
 
     @staticmethod
     def authenticate(shop: str, code: str) -> str:
-        url = f"https://{shop}/admin/oauth/access_token"
+        url = f"{admin_origin(shop)}/admin/oauth/access_token"
         payload = {
             "client_id": SHOPIFY_API_KEY,
             "client_secret": SHOPIFY_SECRET,
             "code": code
         }
         try:
-            response = requests.post(url, json=payload)
+            response = TRANSPORTS.for_shop(shop).request("POST", url, json=payload, throttle=False)
             response.raise_for_status()
             return response.json()['access_token']
 
@@ -348,15 +623,15 @@ class ShopifyStoreClient(ShopifyGraphQLClient, WebhookClient):
             logging.exception(ex)
             return None
 
-    def authenticated_shopify_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}) -> dict:
+    def authenticated_shopify_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = None) -> dict:
         url = f"{self.base_url}{call_path}"
-        request_func = REQUEST_METHODS[method]
-        headers['X-Shopify-Access-Token'] = self.access_token
+        request_method = REQUEST_METHODS[method]
+        headers = dict(headers or {}, **{'X-Shopify-Access-Token': self.access_token})
         #logging.basicConfig(level=logging.DEBUG)
 
         try:
-            logging.debug(f"request_func('{url}', params={params}, json={payload}, headers={headers})")
-            response = request_func(url, params=params, json=payload, headers=headers)
+            logging.debug(f"{request_method} '{url}', params={params}, json={payload}, headers={headers}")
+            response = self.http.request(request_method, url, params=params, json=payload, headers=headers)
             response.raise_for_status()
             logging.debug(f"authenticated_shopify_call response:\n{json.dumps(response.json(), indent=4)}")
             return response.json()
@@ -366,15 +641,22 @@ class ShopifyStoreClient(ShopifyGraphQLClient, WebhookClient):
             return None
 
 
-    def fetch_products(self):
-        self.fetch_bulk_operation_data(query_fetch_products, run_ingest_products)
+    # `search` narrows the export with Shopify search syntax, e.g. "updated_at:>'2024-05-01T00:00:00Z'" for incremental syncs
+    def fetch_products(self, search=None):
+        return self.fetch_bulk_operation_data(with_search(read_query("products"), "products", search), run_ingest_products)
         # products = ...
         # for i in range(len(products)):
         #     products[i]['id'] = products[i]['id'][22:] 
         # return products
 
-    def fetch_variants(self):
-        self.fetch_bulk_operation_data(query_fetch_variants, run_ingestion_variants)
+    def fetch_inventory_levels(self, search=None):
+        # Stock per inventory item and location. A level changing does not move its item's updatedAt, so this is always
+        #   a full export, inventory_levels/update webhooks keep it current in between. Not handed to ingestion.
+        path, _ = self.run_bulk_operation(read_query("inventory_levels"))
+        return path
+
+    def fetch_variants(self, search=None):
+        return self.fetch_bulk_operation_data(with_search(read_query("variants"), "productVariants", search), run_ingestion_variants)
         # variants = 
         # variants_clean = []
         # for variant in variants:
@@ -387,14 +669,68 @@ class ShopifyStoreClient(ShopifyGraphQLClient, WebhookClient):
         # 
         # return variants_clean
 
-    def fetch_orders(self):
+    def fetch_orders_sharded(self, query):
+        # One bulk operation per created_at window, merged into a single cached export of `query`.
+        #   Closed windows exported less than ORDERS_SHARD_REUSE_AGE ago are taken from the cache, so a sync
+        #   that failed halfway resumes with the windows it is missing. The open, most recent window is always exported.
+        start = self.fetch_first_order_created_at()
+        if start is None:
+            return None
+
+        windows = created_at_windows(start)
+        shard_queries = [with_search(query, "orders", created_at_search(since, until)) for since, until in windows]
+
+        def export(i):
+            shard_query = shard_queries[i]
+            is_open = windows[i][1] is None
+            cached = None if is_open else BULK_CACHE.latest(self.shop, shard_query)
+            manifest = BULK_CACHE.manifest(cached) if cached else None
+            if manifest and time.time() - manifest['created_at'] <= ORDERS_SHARD_REUSE_AGE:
+                logging.info(f"Reusing cached orders shard {i + 1}/{len(windows)} of shop {self.shop}")
+                return cached
+            logging.info(f"Exporting orders shard {i + 1}/{len(windows)} of shop {self.shop}")
+            path, _ = self.run_bulk_operation(shard_query)
+            return path
+
+        with ThreadPoolExecutor(max_workers=max(ORDERS_SHARD_CONCURRENCY, 1)) as executor:
+            paths = [path for path in executor.map(export, range(len(windows))) if path is not None]
+        if not paths:
+            return None
+
+        key = "sharded-" + hashlib.sha256("".join(str(path) for path in paths).encode('utf-8')).hexdigest()[:16]
+        return BULK_CACHE.merge(self.shop, query, key, paths)
+
+    def reingest_cached(self, name):
+        # Re-runs ingestion of a dataset from its latest cached full export, without going back to Shopify
+        query, fn_read_bulk_operation_data = {
+            "products": (read_query("products"), run_ingest_products),
+            "variants": (read_query("variants"), run_ingestion_variants),
+            "orders": (build_orders_query(), run_ingest_orders),
+        }[name]
+        path = BULK_CACHE.latest(self.shop, query)
+        if not path:
+            return None
+        BULK_CACHE.pin(path)
+        return fn_read_bulk_operation_data( self.shop, json_url = path.as_uri(), json_path = str(path) )
+
+    def fetch_orders(self, search=None, profile=ORDERS_QUERY_PROFILE):
+        # Full exports are split into created_at windows (see order_query.py) and merged before ingestion,
+        #   incremental ones (`search` set) are small enough to run as a single bulk operation
         #orders = shopify.Order.find()
         #order_list = []
         #for order in orders:
         #    order_list.append( order.to_dict() )
         #
-        query_fetch_orders = read_query("queries/orders.graphql")
-        self.fetch_bulk_operation_data(query_fetch_orders, run_ingest_orders)
+        query_fetch_orders = build_orders_query(profile)
+        if search or not ORDERS_SHARD_DAYS:
+            return self.fetch_bulk_operation_data(with_search(query_fetch_orders, "orders", search), run_ingest_orders)
+
+        path = self.fetch_orders_sharded(query_fetch_orders)
+        if path is not None:
+            BULK_CACHE.pin(path)
+            with BULK_STAGE_SECONDS.time(shop=self.shop, resource="orders", stage="ingest"):
+                run_ingest_orders( self.shop, json_url = path.as_uri(), json_path = str(path) )
+        return path
         # orders = ...
         # orders_meta = []
         # orders_line_items = []
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from data_store import DATASETS, SYNCED_DATASETS, table_from_columns
+
+load_dotenv()
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'snapshots'))
+
+# Durable copy of each shop's datasets, so a restarted process serves dashboards from disk instead of re-running the
+#   bulk operations. One SQLite file per shop, <dir>/<shop>.sqlite3:
+#     one table per data store table (products, variants, orders, line_items), indexed like the in memory one
+#     snapshots    per synced dataset: bulk operation ID, sync watermark, handle position (see dataset_handles.py)
+#   Written after every sync (whole dataset) and webhook delta (upserted rows), read back on a shop's first request.
+
+SQL_TYPES = {'int': "INTEGER", 'float': "REAL", 'str': "TEXT"}
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    dataset TEXT PRIMARY KEY,
+    operation_id TEXT,
+    watermark TEXT,
+    position TEXT,
+    rows INTEGER NOT NULL,
+    saved_at REAL NOT NULL
+);
+"""
+
+
+def _create_table(db, table):
+    schema = DATASETS[table][0]
+    columns = ", ".join(f"{column} {SQL_TYPES[kind]}" for column, kind in schema.items())
+    db.execute(f"CREATE TABLE {table} ({columns})")
+
+
+def _create_indexes(db, table):
+    _, _, unique_indexes, indexes = DATASETS[table]
+    for column in unique_indexes:
+        db.execute(f"CREATE UNIQUE INDEX {table}_{column} ON {table} ({column})")
+    for column in indexes:
+        db.execute(f"CREATE INDEX {table}_{column} ON {table} ({column})")
+
+
+class SnapshotStore:
+    def __init__(self, root: str = SNAPSHOT_DIR):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self._shop_locks = {}
+
+    def path(self, shop) -> Path:
+        return self.root / f"{shop}.sqlite3"
+
+    def _shop_lock(self, shop) -> threading.Lock:
+        # writers of the same shop in this process take turns, other processes wait on SQLite's own lock
+        with self._lock:
+            return self._shop_locks.setdefault(shop, threading.Lock())
+
+    def _connect(self, shop) -> sqlite3.Connection:
+        self.root.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.path(shop), timeout=60, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(META_SCHEMA)
+        return db
+
+    def _set_meta(self, db, dataset, position, operation_id=None, watermark: datetime = None, rows: int = None):
+        current = self._meta(db, dataset) or {}
+        if current.get('position') and (position is None or current['position'] > position):
+            position = current['position']
+        db.execute("INSERT OR REPLACE INTO snapshots (dataset, operation_id, watermark, position, rows, saved_at) VALUES (?, ?, ?, ?, ?, ?)", (
+            dataset,
+            operation_id if operation_id is not None else current.get('operation_id'),
+            watermark.isoformat() if watermark is not None else current.get('watermark'),
+            json.dumps(position) if position is not None else None,
+            rows if rows is not None else current.get('rows', 0),
+            time.time(),
+        ))
+
+    def _meta(self, db, dataset) -> dict:
+        row = db.execute("SELECT operation_id, watermark, position, rows, saved_at FROM snapshots WHERE dataset = ?", (dataset,)).fetchone()
+        if not row:
+            return None
+        operation_id, watermark, position, rows, saved_at = row
+        return {'dataset': dataset, 'operation_id': operation_id, 'watermark': watermark,
+                'position': json.loads(position) if position else None, 'rows': rows, 'saved_at': saved_at}
+
+    def save(self, shop, dataset, shop_data, operation_id=None, watermark: datetime = None, position=None):
+        # Replaces the snapshot of a synced dataset with what the shop's store holds now, in one transaction.
+        #   The columns are copied under the shop's lock, merges go on while they are written.
+        with shop_data.lock:
+            names = [table for table in SYNCED_DATASETS[dataset] if shop_data.has(table)]
+            if not names:
+                return
+            rows = len(shop_data.table(names[0]))
+            tables = {table: {column: values[:] for column, values in shop_data.table(table).columns.items()} for table in names}
+        with self._shop_lock(shop):
+            db = self._connect(shop)
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for table, data in tables.items():
+                    columns = list(data)
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                    _create_table(db, table)
+                    # NaN floats are stored as NULL, see #restore
+                    db.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                                   zip(*(data[column] for column in columns)))
+                    _create_indexes(db, table)
+                self._set_meta(db, dataset, position, operation_id=operation_id, watermark=watermark,
+                               rows=rows)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            finally:
+                db.close()
+
+    def upsert(self, shop, dataset, tables: dict, position=None, operation_id=None, watermark: datetime = None) -> bool:
+        # Incremental sync or webhook delta, tables: table -> rows upserted on its unique key, in one transaction.
+        #   Rows may carry only some columns (e.g. a variant's inventory), those alone are updated.
+        #   False when the dataset has no snapshot to update.
+        if not self.path(shop).exists():
+            return False
+        tables = {table: rows for table, rows in tables.items() if rows}
+        with self._shop_lock(shop):
+            db = self._connect(shop)
+            try:
+                snapshotted = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                if not all(table in snapshotted for table in SYNCED_DATASETS[dataset]):
+                    return False
+                db.execute("BEGIN IMMEDIATE")
+                for table, rows in tables.items():
+                    schema, _, unique_indexes, _ = DATASETS[table]
+                    key = unique_indexes[0]
+                    for row in rows:
+                        columns = [column for column in row if column in schema]
+                        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != key)
+                        db.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                                   f"ON CONFLICT ({key}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"),
+                                   [row[column] for column in columns])
+                self._set_meta(db, dataset, position, operation_id=operation_id, watermark=watermark)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            finally:
+                db.close()
+        return True
+
+    def set_watermark(self, shop, dataset, watermark: datetime):
+        # a sync that found nothing new, the snapshot is as recent as its watermark
+        if not self.path(shop).exists():
+            return
+        with self._shop_lock(shop):
+            db = self._connect(shop)
+            try:
+                if self._meta(db, dataset) is not None:
+                    self._set_meta(db, dataset, None, watermark=watermark)
+            finally:
+                db.close()
+
+    def meta(self, shop, dataset) -> dict:
+        if not self.path(shop).exists():
+            return None
+        db = self._connect(shop)
+        try:
+            return self._meta(db, dataset)
+        finally:
+            db.close()
+
+    def metas(self, shop) -> dict:
+        # dataset -> meta of every dataset snapshotted for the shop, one connection
+        if not self.path(shop).exists():
+            return {}
+        db = self._connect(shop)
+        try:
+            datasets = [row[0] for row in db.execute("SELECT dataset FROM snapshots")]
+            return {dataset: self._meta(db, dataset) for dataset in datasets}
+        finally:
+            db.close()
+
+    def watermark(self, shop, dataset) -> datetime:
+        meta = self.meta(shop, dataset)
+        return datetime.fromisoformat(meta['watermark']) if meta and meta['watermark'] else None
+
+    def restore(self, shop, dataset, shop_data) -> dict:
+        # Loads a synced dataset's tables into the shop's store, returns the snapshot's meta (None without a snapshot)
+        if not self.path(shop).exists():
+            return None
+        started = time.monotonic()
+        db = self._connect(shop)
+        try:
+            meta = self._meta(db, dataset)
+            if meta is None:
+                return None
+            tables = {}
+            for table in SYNCED_DATASETS[dataset]:
+                columns = list(DATASETS[table][0])
+                rows = db.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid").fetchall()
+                tables[table] = table_from_columns(table, dict(zip(columns, zip(*rows))) if rows else {column: () for column in columns})
+        except sqlite3.OperationalError as ex:
+            logging.error(f"Snapshot of {dataset} for shop {shop} could not be read: {ex}")
+            return None
+        finally:
+            db.close()
+
+        for table, data in tables.items():
+            shop_data.install(table, data)
+        logging.info(f"Restored {dataset} of shop {shop} from its snapshot ({meta['rows']} rows, operation {meta['operation_id']}) "
+                     f"in {time.monotonic() - started:.2f}s")
+        return meta
+
+    def drop(self, shop):
+        with self._shop_lock(shop):
+            for suffix in ("", "-wal", "-shm"):
+                path = self.path(shop).with_name(self.path(shop).name + suffix)
+                if path.exists():
+                    path.unlink()
+
+
+SNAPSHOTS = SnapshotStore()
@@ -0,0 +1,130 @@
+import os
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Incremental syncs re-read this much before the last watermark, to cover clock skew and late commits
+SYNC_WATERMARK_OVERLAP = int(os.environ.get('SYNC_WATERMARK_OVERLAP', 300))
+
+# Store dataset -> root connection of its bulk query
+ROOT_FIELDS = {
+    'products': 'products',
+    'variants': 'productVariants',
+    'orders': 'orders',
+    'inventory_levels': 'inventoryItems',
+}
+
+# Webhooks carrying deltas for the stored datasets, see #data_updated in server.py
+DELTA_TOPICS = ["orders/updated", "products/update", "inventory_levels/update"]
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class WatermarkStore:
+    # High-water mark of the last successful bulk sync, per shop and dataset
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watermarks = {}
+
+    def get(self, shop, name) -> datetime:
+        with self._lock:
+            return self._watermarks.get((shop, name))
+
+    def set(self, shop, name, watermark: datetime):
+        with self._lock:
+            self._watermarks[(shop, name)] = watermark
+
+    def drop(self, shop):
+        with self._lock:
+            for key in [key for key in self._watermarks if key[0] == shop]:
+                del self._watermarks[key]
+
+
+WATERMARKS = WatermarkStore()
+
+
+def updated_at_search(watermark: datetime) -> str:
+    since = (watermark - timedelta(seconds=SYNC_WATERMARK_OVERLAP)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return f"updated_at:>'{since}'"
+
+
+def with_search(query: str, root: str, search: str) -> str:
+    # orders { ... } -> orders(query: "updated_at:>'...'") { ... }
+    if not search:
+        return query
+    return re.sub(rf'^(\s*){root}\s*{{', rf'\g<1>{root}(query: "{search}") {{', query, count=1)
+
+
+def and_search(query: str, root: str, search: str) -> str:
+    # Narrows the root connection's search with one more term, e.g. the `id:>` cursor of a resumed export
+    match = re.match(rf'^\s*{root}\(query: "([^"]*)"\)', query)
+    if not match:
+        return with_search(query, root, search)
+    return query[:match.start(1)] + f"{match.group(1)} AND {search}" + query[match.end(1):]
+
+
+def _gid_int(value):
+    return int(value) if value is not None else None
+
+
+def order_rows_from_webhook(payload: dict):
+    # orders/updated (REST representation) -> rows of the `orders` and `line_items` datasets
+    order = {
+        'id': payload['id'],
+        'created_at': payload.get('created_at'),
+        'cancelled_at': payload.get('cancelled_at'),
+        'currency_code': payload.get('currency'),
+        'total_price': payload.get('total_price'),
+        'current_total_discounts': payload.get('current_total_discounts'),
+        'current_total_price': payload.get('current_total_price'),
+    }
+
+    line_items = []
+    for line_item in payload.get('line_items', []):
+        quantity = line_item.get('quantity') or 0
+        price = float(line_item['price']) if line_item.get('price') is not None else None
+        discount = sum(float(allocation['amount']) for allocation in line_item.get('discount_allocations', []))
+        line_items.append({
+            'id': line_item['id'],
+            'order_id': payload['id'],
+            'product_id': _gid_int(line_item.get('product_id')),
+            'variant_id': _gid_int(line_item.get('variant_id')),
+            'sku': line_item.get('sku'),
+            'quantity': quantity,
+            'original_unit_price': price,
+            'discounted_unit_price': price - discount / quantity if price is not None and quantity else price,
+        })
+
+    return order, line_items
+
+
+def product_rows_from_webhook(payload: dict):
+    # products/update (REST representation) -> rows of the `products` and `variants` datasets
+    product = {
+        'id': payload['id'],
+        'title': payload.get('title'),
+        'product_type': payload.get('product_type'),
+        'vendor': payload.get('vendor'),
+        'status': payload.get('status'),
+        'created_at': payload.get('created_at'),
+        'updated_at': payload.get('updated_at'),
+    }
+
+    variants = [{
+        'variant_id': variant['id'],
+        'product_id': payload['id'],
+        'variant_title': variant.get('title'),
+        'sku': variant.get('sku'),
+        'price': variant.get('price'),
+        'inventory_quantity': variant.get('inventory_quantity'),
+        'inventory_item_id': variant.get('inventory_item_id'),
+    } for variant in payload.get('variants', [])]
+
+    return product, variants
@@ -0,0 +1,149 @@
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 5))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.5))
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', 30))
+
+# REST Admin API leaky bucket, standard plan values; the bucket size is corrected from the call limit header
+#   https://shopify.dev/docs/api/usage/rate-limits
+REST_BUCKET_SIZE = int(os.environ.get('REST_BUCKET_SIZE', 40))
+REST_LEAK_RATE = float(os.environ.get('REST_LEAK_RATE', 2))
+REST_BUCKET_HEADROOM = int(os.environ.get('REST_BUCKET_HEADROOM', 2))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Calls that may have taken effect when their connection broke or Shopify answered 5xx (an OAuth code exchange,
+#   a webhook subscription): by default only retried on 429, which Shopify returns without handling the call
+NON_IDEMPOTENT_METHODS = ("POST", "PUT", "PATCH")
+
+
+class LeakyBucket:
+    # Client side mirror of the shop's REST bucket: every call adds one unit, `leak_rate` units drain per second
+
+    def __init__(self, capacity: int = REST_BUCKET_SIZE, leak_rate: float = REST_LEAK_RATE, headroom: int = REST_BUCKET_HEADROOM):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.headroom = headroom
+        self.level = 0.0
+        self.blocked_until = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _leak(self, now):
+        self.level = max(self.level - (now - self._updated_at) * self.leak_rate, 0.0)
+        self._updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._leak(now)
+                limit = max(self.capacity - self.headroom, 1)
+                if now >= self.blocked_until and self.level + 1 <= limit:
+                    self.level += 1
+                    return
+                wait = max(self.blocked_until - now, (self.level + 1 - limit) / self.leak_rate)
+            time.sleep(wait)
+
+    def update(self, used: int, capacity: int):
+        # X-Shopify-Shop-Api-Call-Limit: "<used>/<capacity>" as seen by Shopify
+        with self._lock:
+            self._leak(time.monotonic())
+            self.capacity = capacity
+            self.level = max(self.level, float(used))
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt: int) -> float:
+    # Full jitter exponential backoff
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+class ShopTransport:
+    # One keep-alive session per shop, paced by the shop's bucket and retrying throttled or failed calls
+
+    def __init__(self, shop, pool_maxsize: int = HTTP_POOL_MAXSIZE):
+        self.shop = shop
+        self.bucket = LeakyBucket()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, throttle: bool = True, max_retries: int = HTTP_MAX_RETRIES, retry: bool = None,
+                **kwargs) -> requests.Response:
+        # throttle=False for calls that do not count against the REST bucket (OAuth, bulk file downloads).
+        #   retry: whether connection errors and 5xx are retried, by default for all but NON_IDEMPOTENT_METHODS
+        if retry is None:
+            retry = method.upper() not in NON_IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            if throttle:
+                self.bucket.acquire()
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as ex:
+                # a connect timeout never reached Shopify
+                if attempt >= max_retries or not (retry or isinstance(ex, requests.ConnectTimeout)):
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning(f"Connection error on {method} {url} for shop {self.shop}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+            if call_limit:
+                used, capacity = call_limit.split('/')
+                self.bucket.update(int(used), int(capacity))
+
+            retryable = response.status_code == 429 or (retry and response.status_code in RETRY_STATUSES)
+            if not retryable or attempt >= max_retries:
+                return response
+
+            retry_after = response.headers.get('Retry-After')
+            delay = float(retry_after) if retry_after else backoff_delay(attempt)
+            if response.status_code == 429:
+                self.bucket.pause(delay)
+            logging.warning(f"{method} {url} for shop {self.shop} returned {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+
+
+class TransportRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports = {}
+
+    def for_shop(self, shop) -> ShopTransport:
+        with self._lock:
+            if shop not in self._transports:
+                self._transports[shop] = ShopTransport(shop)
+            return self._transports[shop]
+
+    def close(self, shop):
+        with self._lock:
+            transport = self._transports.pop(shop, None)
+        if transport:
+            transport.close()
+
+
+TRANSPORTS = TransportRegistry()
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WEBHOOK_QUEUE_PATH = os.environ.get('WEBHOOK_QUEUE_PATH', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'webhooks.sqlite3'))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 2))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+WEBHOOK_RETRY_DELAY = float(os.environ.get('WEBHOOK_RETRY_DELAY', 5))
+# Processed events are kept this long so redelivered webhooks are recognized as duplicates.
+#   Shopify retries a failed delivery for up to 48 hours.
+WEBHOOK_RETENTION = float(os.environ.get('WEBHOOK_RETENTION', 3 * 24 * 60 * 60))
+# A claimed event goes back to pending when its worker has not finished it after this long (e.g. the process died).
+#   Longer than any handler takes, a handler still running past it may see its event handled a second time.
+WEBHOOK_LEASE = float(os.environ.get('WEBHOOK_LEASE', 10 * 60))
+
+EVENT_PENDING = "pending"
+EVENT_PROCESSING = "processing"
+EVENT_DONE = "done"
+EVENT_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    webhook_id TEXT NOT NULL UNIQUE,
+    shop TEXT,
+    topic TEXT,
+    payload BLOB,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    received_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    processed_at REAL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS events_status ON events (status, available_at, seq);
+CREATE INDEX IF NOT EXISTS events_shop ON events (shop, status, seq);
+"""
+
+
+class WebhookQueue:
+    # Durable queue of received webhooks in a local SQLite file. Endpoints only verify and enqueue, worker threads
+    #   run the topic handlers. The X-Shopify-Webhook-Id is unique, so a redelivered event is recorded once
+    #   and handled at most once. Events of the same shop are handled one at a time in the order they were received,
+    #   over every process sharing the file: only a shop's oldest unfinished event can be claimed. An event that
+    #   failed is retried after a backoff and holds back the shop's later events until it succeeds or is given up,
+    #   so an old delta never overwrites a newer one. A claim is a lease (owner, lease_until), events of a worker
+    #   that died are handed out again once it expires.
+
+    def __init__(self, path: str = WEBHOOK_QUEUE_PATH, max_attempts: int = WEBHOOK_MAX_ATTEMPTS, lease: float = WEBHOOK_LEASE):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._handlers = {}
+        self._workers = []
+        self._stopping = False
+        self.duplicates = 0
+        # neither the SQLite connection nor the worker threads carry over into a forked process
+        os.register_at_fork(after_in_child=self._after_fork)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+        # events a stopped process was handling are picked up again, those of live ones stay theirs
+        self.requeue_expired()
+
+    def _after_fork(self):
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._workers = []
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def register(self, topic, fn):
+        # fn(shop, topic, payload: dict)
+        self._handlers[topic] = fn
+
+    def enqueue(self, webhook_id, shop, topic, payload: bytes) -> bool:
+        # False when the event was already received
+        webhook_id = webhook_id or f"local-{uuid.uuid4().hex}"
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO events (webhook_id, shop, topic, payload, status, received_at, available_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (webhook_id, shop, topic, payload, EVENT_PENDING, now, now))
+        if cursor.rowcount == 0:
+            with self._condition:
+                self.duplicates += 1
+            logging.info(f"Duplicate webhook {webhook_id} ({topic}) for shop {shop} ignored")
+            return False
+
+        with self._condition:
+            self._condition.notify()
+        return True
+
+    def _claim(self):
+        # oldest due event that is also its shop's oldest unfinished one (none of the shop's events is being handled
+        #   or waiting for a retry before it), or None. In a write transaction, so two processes never claim for the same shop.
+        db = self._connection()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT seq, webhook_id, shop, topic, payload, attempts FROM events AS e "
+                "WHERE status = ? AND available_at <= ? AND NOT EXISTS ("
+                "    SELECT 1 FROM events AS p WHERE p.shop IS e.shop AND p.status IN (?, ?) AND p.seq < e.seq) "
+                "ORDER BY seq LIMIT 1",
+                (EVENT_PENDING, now, EVENT_PENDING, EVENT_PROCESSING)).fetchone()
+            if row is not None:
+                db.execute("UPDATE events SET status = ?, attempts = attempts + 1, owner = ?, lease_until = ? WHERE seq = ?",
+                           (EVENT_PROCESSING, self._owner, now + self.lease, row[0]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return row
+
+    def _release(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def requeue_expired(self) -> int:
+        # events claimed by a worker that did not finish them within its lease
+        requeued = self._connection().execute(
+            "UPDATE events SET status = ?, owner = NULL, lease_until = NULL WHERE status = ? AND (lease_until IS NULL OR lease_until < ?)",
+            (EVENT_PENDING, EVENT_PROCESSING, time.time())).rowcount
+        if requeued:
+            logging.warning(f"{requeued} webhooks whose worker stopped handling them are pending again")
+        return requeued
+
+    def process_one(self) -> bool:
+        row = self._claim()
+        if row is None:
+            return False
+
+        seq, webhook_id, shop, topic, payload, attempts = row
+        db = self._connection()
+        try:
+            handler = self._handlers.get(topic)
+            if handler is None:
+                raise KeyError(f"No handler for webhook topic {topic}")
+            handler(shop, topic, json.loads(payload) if payload else {})
+            self._finish(db, seq, "status = ?, error = NULL, processed_at = ?", (EVENT_DONE, time.time()))
+        except Exception as ex:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                logging.exception(f"Webhook {webhook_id} ({topic}) for shop {shop} failed {attempts} times, giving up")
+                self._finish(db, seq, "status = ?, error = ?, processed_at = ?", (EVENT_FAILED, str(ex), time.time()))
+            else:
+                delay = random.uniform(0, WEBHOOK_RETRY_DELAY * 2 ** attempts)
+                logging.exception(f"Webhook {webhook_id} ({topic}) for shop {shop} failed, retrying in {delay:.1f}s, its later events wait")
+                self._finish(db, seq, "status = ?, error = ?, available_at = ?", (EVENT_PENDING, str(ex), time.time() + delay))
+        finally:
+            self._release()
+        return True
+
+    def _finish(self, db, seq, assignments, params):
+        # only while the lease is still ours, an expired one may have been handed to another worker since
+        updated = db.execute(f"UPDATE events SET {assignments}, owner = NULL, lease_until = NULL WHERE seq = ? AND owner = ?",
+                             (*params, seq, self._owner)).rowcount
+        if not updated:
+            logging.warning(f"Lease of webhook event {seq} expired before it was handled, left to its new owner")
+
+    def _next_available_in(self) -> float:
+        row = self._connection().execute("SELECT MIN(available_at) FROM events WHERE status = ?", (EVENT_PENDING,)).fetchone()
+        return max(row[0] - time.time(), 0.0) if row[0] is not None else None
+
+    def _work(self):
+        last_purge = last_requeue = 0.0
+        while not self._stopping:
+            if self.process_one():
+                continue
+            if time.time() - last_requeue > min(self.lease, 60):
+                self.requeue_expired()
+                last_requeue = time.time()
+            if time.time() - last_purge > 60 * 60:
+                self.purge()
+                last_purge = time.time()
+            with self._condition:
+                # woken by enqueue / release in this process, or when a delayed retry becomes due. Events that are
+                #   due but held back by their shop's event in another worker or process are rechecked every second
+                wait = self._next_available_in()
+                self._condition.wait(min(max(wait, 1.0), 60) if wait is not None else 60)
+
+    def start(self, workers: int = WEBHOOK_WORKERS):
+        if self._workers:
+            return
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name=f"webhook-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self._stopping = True
+        with self._condition:
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def purge(self, retention: float = WEBHOOK_RETENTION):
+        self._connection().execute("DELETE FROM events WHERE status IN (?, ?) AND received_at < ?",
+                                   (EVENT_DONE, EVENT_FAILED, time.time() - retention))
+
+    def stats(self) -> dict:
+        db = self._connection()
+        counts = dict(db.execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall())
+        oldest = db.execute("SELECT MIN(received_at) FROM events WHERE status IN (?, ?)", (EVENT_PENDING, EVENT_PROCESSING)).fetchone()[0]
+        last_lag = db.execute("SELECT processed_at - received_at FROM events WHERE status = ? ORDER BY processed_at DESC LIMIT 1",
+                              (EVENT_DONE,)).fetchone()
+        return {
+            'depth': counts.get(EVENT_PENDING, 0) + counts.get(EVENT_PROCESSING, 0),
+            'lag': time.time() - oldest if oldest is not None else 0.0,
+            'last_processing_lag': last_lag[0] if last_lag else None,
+            'counts': counts,
+            'duplicates': self.duplicates,
+            'workers': len(self._workers),
+        }
+
+
+WEBHOOKS = WebhookQueue()
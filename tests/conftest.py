@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The modules live flat in src/ and are imported by name, as server.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+# Module level singletons (shared state, bulk cache, snapshots) are created on import, keep them out of src/cache
+_cache_dir = tempfile.mkdtemp(prefix="inventory-guru-tests-")
+os.environ.setdefault('SHARED_STATE_BACKEND', 'memory')
+os.environ.setdefault('BULK_CACHE_DIR', os.path.join(_cache_dir, 'bulk'))
+os.environ.setdefault('SNAPSHOT_DIR', os.path.join(_cache_dir, 'snapshots'))
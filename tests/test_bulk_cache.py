@@ -0,0 +1,80 @@
+import gzip
+import json
+
+from bulk_cache import BulkCache
+from shared_state import MemoryState
+
+ORDER = "gid://shopify/Order/{}"
+LINE_ITEM = "gid://shopify/LineItem/{}"
+
+
+def lines(order_ids, children=2) -> list:
+    # a bulk export of orders with their line items nested under them through __parentId
+    result = []
+    for order_id in order_ids:
+        result.append(json.dumps({'id': ORDER.format(order_id), 'name': f"#{order_id}"}) + "\n")
+        for i in range(children):
+            result.append(json.dumps({'id': LINE_ITEM.format(order_id * 100 + i), '__parentId': ORDER.format(order_id)}) + "\n")
+    return result
+
+
+def write_partial(tmp_path, content: str):
+    cache = BulkCache(root=tmp_path, state=MemoryState())
+    path = cache.path("test-shop", "query", "gid://shopify/BulkOperation/1")
+    path.parent.mkdir(parents=True)
+    with gzip.open(path, 'wt') as f:
+        f.write(content)
+    path.with_name(path.name[:-len('.jsonl.gz')] + '.json').write_text(json.dumps({'operation_id': "gid://shopify/BulkOperation/1"}))
+    return cache, path
+
+
+def kept(path) -> list:
+    with gzip.open(path, 'rt') as f:
+        return f.readlines()
+
+
+def test_cut_mid_child_drops_its_parent(tmp_path):
+    full = lines([1, 2, 3])
+    cache, path = write_partial(tmp_path, "".join(full[:-1]) + full[-1][:15])
+
+    cursor, ascending = cache.trim_partial(path)
+    assert cursor == ORDER.format(2)
+    assert ascending
+    # order 3 may be missing line items, it goes with the cut line
+    assert kept(path) == full[:6]
+
+    manifest = cache.manifest(path)
+    assert manifest['partial'] and manifest['cursor'] == cursor and manifest['ascending']
+    assert manifest['size'] == path.stat().st_size
+    assert manifest['operation_id'] == "gid://shopify/BulkOperation/1"
+    assert cache.latest("test-shop", "query") is None
+
+
+def test_cut_mid_parent_keeps_the_one_before(tmp_path):
+    full = lines([1, 2, 3])
+    cache, path = write_partial(tmp_path, "".join(full[:6]) + full[6][:20])
+
+    # order 2 has all its lines, but nothing says so until the next top-level object is complete
+    assert cache.trim_partial(path) == (ORDER.format(1), True)
+    assert kept(path) == full[:3]
+
+
+def test_out_of_order_ids(tmp_path):
+    full = lines([5, 2, 9, 7])
+    cache, path = write_partial(tmp_path, "".join(full[:-2]) + full[-2][:10])
+
+    cursor, ascending = cache.trim_partial(path)
+    # the cursor is the last object kept, not the highest ID, and resuming `id:>` it would skip order 7
+    assert cursor == ORDER.format(9)
+    assert not ascending
+    assert kept(path) == full[:9]
+    assert cache.manifest(path)['ascending'] is False
+
+
+def test_nothing_complete(tmp_path):
+    full = lines([1])
+    cache, path = write_partial(tmp_path, "".join(full[:2]) + full[2][:5])
+
+    assert cache.trim_partial(path) == (None, True)
+    assert kept(path) == []
+    assert cache.manifest(path)['cursor'] is None
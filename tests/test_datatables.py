@@ -0,0 +1,119 @@
+from data_store import Table, INT, STR, FLOAT
+from datatables import DataTablesRequest, query_table, MAX_PAGE_LENGTH
+
+
+class Args(dict):
+    # the part of werkzeug's MultiDict that DataTablesRequest uses: values that do not convert fall back to the default
+    def get(self, key, default=None, type=None):
+        if key not in self:
+            return default
+        try:
+            return type(self[key]) if type is not None else self[key]
+        except (ValueError, TypeError):
+            return default
+
+
+COLUMNS = {'columns[0][data]': 'id', 'columns[1][data]': 'title', 'columns[2][data]': 'price'}
+
+
+def products(count=25) -> Table:
+    table = Table({'id': INT, 'title': STR, 'price': FLOAT}, unique_indexes=('id',))
+    # ids ascending, titles in another order, one price missing
+    for i in range(1, count + 1):
+        table.append({'id': i, 'title': f"Product {(i * 7) % count:02d}", 'price': None if i == 3 else float(i % 5)})
+    return table
+
+
+def ids(response) -> list:
+    return [row['id'] for row in response['data']]
+
+
+def test_defaults_on_malformed_parameters():
+    query = DataTablesRequest(Args(COLUMNS, draw='x', start='-5', length='lots', **{
+        'order[0][column]': 'first', 'order[1][column]': '7', 'order[2][column]': '-1', 'order[3][column]': '1',
+        'order[3][dir]': 'sideways', 'search[value]': '  '}))
+    assert query.draw == 0
+    assert query.start == 0
+    assert query.length == 50
+    assert query.search == ''
+    assert query.columns == ['id', 'title', 'price']
+    # unknown and out of range columns are skipped, an unknown direction is ascending
+    assert query.order == [('title', False)]
+
+
+def test_length_is_capped():
+    assert DataTablesRequest(Args(length='-1')).length == MAX_PAGE_LENGTH
+    assert DataTablesRequest(Args(length=str(MAX_PAGE_LENGTH * 10))).length == MAX_PAGE_LENGTH
+    assert DataTablesRequest(Args(length='0')).length == 0
+
+
+def test_pages_in_table_order():
+    table = products()
+    response = query_table(table, DataTablesRequest(Args(COLUMNS, draw='3', start='10', length='10')))
+    assert response['draw'] == 3
+    assert response['recordsTotal'] == response['recordsFiltered'] == 25
+    assert ids(response) == list(range(11, 21))
+
+    last = query_table(table, DataTablesRequest(Args(COLUMNS, start='20', length='10')))
+    assert ids(last) == list(range(21, 26))
+    past = query_table(table, DataTablesRequest(Args(COLUMNS, start='100', length='10')))
+    assert past['data'] == [] and past['recordsFiltered'] == 25
+
+
+def test_ordering_ascending_and_descending_pages():
+    table = products()
+    by_title = sorted(range(1, 26), key=lambda i: f"Product {(i * 7) % 25:02d}")
+
+    ascending = query_table(table, DataTablesRequest(Args(COLUMNS, start='5', length='5', **{'order[0][column]': '1'})))
+    assert ids(ascending) == by_title[5:10]
+
+    descending = DataTablesRequest(Args(COLUMNS, start='5', length='5', **{'order[0][column]': '1', 'order[0][dir]': 'desc'}))
+    assert ids(query_table(table, descending)) == by_title[::-1][5:10]
+
+    # the last descending page is short rather than wrapping around
+    descending.start = 22
+    assert ids(query_table(table, descending)) == by_title[::-1][22:]
+
+
+def test_ordering_puts_missing_floats_first():
+    table = products(5)
+    response = query_table(table, DataTablesRequest(Args(COLUMNS, **{'order[0][column]': '2'})))
+    assert ids(response)[0] == 3
+    assert response['data'][0]['price'] is None
+
+
+def test_ordering_by_unknown_column_keeps_table_order():
+    args = Args(COLUMNS, **{'columns[3][data]': 'vendor', 'order[0][column]': '3', 'order[0][dir]': 'desc'})
+    response = query_table(products(5), DataTablesRequest(args))
+    assert ids(response) == [1, 2, 3, 4, 5]
+
+
+def test_search_filters_before_paging():
+    table = products()
+    # case insensitive on text columns, numbers also match int columns exactly
+    response = query_table(table, DataTablesRequest(Args(COLUMNS, length='2', **{'search[value]': ' product 1'})))
+    matching = [i for i in range(1, 26) if f"{(i * 7) % 25:02d}".startswith('1')]
+    assert response['recordsTotal'] == 25
+    assert response['recordsFiltered'] == len(matching)
+    assert ids(response) == matching[:2]
+
+    # no title holds "25"
+    by_id = query_table(table, DataTablesRequest(Args(COLUMNS, **{'search[value]': '25'})))
+    assert ids(by_id) == [25]
+
+    nothing = query_table(table, DataTablesRequest(Args(COLUMNS, **{'search[value]': 'missing'})))
+    assert nothing['recordsFiltered'] == 0 and nothing['data'] == []
+
+
+def test_search_with_descending_order():
+    table = products()
+    args = Args(COLUMNS, length='3', **{'search[value]': 'Product 0', 'order[0][column]': '0', 'order[0][dir]': 'desc'})
+    response = query_table(table, DataTablesRequest(args))
+    matching = [i for i in range(1, 26) if f"{(i * 7) % 25:02d}".startswith('0')]
+    assert response['recordsFiltered'] == len(matching)
+    assert ids(response) == sorted(matching, reverse=True)[:3]
+
+
+def test_rows_go_through_fn_row():
+    response = query_table(products(3), DataTablesRequest(Args(COLUMNS)), fn_row=lambda row: row['title'])
+    assert response['data'] == ["Product 01", "Product 02", "Product 00"]
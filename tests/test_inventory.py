@@ -0,0 +1,115 @@
+import math
+import random
+
+from data_store import ShopData
+from inventory import IndexedHeap, LowStockIndex
+
+
+def check_heap(heap: IndexedHeap):
+    # every parent is at most its children and every key is found where its position says
+    entries = heap._heap
+    for i in range(1, len(entries)):
+        assert entries[(i - 1) // 2] <= entries[i]
+    assert {key: i for i, (_, key) in enumerate(entries)} == heap._positions
+
+
+def test_build_orders_by_score():
+    heap = IndexedHeap([("a", 3), ("b", 1), ("c", 2)])
+    check_heap(heap)
+    assert heap.lowest(3) == [(1, "b"), (2, "c"), (3, "a")]
+    assert len(heap) == 3 and "a" in heap and "d" not in heap
+
+
+def test_set_sifts_up_on_decrease_and_down_on_increase():
+    heap = IndexedHeap((key, score) for key, score in zip("abcdefg", range(7)))
+
+    heap.set("g", -1)
+    check_heap(heap)
+    assert heap.lowest(1) == [(-1, "g")]
+
+    heap.set("g", 10)
+    check_heap(heap)
+    assert heap.lowest(2) == [(0, "a"), (1, "b")]
+    assert heap.score("g") == 10
+
+    heap.set("h", 0.5)
+    check_heap(heap)
+    assert heap.lowest(3) == [(0, "a"), (0.5, "h"), (1, "b")]
+
+
+def test_remove_root_inner_and_last():
+    heap = IndexedHeap((key, score) for key, score in zip("abcdefg", range(7)))
+
+    heap.remove("a")
+    check_heap(heap)
+    heap.remove("c")
+    check_heap(heap)
+    heap.remove("g")
+    check_heap(heap)
+    heap.remove("missing")
+
+    assert [key for _, key in heap.lowest(10)] == ["b", "d", "e", "f"]
+    assert heap.score("a") is None
+
+
+def test_remove_moves_last_up():
+    # the last entry replacing a removed one in another subtree can be lower than the removed one's parent
+    heap = IndexedHeap([("a", 0), ("b", 10), ("c", 1), ("d", 11), ("e", 12), ("f", 2), ("g", 3)])
+    heap.remove("d")
+    check_heap(heap)
+    assert [key for _, key in heap.lowest(10)] == ["a", "c", "f", "g", "b", "e"]
+
+
+def test_random_updates_keep_order():
+    rng = random.Random(7)
+    scores = {key: rng.random() for key in range(200)}
+    heap = IndexedHeap(scores.items())
+    for _ in range(2000):
+        key = rng.randrange(250)
+        if rng.random() < 0.2:
+            heap.remove(key)
+            scores.pop(key, None)
+        else:
+            scores[key] = rng.random()
+            heap.set(key, scores[key])
+    check_heap(heap)
+    assert heap.lowest(len(scores)) == sorted((score, key) for key, score in scores.items())
+
+
+def shop_with_variants(quantities: dict) -> ShopData:
+    shop_data = ShopData("test-shop")
+    shop_data.load("variants", [{'id': f"gid://shopify/ProductVariant/{variant_id}", 'inventoryQuantity': quantity}
+                                for variant_id, quantity in quantities.items()])
+    return shop_data
+
+
+def test_low_stock_index_without_sales():
+    index = LowStockIndex(ordering='days_of_cover')
+    index.build(shop_with_variants({1: 10, 2: 0, 3: 4}))
+
+    # out of stock first, variants without recent sales have an infinite cover
+    assert index.lowest(1) == [2]
+    assert index.heap.score(2) == 0.0
+    assert math.isinf(index.heap.score(1))
+    assert not index.needs_reorder(3)
+
+
+def test_low_stock_index_update_moves_variant_and_flags_crossing():
+    index = LowStockIndex(ordering='threshold')
+    index.build(shop_with_variants({1: 50, 2: 30, 3: 35}))
+    index.velocity = {1: 2.0, 2: 1.0, 3: 1.0}
+    index.reorder_point = {1: 20.0, 2: 10.0, 3: 10.0}
+    for variant_id in (1, 2, 3):
+        index.heap.set(variant_id, index.score(variant_id))
+    assert index.lowest(3) == [2, 3, 1]
+
+    # crossing the reorder point flags once, staying below it does not again
+    assert index.update(1, 15)
+    assert index.lowest(1) == [1]
+    assert not index.update(1, 12)
+    assert index.needs_reorder(1)
+
+    # back above it moves the variant down again
+    assert not index.update(1, 100)
+    assert index.lowest(3) == [2, 3, 1]
+    check_heap(index.heap)